@@ -0,0 +1,166 @@
+import os
+import json
+import time
+from itertools import chain
+from typing import Iterable, Iterator, List, Dict, Tuple
+from src.utils import LoggingHandler
+from src.openaiQuery import OpenAIQuery
+from src.chunker import merge_results
+
+# final states of a batch, see https://platform.openai.com/docs/api-reference/batch/object
+FINAL_STATES = ('completed', 'failed', 'expired', 'cancelled')
+BATCH_PRICE_FACTOR = 0.5  # Batch API costs half of the synchronous one
+
+
+class BatchExtractor(LoggingHandler):
+    """
+    Knowledge extraction through the OpenAI Batch API: documents are written as JSONL requests (the same messages
+    as `OpenAIQuery.query`, long documents split into chunks), submitted as batches, polled until done and their
+    results streamed back per document.
+    Submitted batches are recorded in `<state_dir>/batches.json`, so an interrupted run resumes polling & collecting
+    them instead of submitting the documents again.
+    """
+    def __init__(self, openai: OpenAIQuery, state_dir: str, max_requests_per_batch: int = 50000,
+                 max_batch_bytes: int = 190 * 1024 * 1024):
+        super().__init__(self)
+        self.openai = openai
+        self.client = openai.gpt_client
+        self.metrics = openai.metrics
+        self.state_dir = state_dir
+        self.max_requests_per_batch = max_requests_per_batch
+        self.max_batch_bytes = max_batch_bytes
+        os.makedirs(state_dir, exist_ok=True)
+        self.state_path = os.path.join(state_dir, "batches.json")
+        self.state = dict()
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                self.state = json.load(f)
+
+    def _save_state(self):
+        tmp = self.state_path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp, self.state_path)
+
+    def pending(self) -> List[str]:
+        """:return: ids of submitted batches whose results weren't collected yet"""
+        return [batch_id for batch_id, b in self.state.items() if not b.get('collected')]
+
+    def write_requests(self, docs: Iterable[Tuple[str, List[str]]], model: str) -> List[str]:
+        """
+        Write JSONL request files, split to respect the Batch API limits of requests & bytes per batch.
+        :param docs: (element_id, page texts) of the documents
+        :param model: OpenAI model
+        :return: paths of the request files
+        """
+        paths, f, n_requests, n_bytes = list(), None, 0, 0
+        for element_id, pages in docs:
+            chunks = self.openai.chunker.split(pages, model)
+            for i, chunk in enumerate(chunks):
+                line = json.dumps({'custom_id': f"{element_id}|{i}|{len(chunks)}", 'method': "POST",
+                                   'url': "/v1/chat/completions",
+                                   'body': {'model': model, 'messages': self.openai.build_messages(chunk),
+                                            'temperature': 0., 'max_tokens': self.openai.max_tokens,
+                                            **self.openai.request_options}
+                                   }) + "\n"
+                size = len(line.encode("utf-8"))
+                # chunks of one document may end up in different batches, they are merged when collected
+                if f is None or n_requests >= self.max_requests_per_batch or n_bytes + size > self.max_batch_bytes:
+                    if f is not None:
+                        f.close()
+                    paths.append(os.path.join(self.state_dir, f"requests_{int(time.time() * 1000)}_{len(paths)}.jsonl"))
+                    f, n_requests, n_bytes = open(paths[-1], 'w'), 0, 0
+                f.write(line)
+                n_requests += 1
+                n_bytes += size
+        if f is not None:
+            f.close()
+        self.log.info(f"Wrote {len(paths)} batch request files.")
+        return paths
+
+    def submit(self, path: str, model: str) -> str:
+        """Upload a request file and create its batch. :return: batch id"""
+        with open(path, 'rb') as f:
+            file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(input_file_id=file.id, endpoint="/v1/chat/completions",
+                                           completion_window="24h")
+        self.state[batch.id] = {'requests': path, 'model': model, 'status': batch.status, 'collected': False,
+                                'submitted_at': time.time()}
+        self._save_state()
+        self.metrics.inc('llm_batches_submitted_total', model=model)
+        self.log.info(f"Submitted batch {batch.id} ({path}).")
+        return batch.id
+
+    def wait(self, batch_id: str, poll_interval: float = 60., timeout: float = None):
+        """
+        Poll the batch until it reaches a final state.
+        :return: the batch object
+        """
+        t_start = time.time()
+        while True:
+            batch = self.client.batches.retrieve(batch_id)
+            if batch_id in self.state and self.state[batch_id]['status'] != batch.status:
+                self.state[batch_id]['status'] = batch.status
+                self._save_state()
+            if batch.status in FINAL_STATES:
+                self.log.info(f"Batch {batch_id} {batch.status}: {batch.request_counts}")
+                return batch
+            if timeout is not None and time.time() - t_start > timeout:
+                raise TimeoutError(f"Batch {batch_id} not finished after {timeout} sec (status {batch.status}).")
+            self.log.debug(f"Batch {batch_id} is {batch.status}, next poll in {poll_interval} sec.")
+            time.sleep(poll_interval)
+
+    def _lines(self, file_id: str) -> Iterator[dict]:
+        """Stream a JSONL result file line by line, the file is never held in memory as a whole."""
+        if file_id is None:
+            return
+        with self.client.files.with_streaming_response.content(file_id) as response:
+            for line in response.iter_lines():
+                if line.strip():
+                    yield json.loads(line)
+
+    def collect(self, batch) -> Iterator[Tuple[str, dict]]:
+        """
+        Stream results of a finished batch, one per document (chunks of a document are merged, see
+        `merge_results`; chunks submitted in other batches are awaited in `<state_dir>/partial.json`).
+        :param batch: batch object returned by `wait`
+        :return: generator of (element_id, output) with output as returned by `OpenAIQuery.query`
+        """
+        model = self.state.get(batch.id, dict()).get('model', "default")
+        partial_path = os.path.join(self.state_dir, "partial.json")
+        partial = dict()
+        if os.path.exists(partial_path):
+            with open(partial_path) as f:
+                partial = json.load(f)
+
+        for item in chain(self._lines(batch.output_file_id), self._lines(batch.error_file_id)):
+            element_id, i, n = item['custom_id'].rsplit("|", 2)
+            response = item.get('response') or dict()
+            if item.get('error') or response.get('status_code') != 200:
+                error = item.get('error') or response.get('body', dict()).get('error')
+                self.log.error(f"Batch request {item['custom_id']} failed: {error}")
+                self.metrics.inc('llm_requests_total', model=model, status="error", api="batch")
+                output = {"error": f"Batch request failed: {error}", "response": str(response or None)}
+            else:
+                body = response['body']
+                self.metrics.inc('llm_requests_total', model=model, status="ok", api="batch")
+                self.metrics.record_llm_usage(model, body.get('usage'), BATCH_PRICE_FACTOR)
+                output = self.openai.parse_output(body['choices'][0]['message']['content'], model, body)
+
+            if int(n) == 1:
+                yield element_id, output
+                continue
+            parts = partial.setdefault(element_id, dict())
+            parts[i] = output
+            if len(parts) == int(n):
+                del partial[element_id]
+                yield element_id, merge_results([parts[str(k)] for k in range(int(n))])
+
+        with open(partial_path, 'w') as f:
+            json.dump(partial, f)
+        if partial:
+            self.log.info(f"{len(partial)} documents wait for chunks from other batches.")
+
+    def mark_collected(self, batch_id: str):
+        self.state.setdefault(batch_id, dict())['collected'] = True
+        self._save_state()
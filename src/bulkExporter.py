@@ -0,0 +1,185 @@
+import os
+import csv
+import gzip
+import json
+import time
+from typing import Dict
+from src.utils import LoggingHandler
+from src.dataLoader import DataLoader
+from src.manifest import FileManifest
+from src.metrics import Metrics
+from src.contentStore import ContentStore
+
+# page properties with a CSV column (value of the declared type), any other one goes to the properties file
+PAGE_COLUMNS = [('pageNumber', 'long', int), ('text', 'string', str), ('id_page', 'string', str)]
+# page text moved to a content store (see `ContentStore.externalize`)
+REF_COLUMNS = [('text_ref', 'string', str), ('text_preview', 'string', str)]
+ARRAY_DELIMITER = ";"
+
+
+class BulkExporter(LoggingHandler):
+    """
+    Writes a corpus as CSV files for the offline importer (`neo4j-admin database import full`), orders of magnitude
+    faster than transactional ingestion for the initial load of a new corpus. Node & relationship files (with
+    headers) are streamed file by file, node ids & properties are the ones `KnowledgeGraph.ingest_data` writes,
+    so incremental ingestion and extraction work on top of the imported graph.
+    Page properties vary between files, CSV columns can't: the ones without a column (see `PAGE_COLUMNS`) are
+    written to `page_properties.jsonl`, set after the import by `KnowledgeGraph.import_page_properties`.
+    """
+    NODE_FILES = {'Directory': ["id:ID(Directory)", "name"],
+                  'File': ["id:ID(File)", "name", "_minhash:long[]", "size:long", "mtime:double", "content_hash"],
+                  'Page': ["id:ID(Page)"] + [f"{name}:{t}" for name, t, _ in PAGE_COLUMNS]}
+    RELATIONSHIP_FILES = {'CONTAINS_DIR': [":START_ID(Directory)", ":END_ID(Directory)"],
+                          'CONTAINS_FILE': [":START_ID(Directory)", ":END_ID(File)"],
+                          'CONTAINS_PAGE': [":START_ID(File)", ":END_ID(Page)"]}
+    PROPERTIES_FILE = "page_properties.jsonl"
+
+    def __init__(self, output_dir: str, compress: bool = False, metrics: Metrics = None,
+                 content_store: ContentStore = None):
+        """
+        :param output_dir: directory for the CSV files
+        :param compress: write gzipped CSVs (`.csv.gz`, read by the importer as they are)
+        :param metrics: metrics registry
+        :param content_store: export large page properties as references to this store, as `ingest_data` does
+        """
+        super().__init__(self)
+        self.output_dir = output_dir
+        self.compress = compress
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.content_store = content_store
+        self.page_columns = PAGE_COLUMNS + (REF_COLUMNS if content_store is not None else list())
+        self.node_files = {**self.NODE_FILES,
+                           'Page': ["id:ID(Page)"] + [f"{name}:{t}" for name, t, _ in self.page_columns]}
+        os.makedirs(output_dir, exist_ok=True)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.output_dir, name.lower() + (".csv.gz" if self.compress else ".csv"))
+
+    def _open(self, name: str, header: list):
+        path = self.path(name)
+        f = gzip.open(path, 'wt', newline="", encoding="utf-8") if self.compress else \
+            open(path, 'w', newline="", encoding="utf-8")
+        writer = csv.writer(f, quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(header)
+        return f, writer
+
+    def export(self, data_dir: str, workers: int = None, signatures: bool = True, manifest_path: str = None) -> dict:
+        """
+        Export the directory structure & contents of all JSON files in `data_dir`.
+        :param data_dir: corpus directory
+        :param workers: file parsing processes, see `DataLoader.iter_payloads`
+        :param signatures: export MinHash signatures of file texts (`_minhash`) for `find_duplicates`
+        :param manifest_path: record the exported files in this manifest (see `FileManifest`), so that a later
+        incremental `ingest_data` with it writes only files changed since the export
+        :return: stats - nodes & relationships per type, spilled page properties, failed files, bytes written,
+        seconds and throughput (files, pages & MB per second), and the import command
+        """
+        data = DataLoader.from_path(data_dir, self.metrics)
+        if data is None:
+            raise ValueError(f"Not a directory: {data_dir}")
+        manifest = FileManifest(manifest_path) if manifest_path is not None else None
+        stats = {'nodes': {label: 0 for label in self.node_files},
+                 'relationships': {rel: 0 for rel in self.RELATIONSHIP_FILES},
+                 'spilled_page_properties': 0}
+        handles, writers = dict(), dict()
+        for name, header in list(self.node_files.items()) + list(self.RELATIONSHIP_FILES.items()):
+            handles[name], writers[name] = self._open(name, header)
+        spill = open(os.path.join(self.output_dir, self.PROPERTIES_FILE), 'w', encoding="utf-8")
+
+        t_start = time.time()
+        try:
+            directories = set()
+            for pair in data.iter_directory_pairs():  # same ids & names as `ingest_data`
+                for d in (pair['source'], pair['target']):
+                    if d not in directories:
+                        directories.add(d)
+                        writers['Directory'].writerow([d, d.split("/")[-1]])
+                writers['CONTAINS_DIR'].writerow([pair['source'], pair['target']])
+                stats['relationships']['CONTAINS_DIR'] += 1
+            stats['nodes']['Directory'] = len(directories)
+
+            def files():
+                for file in data.iter_files():
+                    if manifest is not None:
+                        _, file['file_meta'] = manifest.classify(file['path'])
+                    yield file
+
+            for file, payload in data.iter_payloads(files(), workers, signatures):
+                meta = file.get('file_meta') or dict()
+                writers['File'].writerow([payload['id'], payload['name'],
+                                          ARRAY_DELIMITER.join(str(x) for x in payload.get('minhash') or list()),
+                                          meta.get('size'), meta.get('mtime'), meta.get('content_hash')])
+                writers['CONTAINS_FILE'].writerow([payload['directory_id'], payload['id']])
+                stats['nodes']['File'] += 1
+                stats['relationships']['CONTAINS_FILE'] += 1
+                for page_id, props in self._merge_pages(payload).items():
+                    if self.content_store is not None:
+                        props = self.content_store.externalize(props)
+                    row, others = self.page_row(page_id, props)
+                    writers['Page'].writerow(row)
+                    writers['CONTAINS_PAGE'].writerow([payload['id'], page_id])
+                    if others:
+                        spill.write(json.dumps({'id': page_id, 'properties': others}, ensure_ascii=False) + "\n")
+                        stats['spilled_page_properties'] += len(others)
+                    stats['nodes']['Page'] += 1
+                    stats['relationships']['CONTAINS_PAGE'] += 1
+                if manifest is not None:
+                    manifest.update(payload['id'], meta)
+                if stats['nodes']['File'] % 1000 == 0:
+                    self.log.info(f"Exported {stats['nodes']['File']} files, {stats['nodes']['Page']} pages "
+                                  f"({round(stats['nodes']['File'] / (time.time() - t_start), 1)} files/s).")
+        finally:
+            for f in handles.values():
+                f.close()
+            spill.close()
+            if manifest is not None:
+                manifest.close()
+
+        stats['failed_files'] = int(self.metrics.get('files_failed_total'))
+        stats['seconds'] = time.time() - t_start
+        stats['bytes'] = sum(os.path.getsize(self.path(name)) for name in handles) + \
+            os.path.getsize(os.path.join(self.output_dir, self.PROPERTIES_FILE))
+        stats['files_per_sec'] = stats['nodes']['File'] / max(stats['seconds'], 1e-6)
+        stats['pages_per_sec'] = stats['nodes']['Page'] / max(stats['seconds'], 1e-6)
+        stats['mb_per_sec'] = stats['bytes'] / 1024 ** 2 / max(stats['seconds'], 1e-6)
+        stats['command'] = self.import_command()
+        for label, n in stats['nodes'].items():
+            self.metrics.inc('export_nodes_total', n, label=label)
+        for rel, n in stats['relationships'].items():
+            self.metrics.inc('export_relationships_total', n, type=rel)
+        self.log.info(f"Exported {stats['nodes']} nodes & {stats['relationships']} relationships "
+                      f"({round(stats['bytes'] / 1024 ** 2, 1)} MB) in {round(stats['seconds'], 1)} sec: "
+                      f"{round(stats['files_per_sec'], 1)} files/s, {round(stats['pages_per_sec'], 1)} pages/s, "
+                      f"{round(stats['mb_per_sec'], 1)} MB/s. Import with:\n{stats['command']}")
+        return stats
+
+    @staticmethod
+    def _merge_pages(payload: dict) -> Dict[str, dict]:
+        """Pages of a file by id; pages sharing an id are merged into one node, as `MERGE` in `ingest_data` does."""
+        pages = dict()
+        for page in payload['pages']:
+            pages.setdefault(page['id'], dict()).update(page['others'])
+        return pages
+
+    def page_row(self, page_id: str, props: dict) -> tuple:
+        """:return: CSV row of a page and its properties without a column (or with a value of another type)"""
+        row, others = [page_id], dict()
+        for name, _, t in self.page_columns:
+            value = props.get(name)
+            # an empty cell imports as no property, so empty strings are set afterwards too
+            if value is None or (isinstance(value, t) and not isinstance(value, bool) and value != ""):
+                row.append(value)
+            else:
+                row.append(None)
+                others[name] = value
+        for name, value in props.items():
+            if name not in others and all(name != c for c, _, _ in self.page_columns) and value is not None:
+                others[name] = value
+        return row, others
+
+    def import_command(self, database: str = "neo4j") -> str:
+        """:return: `neo4j-admin` command importing the exported files into a new (or overwritten) database"""
+        args = [f"--nodes={label}={self.path(label)}" for label in self.node_files]
+        args += [f"--relationships={rel}={self.path(rel)}" for rel in self.RELATIONSHIP_FILES]
+        return (f"neo4j-admin database import full {database} --overwrite-destination --multiline-fields=true "
+                f"--array-delimiter=\"{ARRAY_DELIMITER}\" " + " ".join(args))
@@ -0,0 +1,204 @@
+import json
+import time
+import queue
+import threading
+from typing import Iterable, Dict, List, Callable
+from neo4j.exceptions import TransientError, ServiceUnavailable, SessionExpired
+from src.utils import LoggingHandler
+from src.metrics import in_context
+
+# errors after which the same batch is worth re-trying (after backing off)
+TRANSIENT_ERRORS = (TransientError, ServiceUnavailable, SessionExpired)
+_DONE = object()
+
+
+class AdaptiveBackpressure:
+    """
+    Pause between write batches that adapts to the DB: grows when a batch fails with a transient error or its
+    latency exceeds `target_latency`, decays back to zero while batches are fast & successful.
+    """
+    def __init__(self, target_latency: float = 2., min_step: float = 0.5, max_delay: float = 30.,
+                 increase: float = 2., decrease: float = 0.5):
+        self.target_latency = target_latency
+        self.min_step = min_step
+        self.max_delay = max_delay
+        self.increase = increase
+        self.decrease = decrease
+        self.delay = 0.
+
+    def _grow(self):
+        self.delay = min(max(self.delay * self.increase, self.min_step), self.max_delay)
+
+    def on_success(self, latency: float):
+        if latency > self.target_latency:
+            self._grow()
+        else:
+            self.delay *= self.decrease
+            if self.delay < self.min_step / 4:
+                self.delay = 0.
+
+    def on_error(self):
+        self._grow()
+
+    def wait(self):
+        if self.delay > 0:
+            time.sleep(self.delay)
+
+
+class BulkWriter(LoggingHandler):
+    """
+    Groups rows into batches (bounded by row count and by serialised payload size) and writes each batch with
+    a single `UNWIND $rows AS row ...` query.
+    """
+    def __init__(self, neo, batch_size: int = 200, max_batch_bytes: int = 8 * 1024 * 1024, max_retries: int = 5,
+                 backpressure: AdaptiveBackpressure = None):
+        super().__init__(self)
+        self.neo = neo
+        self.batch_size = max(1, batch_size)
+        self.max_batch_bytes = max_batch_bytes
+        self.max_retries = max_retries
+        self.backpressure = backpressure if backpressure is not None else AdaptiveBackpressure()
+        self.failed_rows = list()
+        self._on_batch = None
+        # effective batch size shrinks on transient errors and recovers on success
+        self._current_size = self.batch_size
+
+    def write(self, query: str, rows: Iterable[Dict], label: str = "rows",
+              on_batch: Callable[[List[Dict]], None] = None) -> dict:
+        """
+        Write all rows in batches. A batch failing on bad data is split to isolate the offending rows (recorded in
+        `failed_rows`), a transient DB error persisting after `max_retries` attempts is raised.
+        :param query: Cypher query consuming the batch through `$rows` parameter (`UNWIND $rows AS row ...`)
+        :param rows: any iterable of dicts (consumed lazily, so a generator keeps memory flat)
+        :param label: name used in progress reports
+        :param on_batch: called with the rows of each successfully written batch
+        :return: totals - rows, bytes, batches, failed rows, seconds, rows/sec, bytes/sec
+        """
+        stats = {'rows': 0, 'bytes': 0, 'batches': 0, 'failed': 0, 'seconds': 0.}
+        self._on_batch = on_batch
+        batch, batch_bytes = list(), 0
+        for row in rows:
+            size = len(json.dumps(row, default=str))
+            if batch and (len(batch) >= self._current_size or batch_bytes + size > self.max_batch_bytes):
+                self._flush(query, batch, batch_bytes, label, stats)
+                batch, batch_bytes = list(), 0
+            batch.append(row)
+            batch_bytes += size
+        if batch:
+            self._flush(query, batch, batch_bytes, label, stats)
+
+        stats['rows_per_sec'] = stats['rows'] / stats['seconds'] if stats['seconds'] > 0 else 0.
+        stats['bytes_per_sec'] = stats['bytes'] / stats['seconds'] if stats['seconds'] > 0 else 0.
+        self.log.info(f"[{label}] Finished: {stats['rows']} rows ({round(stats['bytes'] / 1024 ** 2, 1)} MB) in "
+                      f"{stats['batches']} batches, {round(stats['seconds'], 1)} sec write time "
+                      f"({round(stats['rows_per_sec'])} rows/s, {round(stats['bytes_per_sec'] / 1024)} KB/s), "
+                      f"{stats['failed']} failed.")
+        return stats
+
+    def write_parallel(self, query: str, rows: Iterable[Dict], label: str = "rows",
+                       on_batch: Callable[[List[Dict]], None] = None, writers: int = 2,
+                       queue_size: int = None) -> dict:
+        """
+        Like `write`, but `writers` threads (each batching & backing off on its own) write concurrently, fed by the
+        calling thread through a bounded queue: producing the rows (e.g. parsing files) overlaps with the writes
+        and a full queue makes the producer wait for the DB. `on_batch` is called from the writer threads.
+        :param writers: number of writer threads, 1 is the same as `write`
+        :param queue_size: max rows waiting for the writers, 2 batches per writer if None
+        :return: totals as in `write`, `seconds` being the elapsed time
+        """
+        if writers <= 1:
+            return self.write(query, rows, label, on_batch)
+        rows_queue = queue.Queue(maxsize=queue_size if queue_size is not None else 2 * writers * self.batch_size)
+        results, errors, lock = list(), list(), threading.Lock()
+
+        def consume():
+            while True:
+                row = rows_queue.get()
+                if row is _DONE:
+                    return
+                yield row
+
+        def work(i: int):
+            writer = BulkWriter(self.neo, self.batch_size, self.max_batch_bytes, self.max_retries)
+            try:
+                stats = writer.write(query, consume(), f"{label} #{i}", on_batch)
+            except Exception as e:
+                errors.append(e)
+                for _ in consume():  # keep the queue moving so that the producer doesn't block
+                    pass
+                return
+            with lock:
+                results.append(stats)
+                self.failed_rows += writer.failed_rows
+
+        t_start = time.time()
+        threads = [threading.Thread(target=in_context(work), args=(i,), daemon=True, name=f"writer-{i}") for i in range(writers)]
+        for thread in threads:
+            thread.start()
+        try:
+            for row in rows:
+                rows_queue.put(row)
+        finally:
+            for _ in threads:
+                rows_queue.put(_DONE)
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+
+        stats = {key: sum(r[key] for r in results) for key in ['rows', 'bytes', 'batches', 'failed']}
+        stats['seconds'] = time.time() - t_start
+        stats['rows_per_sec'] = stats['rows'] / stats['seconds'] if stats['seconds'] > 0 else 0.
+        stats['bytes_per_sec'] = stats['bytes'] / stats['seconds'] if stats['seconds'] > 0 else 0.
+        self.log.info(f"[{label}] Finished: {stats['rows']} rows by {writers} writers in {round(stats['seconds'], 1)} "
+                      f"sec ({round(stats['rows_per_sec'])} rows/s), {stats['failed']} failed.")
+        return stats
+
+    def _flush(self, query: str, batch: List[Dict], batch_bytes: int, label: str, stats: dict):
+        """Write one batch, re-trying transient errors (re-raised after `max_retries`) and bisecting on other ones."""
+        error = None
+        for attempt in range(1, self.max_retries + 1):
+            self.backpressure.wait()
+            t_start = time.time()
+            try:
+                self.neo.write_batch(query, batch)
+            except TRANSIENT_ERRORS as e:
+                error = e
+                self.backpressure.on_error()
+                self._current_size = max(1, self._current_size // 2)
+                self.log.warning(f"[{label}] Transient error on batch of {len(batch)} rows (attempt {attempt}/"
+                                 f"{self.max_retries}), backing off {round(self.backpressure.delay, 1)} sec: {e}")
+                continue
+            except Exception as e:
+                self._bisect(query, batch, label, stats, e)
+                return
+            latency = time.time() - t_start
+            self.backpressure.on_success(latency)
+            self._current_size = min(self.batch_size, self._current_size * 2)
+
+            stats['rows'] += len(batch)
+            stats['bytes'] += batch_bytes
+            stats['batches'] += 1
+            stats['seconds'] += latency
+            self.log.info(f"[{label}] Batch {stats['batches']}: {len(batch)} rows, {round(batch_bytes / 1024)} KB "
+                          f"in {round(latency, 2)} sec ({round(len(batch) / max(latency, 1e-6))} rows/s, "
+                          f"{round(batch_bytes / 1024 / max(latency, 1e-6))} KB/s)")
+            if self._on_batch is not None:
+                self._on_batch(batch)
+            return
+        # the DB is unavailable rather than the batch invalid: splitting it would only multiply the retries
+        self.log.error(f"[{label}] Giving up after {self.max_retries} transient errors on a batch of {len(batch)} rows.")
+        raise error
+
+    def _bisect(self, query: str, batch: List[Dict], label: str, stats: dict, error):
+        """Split a failing batch in halves to isolate the offending row(s), keep writing the rest."""
+        if len(batch) == 1:
+            self.log.error(f"[{label}] Failure when storing a row to Neo4j: {error}\n\tRow ID: {batch[0].get('id')}")
+            self.log.debug(f"\n\tContent: {batch[0]}")
+            self.failed_rows.append(batch[0].get('id'))
+            stats['failed'] += 1
+            return
+        self.log.warning(f"[{label}] Batch of {len(batch)} rows failed, splitting it: {error}")
+        half = len(batch) // 2
+        for part in (batch[:half], batch[half:]):
+            self._flush(query, part, sum(len(json.dumps(r, default=str)) for r in part), label, stats)
@@ -0,0 +1,118 @@
+from typing import List, Dict
+from src.utils import LoggingHandler, estimate_tokens
+
+# context window (input + output tokens) per model
+MODEL_CONTEXT = {
+    'gpt-4': 8192,
+    'gpt-4-32k': 32768,
+    'gpt-4-turbo': 128000,
+    'gpt-4o': 128000,
+    'gpt-3.5-turbo': 16385,
+    'default': 8192
+}
+
+
+class Chunker(LoggingHandler):
+    """
+    Splits a document into chunks that fit the model's context window next to the prompt and the reserved output
+    tokens. Pages are packed greedily, a page is only split (on paragraphs, then lines) when it alone is too long.
+    """
+    def __init__(self, prompt_tokens: int, max_tokens: int, margin: int = 100, min_chunk_tokens: int = 500):
+        super().__init__(self)
+        self.prompt_tokens = prompt_tokens
+        self.max_tokens = max_tokens
+        self.margin = margin
+        self.min_chunk_tokens = min_chunk_tokens
+
+    def budget(self, model: str) -> int:
+        """:return: max number of document tokens per LLM call"""
+        context = MODEL_CONTEXT.get(model, MODEL_CONTEXT['default'])
+        budget = context - self.prompt_tokens - self.max_tokens - self.margin
+        if budget < self.min_chunk_tokens:
+            self.log.warning(f"Prompt ({self.prompt_tokens}) and max_tokens ({self.max_tokens}) leave only {budget} "
+                             f"tokens of {model} context for the document, using {self.min_chunk_tokens}.")
+            budget = self.min_chunk_tokens
+        return budget
+
+    def split(self, pages: List[str], model: str) -> List[str]:
+        """
+        :param pages: texts of document pages, in order
+        :param model: OpenAI model
+        :return: chunks of text, pages within a chunk separated by empty line
+        """
+        budget = self.budget(model)
+        chunks, current, current_tokens = list(), list(), 0
+        for page in pages:
+            for piece in self._split_long(page, budget, ["\n\n", "\n", " "]):
+                tokens = estimate_tokens(piece)
+                if current and current_tokens + tokens > budget:
+                    chunks.append("\n\n".join(current))
+                    current, current_tokens = list(), 0
+                current.append(piece)
+                current_tokens += tokens
+        if current:
+            chunks.append("\n\n".join(current))
+        return chunks
+
+    def _split_long(self, text: str, budget: int, separators: List[str]) -> List[str]:
+        if estimate_tokens(text) <= budget:
+            return [text]
+        if not separators:  # no separator left, cut by characters
+            n_chars = max(1, len(text) * budget // estimate_tokens(text))
+            return [text[i:i + n_chars] for i in range(0, len(text), n_chars)]
+        pieces, current = list(), ""
+        for part in text.split(separators[0]):
+            candidate = current + separators[0] + part if current else part
+            if current and estimate_tokens(candidate) > budget:
+                pieces.append(current)
+                candidate = part
+            current = candidate
+        if current:
+            pieces.append(current)
+        return [x for piece in pieces for x in self._split_long(piece, budget, separators[1:])]
+
+
+def merge_results(results: List[Dict]) -> dict:
+    """
+    Merge LLM outputs of chunks of one document into a single output. Entities with the same label & name are merged
+    and all entities get new document-wide ids (in order of first appearance), relations are re-mapped to them and
+    de-duplicated.
+    :param results: LLM outputs of the chunks, in order
+    :return: merged output, with the number of failed chunks in `_failed_chunks` if any; the first error if no
+    chunk succeeded
+    """
+    valid = [r for r in results if 'error' not in r and 'entities' in r and 'relations' in r]
+    if not valid:
+        return results[0] if results else {"error": "No chunks to merge", "response": None}
+
+    entities, relations = dict(), dict()
+    entity_ids, relation_keys = dict(), set()
+    content_types = [r['content_type'] for r in valid if r.get('content_type')]
+    for result in valid:
+        local_ids = dict()
+        for label, arr in result['entities'].items():
+            for e in arr:
+                key = (label.strip(), str(e.get('name', "")).strip().lower())
+                if key not in entity_ids:
+                    entity_ids[key] = len(entity_ids)
+                    entities.setdefault(label, list()).append({**e, 'id': entity_ids[key]})
+                local_ids[e.get('id')] = entity_ids[key]
+        for rel_type, arr in result['relations'].items():
+            for r in arr:
+                if r.get('source') not in local_ids or r.get('target') not in local_ids:
+                    continue
+                rel = {**r, 'source': local_ids[r['source']], 'target': local_ids[r['target']]}
+                key = (rel_type.strip(), rel['source'], rel['target'])
+                if key in relation_keys:
+                    continue
+                relation_keys.add(key)
+                relations.setdefault(rel_type, list()).append(rel)
+
+    merged = {'entities': entities, 'relations': relations}
+    if content_types:
+        merged['content_type'] = max(set(content_types), key=content_types.count)
+    if any(r.get('_truncated') for r in valid):
+        merged['_truncated'] = True
+    if len(valid) < len(results):
+        merged['_failed_chunks'] = len(results) - len(valid)
+    return merged
@@ -0,0 +1,110 @@
+import os
+import re
+import zlib
+import hashlib
+import threading
+from collections import OrderedDict
+from src.utils import LoggingHandler
+from src.metrics import Metrics
+
+_REF = re.compile(r"sha256:[0-9a-f]{64}")
+
+
+class ContentStore(LoggingHandler):
+    """
+    Local content-addressed blob store for large texts (page texts, raw OCR payloads, LLM metadata): blobs are
+    zlib-compressed files named by the SHA-256 of their content, so identical contents are stored once. Nodes keep
+    only a reference (`<key>_ref`) and a short preview (`<key>_preview`) instead of the text, which keeps the store,
+    transaction logs and page cache small. Reads go through an in-memory LRU cache of up to `cache_bytes`.
+    """
+    def __init__(self, root: str, min_bytes: int = 2048, preview_chars: int = 200, level: int = 6,
+                 cache_bytes: int = 64 * 1024 ** 2, metrics: Metrics = None):
+        """
+        :param root: blob directory
+        :param min_bytes: string properties of at least this size (UTF-8) are moved to the store
+        :param preview_chars: length of the preview kept on the node
+        :param level: zlib compression level
+        :param cache_bytes: max size of the read cache (uncompressed)
+        :param metrics: metrics registry
+        """
+        super().__init__(self)
+        self.root = root
+        self.min_bytes = min_bytes
+        self.preview_chars = preview_chars
+        self.level = level
+        self.cache_bytes = cache_bytes
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.cache, self.cached_bytes = OrderedDict(), 0
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def is_ref(value) -> bool:
+        return isinstance(value, str) and _REF.fullmatch(value) is not None
+
+    def path(self, ref: str) -> str:
+        digest = ref.split(":", 1)[1]
+        return os.path.join(self.root, digest[:2], digest + ".z")
+
+    def put(self, text: str) -> str:
+        """Store a text (unless already stored). :return: its reference"""
+        data = text.encode("utf-8")
+        ref = "sha256:" + hashlib.sha256(data).hexdigest()
+        path = self.path(ref)
+        self.metrics.inc('content_store_bytes_total', len(data), kind="raw")
+        if os.path.exists(path):
+            self.metrics.inc('content_store_dedup_total')
+            return ref
+        compressed = zlib.compress(data, self.level)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(compressed)
+        os.replace(tmp, path)  # atomic, concurrent writers of the same blob write the same bytes
+        self.metrics.inc('content_store_bytes_total', len(compressed), kind="stored")
+        return ref
+
+    def get(self, ref: str) -> str:
+        """:return: text of a reference, None if it isn't in the store"""
+        with self.lock:
+            text = self.cache.get(ref)
+            if text is not None:
+                self.cache.move_to_end(ref)
+                self.metrics.inc('content_store_cache_hits_total')
+                return text
+        self.metrics.inc('content_store_cache_misses_total')
+        try:
+            with open(self.path(ref), 'rb') as f:
+                text = zlib.decompress(f.read()).decode("utf-8")
+        except FileNotFoundError:
+            self.log.warning(f"Blob {ref} not found in {self.root}")
+            return None
+        with self.lock:
+            if ref not in self.cache and len(text) <= self.cache_bytes:
+                self.cache[ref] = text
+                self.cached_bytes += len(text)
+                while self.cached_bytes > self.cache_bytes:
+                    _, evicted = self.cache.popitem(last=False)
+                    self.cached_bytes -= len(evicted)
+        return text
+
+    def resolve(self, value):
+        """:return: the text of `value` if it is a reference, `value` itself otherwise"""
+        return self.get(value) if self.is_ref(value) else value
+
+    def externalize(self, props: dict, min_bytes: int = None) -> dict:
+        """
+        Move large string properties to the store.
+        :param props: node properties
+        :param min_bytes: size threshold, `self.min_bytes` if None
+        :return: properties where each large `key` is None (so that `SET n += props` removes a previous inline
+        value) and `<key>_ref` & `<key>_preview` are added
+        """
+        min_bytes = self.min_bytes if min_bytes is None else min_bytes
+        out = dict(props)
+        for key, value in props.items():
+            if isinstance(value, str) and len(value) * 4 >= min_bytes and len(value.encode("utf-8")) >= min_bytes:
+                out[key] = None
+                out[f"{key}_ref"] = self.put(value)
+                out[f"{key}_preview"] = value[:self.preview_chars]
+        return out
@@ -1,61 +1,307 @@
 import os
+import re
 import json
-from typing import List, Dict
+import mmap
+import time
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Iterator, Iterable
 from src.utils import LoggingHandler
+from src.metrics import Metrics
+from src.dedup import MinHasher
+
+try:  # optional faster JSON decoder
+    import orjson
+    _loads = orjson.loads
+    JSON_BACKEND = "orjson"
+except ImportError:
+    _loads = json.loads
+    JSON_BACKEND = "json"
+
+IGNORE_KEYS = ('words',)  # too verbose page keys, skipped while parsing
 
 
 class DataLoader(LoggingHandler):
-    def __init__(self, data_dir: str):
+    def __init__(self, data_dir: str, metrics: Metrics = None):
         super().__init__(self)
         self.data_dir = data_dir
+        self.metrics = metrics if metrics is not None else Metrics()
 
     @classmethod
-    def from_path(cls, path: str):
+    def from_path(cls, path: str, metrics: Metrics = None):
         if not os.path.exists(path) or not os.path.isdir(path):
             return None
-        return cls(path)
+        return cls(path, metrics)
 
     @staticmethod
     def read_json(path: str) -> List[Dict]:
-        IGNORE_KEYS = ['words']
-        with open(path, 'r') as f:
-            content = json.load(f)
+        return list(DataLoader.iter_pages(path))
+
+    @staticmethod
+    def iter_pages(path: str) -> Iterator[Dict]:
+        """
+        Stream pages (top-level array items) of a JSON file one by one. Values of `IGNORE_KEYS` (too verbose) are
+        skipped by the scanner without being decoded, and the file is memory-mapped rather than read into memory.
+        :param path: JSON file
+        :return: generator of page dicts
+        """
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                pos = _skip_ws(buf, 0)
+                if buf[pos] == ord('{'):  # single page not wrapped in a list
+                    yield _parse_page(buf, pos)[0]
+                    return
+                if buf[pos] != ord('['):
+                    raise ValueError(f"Expected JSON array or object at the top level of {path}")
+                pos = _skip_ws(buf, pos + 1)
+                if buf[pos] == ord(']'):
+                    return
+                while True:
+                    if buf[pos] == ord('{'):
+                        page, pos = _parse_page(buf, pos)
+                        yield page
+                    else:  # not a page, keep the structure of the original content
+                        end = _skip_value(buf, pos)
+                        yield _loads(buf[pos:end])
+                        pos = end
+                    pos = _skip_ws(buf, pos)
+                    if buf[pos] == ord(']'):
+                        return
+                    if buf[pos] != ord(','):
+                        raise ValueError(f"Malformed JSON in {path} at byte {pos}")
+                    pos = _skip_ws(buf, pos + 1)
 
-        # drop irrelevant (too verbose) keys
-        content2 = list()
-        for x in content:
-            for k in IGNORE_KEYS:
-                if k in x:
-                    x.pop(k)
-            content2.append(x)
+    def build_file_payload(self, file: dict) -> dict:
+        """
+        Read a JSON file and normalise its pages into a payload ready to be written to Neo4j.
+        :param file: file record as returned by `crawl_and_identify`
+        :return: dict with file `id`, `name`, `directory_id` and list of `pages` (`id` & `others` properties)
+        """
+        payload, info = build_payload(file)
+        self._record(file, info)
+        return payload
 
-        return content2
+    def iter_payloads(self, files: Iterable[Dict], workers: int = None, signatures: bool = False,
+                      prefetch: int = None) -> Iterator[tuple]:
+        """
+        Parse files into payloads (see `build_file_payload`) in a pool of `workers` processes, so that the CPU-bound
+        JSON decoding & normalisation runs on all cores and overlaps with whatever consumes the payloads (Neo4j
+        writes). At most `prefetch` files are in flight and payloads come in the order of `files`. Files failing to
+        parse are logged, counted (`files_failed_total`) and skipped.
+        :param files: file records (as from `iter_files`), consumed lazily
+        :param workers: number of processes, one per CPU core if None (in this process on a single core); 0 parses
+        in this process
+        :param signatures: add MinHash signature of the file text (`minhash`, see `MinHasher`) to each payload
+        :param prefetch: max files in flight, 4 per worker if None
+        :return: generator of (file record, payload)
+        """
+        if workers is None:
+            workers = os.cpu_count() or 1
+            workers = workers if workers > 1 else 0  # no parallelism to gain, only pickling to pay
+        if workers < 1:
+            for file in files:
+                payload, info = parse_file(file, signatures)
+                if self._record(file, info):
+                    yield file, payload
+            return
+
+        prefetch = prefetch if prefetch is not None else 4 * workers
+        self.log.info(f"Parsing files in {workers} processes (JSON backend: {JSON_BACKEND}).")
+        # spawned (not forked) workers don't inherit the parent's threads & locks (Neo4j driver, logging)
+        pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+        pending = deque()
+        try:
+            for file in files:
+                pending.append((file, pool.submit(parse_file, file, signatures)))
+                if len(pending) >= prefetch:
+                    file, future = pending.popleft()
+                    payload, info = future.result()
+                    if self._record(file, info):
+                        yield file, payload
+            while pending:
+                file, future = pending.popleft()
+                payload, info = future.result()
+                if self._record(file, info):
+                    yield file, payload
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def _record(self, file: dict, info: dict) -> bool:
+        """Log & record metrics of a parsed file. :return: whether parsing succeeded"""
+        for warning in info['warnings']:
+            self.log.warning(f"{warning}: {file['path']}")
+        if info.get('error') is not None:
+            self.log.error(f"Failed to parse file {file['path']}: {info['error']}")
+            self.metrics.inc('files_failed_total')
+            return False
+        self.metrics.observe('file_parse_seconds', info['seconds'])
+        self.metrics.inc('files_parsed_total')
+        self.metrics.inc('pages_parsed_total', info['pages'])
+        self.metrics.inc('bytes_parsed_total', info['bytes'])
+        return True
+
+    def iter_files(self) -> Iterator[Dict]:
+        """
+        Walk the directory structure lazily and yield all JSON files with their full path.
+        :return: generator of file records (`name`, `path`, `directory`)
+        """
+        for root, dirs, files in os.walk(self.data_dir):
+            for f in files:
+                if f.endswith(".json"):
+                    path = os.path.join(root, f)
+                    yield {
+                        'name': path.split("/")[-1],
+                        'path': path,
+                        'directory': "/".join(path.split("/")[:-1])
+                    }
+
+    def iter_directory_pairs(self) -> Iterator[Dict]:
+        """
+        Walk the directory structure lazily and yield each parent-child pair of directories on the path to any
+        JSON file exactly once.
+        :return: generator of dicts with `source` (parent) and `target` (child) directory
+        """
+        seen = set()
+        for root, dirs, files in os.walk(self.data_dir):
+            if not any(f.endswith(".json") for f in files):
+                continue
+            # same directory id as `iter_files` gives to the files in `root`
+            sp = "/".join(os.path.join(root, "x").split("/")[:-1]).split("/")
+            while len(sp) > 1:
+                target = "/".join(sp)
+                if target in seen:  # so are all its ancestors
+                    break
+                seen.add(target)
+                yield {'source': "/".join(sp[:-1]), 'target': target}
+                sp = sp[:-1]
 
     def crawl_and_identify(self) -> dict:
         """
         Crawl directory structure and identify all relevant JSON files, return then with their full path.
-        :param path: root directory location
+        Materialises `iter_files` and `iter_directory_pairs`, prefer these for large corpora.
         :return: list of JSON files with metadata
         """
         self.log.debug("Crawling directory structure.")
-        jsons, dirs = list(), list()
+        return {'files': list(self.iter_files()), 'directory_pairs': list(self.iter_directory_pairs())}
+
+
+_WS = re.compile(rb'[ \t\n\r]*')
+_STRUCT = re.compile(rb'["\[\]{}]')
+_STRING_END = re.compile(rb'["\\]')
+_SCALAR = re.compile(rb'[^,\]}\s]*')
+
+
+def build_payload(file: dict) -> tuple:
+    """
+    Parse a JSON file and normalise its pages (see `DataLoader.build_file_payload`).
+    :return: payload, and info - parse `seconds`, `pages`, `bytes` & `warnings`
+    """
+    payload = {'id': file['path'],
+               'name': file['name'],
+               'directory_id': file['directory'],
+               'pages': list()
+               }
+    warnings = list()
+    t_start = time.perf_counter()
+    pages = DataLoader.iter_pages(file['path'])  # typically, files are sub-structured into pages
+    for page in pages:
+        if 'text' not in page:
+            warnings.append("A page in given file missing `text` field")
+            page['text'] = ""
+        else:
+            page['text'] = page['text'].strip()
+        if 'pageNumber' not in page:
+            warnings.append("A page in given file missing `pageNumber` field")
+            continue
+        if 'id' in page:
+            page['id_page'] = page['id']
+            del page['id']
+        for key, val in page.items():
+            if isinstance(val, dict):
+                page[key] = str(val)
+        payload['pages'].append({'id': f"{file['path']}__{page['pageNumber']}",
+                                 'others': page
+                                 })
+    return payload, {'seconds': time.perf_counter() - t_start, 'pages': len(payload['pages']),
+                     'bytes': os.path.getsize(file['path']), 'warnings': warnings}
+
+
+def parse_file(file: dict, signatures: bool = False) -> tuple:
+    """
+    Task of the parsing processes: `build_payload` plus the file's MinHash signature; errors are returned (in
+    info's `error`) rather than raised, so that one bad file doesn't stop the others.
+    :return: payload (None on error) and info
+    """
+    try:
+        payload, info = build_payload(file)
+        if signatures:
+            payload['minhash'] = MinHasher().signature("\n".join(p['others'].get('text', "")
+                                                                  for p in payload['pages']))
+        return payload, info
+    except Exception as e:
+        return None, {'warnings': list(), 'error': f"{type(e).__name__}: {e}"}
+
+
+def _skip_ws(buf, pos: int) -> int:
+    return _WS.match(buf, pos).end()
+
+
+def _skip_string(buf, pos: int) -> int:
+    """:return: position right after the string starting (with `"`) at `pos`"""
+    pos += 1
+    while True:
+        m = _STRING_END.search(buf, pos)
+        if m is None:
+            raise ValueError("Unterminated JSON string")
+        if buf[m.start()] == ord('"'):
+            return m.start() + 1
+        pos = m.start() + 2  # escaped character
+
+
+def _skip_value(buf, pos: int) -> int:
+    """:return: position right after the JSON value starting at `pos`, without decoding it"""
+    c = buf[pos]
+    if c == ord('"'):
+        return _skip_string(buf, pos)
+    if c != ord('[') and c != ord('{'):
+        return _SCALAR.match(buf, pos).end()
+    depth = 0
+    while True:
+        m = _STRUCT.search(buf, pos)
+        if m is None:
+            raise ValueError("Unterminated JSON array or object")
+        c = buf[m.start()]
+        if c == ord('"'):
+            pos = _skip_string(buf, m.start())
+            continue
+        depth += 1 if c == ord('[') or c == ord('{') else -1
+        pos = m.start() + 1
+        if depth == 0:
+            return pos
 
-        for root, dirs, files in os.walk(self.data_dir):
-            #self.log.info(f"{root} - {dirs} - {files}")
-            jsons += [os.path.join(root, f) for f in files if f.endswith(".json")]
-
-        jsons = [{
-            'name': x.split("/")[-1],
-            'path': x,
-            'directory': "/".join(x.split("/")[:-1])
-        } for x in jsons]
-
-        dirs = set()
-        for f in jsons:
-            sp = f['directory'].split("/")
-            while len(sp) > 1:
-                dirs.add("/".join(sp[:-1]) + "-->" + "/".join(sp))
-                sp = sp[:-1]
-        dirs = [{'source': x.split("-->")[0], 'target': x.split("-->")[1]} for x in dirs]
 
-        return {'files': jsons, 'directory_pairs': dirs}
\ No newline at end of file
+def _parse_page(buf, pos: int, ignore_keys: tuple = IGNORE_KEYS) -> tuple:
+    """Decode the JSON object starting at `pos` except for values of ignored keys. :return: (dict, end position)"""
+    page = dict()
+    pos = _skip_ws(buf, pos + 1)
+    if buf[pos] == ord('}'):
+        return page, pos + 1
+    while True:
+        end = _skip_string(buf, pos)
+        key = _loads(buf[pos:end])
+        pos = _skip_ws(buf, end)
+        if buf[pos] != ord(':'):
+            raise ValueError(f"Malformed JSON object at byte {pos}")
+        pos = _skip_ws(buf, pos + 1)
+        end = _skip_value(buf, pos)
+        if key not in ignore_keys:
+            page[key] = _loads(buf[pos:end])
+        pos = _skip_ws(buf, end)
+        if buf[pos] == ord('}'):
+            return page, pos + 1
+        if buf[pos] != ord(','):
+            raise ValueError(f"Malformed JSON object at byte {pos}")
+        pos = _skip_ws(buf, pos + 1)
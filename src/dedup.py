@@ -0,0 +1,110 @@
+import re
+import hashlib
+from array import array
+from typing import Iterable, List, Tuple, Dict
+from src.utils import LoggingHandler
+
+_WORDS = re.compile(r"\w+")
+
+
+class MinHasher:
+    """
+    MinHash signatures of texts (sets of word `shingle_size`-grams) computed with one-permutation hashing: every
+    shingle is hashed once and the hash space is split into `num_perm` bins, each keeping its minimum (empty bins
+    are filled from the next non-empty one). The share of equal bins of two signatures estimates the Jaccard
+    similarity of their texts. Values fit into Neo4j integers.
+    """
+    def __init__(self, num_perm: int = 128, shingle_size: int = 5):
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+
+    def shingles(self, text: str) -> set:
+        words = _WORDS.findall(text.lower())
+        if len(words) < self.shingle_size:
+            return {" ".join(words)} if words else set()
+        return {" ".join(words[i:i + self.shingle_size]) for i in range(len(words) - self.shingle_size + 1)}
+
+    def signature(self, text: str) -> List[int]:
+        """:return: signature of `num_perm` integers, empty list for a text without words"""
+        bins = [None] * self.num_perm
+        for shingle in self.shingles(text):
+            h = int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), 'big') >> 1
+            b, value = h % self.num_perm, h // self.num_perm
+            if bins[b] is None or value < bins[b]:
+                bins[b] = value
+        if all(v is None for v in bins):
+            return list()
+        for i in range(self.num_perm):
+            j = i
+            while bins[j % self.num_perm] is None:
+                j += 1
+            if j != i:
+                bins[i] = bins[j % self.num_perm]
+        return bins
+
+    @staticmethod
+    def similarity(sig1, sig2) -> float:
+        if not sig1 or len(sig1) != len(sig2):
+            return 0.
+        return sum(a == b for a, b in zip(sig1, sig2)) / len(sig1)
+
+
+class DuplicateFinder(LoggingHandler):
+    """
+    Groups near-duplicate documents by their MinHash signatures with locality-sensitive hashing: signatures are split
+    into `bands`, documents sharing a band are candidates, candidates are verified by their estimated similarity and
+    matching pairs are merged into groups (union-find). Every band bucket keeps at most `max_bucket` documents, so
+    the number of comparisons grows linearly with the number of documents.
+    With 128 values in 16 bands, pairs with similarity 0.85 become candidates with probability ~0.99, pairs with 0.5
+    with ~0.06.
+    """
+    def __init__(self, threshold: float = 0.85, bands: int = 16, max_bucket: int = 8):
+        super().__init__(self)
+        self.threshold = threshold
+        self.bands = bands
+        self.max_bucket = max_bucket
+        self.signatures = dict()  # of the last `group` call
+
+    def group(self, signatures: Iterable[Tuple[str, List[int]]]) -> Tuple[List[List[str]], dict]:
+        """
+        :param signatures: (key, signature) pairs, consumed lazily
+        :return: groups of keys of near-duplicates (2+ documents each, in order of appearance) and stats
+        """
+        parent, order = dict(), dict()
+        self.signatures = sigs = dict()
+        buckets: Dict[tuple, List[str]] = dict()
+        stats = {'documents': 0, 'comparisons': 0}
+
+        def find(x):
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+
+        for key, sig in signatures:
+            if not sig:
+                continue
+            stats['documents'] += 1
+            parent[key], order[key] = key, len(order)
+            sigs[key] = array('q', sig)
+            rows = len(sig) // self.bands
+            for band in range(self.bands):
+                bucket = buckets.setdefault((band, hash(tuple(sig[band * rows:(band + 1) * rows]))), list())
+                for other in bucket:
+                    if find(other) == find(key):
+                        continue
+                    stats['comparisons'] += 1
+                    if MinHasher.similarity(sigs[other], sigs[key]) >= self.threshold:
+                        parent[find(key)] = find(other)
+                if len(bucket) < self.max_bucket:
+                    bucket.append(key)
+
+        groups = dict()
+        for key in order:
+            groups.setdefault(find(key), list()).append(key)
+        groups = [g for g in groups.values() if len(g) > 1]
+        stats['groups'] = len(groups)
+        stats['duplicates'] = sum(len(g) - 1 for g in groups)
+        self.log.info(f"{stats['duplicates']} near-duplicates in {stats['groups']} groups among {stats['documents']} "
+                      f"documents ({stats['comparisons']} comparisons).")
+        return groups, stats
@@ -0,0 +1,115 @@
+import re
+import math
+from typing import Iterable, Tuple
+from src.utils import LoggingHandler
+
+SKIP, CHEAP, EXTRACT = "skip", "cheap", "extract"
+
+_WORDS = re.compile(r"[A-Za-z][A-Za-z'\-]*")
+_NUMBERS = re.compile(r"\d+(?:[.,/:\-]\d+)*")
+_GARBAGE = re.compile(r"[^\sA-Za-z0-9.,;:'\"()\[\]\-/&%$#@!?*+=<>§°_]")
+_NO_VOWELS = re.compile(r"\b[b-df-hj-np-tv-xz]+\b")
+
+# function words: running English prose has 30-50% of them, OCR noise & forms hardly any
+COMMON_WORDS = frozenset("""
+a about above after again against all also am an and any are as at be because been before being below between both
+but by can could did do does doing down during each few for from further had has have having he her here hers him
+his how i if in into is it its itself just may me might more most must my no nor not now of off on once only or
+other our ours out over own same shall she should so some such than that the their theirs them then there these
+they this those through to too under until up upon very was we were what when where whether which while who whom
+why will with within without would you your
+""".split())
+
+# terms of the corpus domain (PFAS litigation), lower case, `*` marks a prefix
+DOMAIN_KEYWORDS = """
+pfoa pfos pfas pfoa's c8 fluoro* perfluoro* fluorinated toxic* exposure* serum blood liver cancer* tumor* tumour*
+health contaminat* concentration concentrations ppm ppb groundwater water well wells landfill* disposal waste*
+emission* discharge* sample samples study studies result results rat rats monkey monkeys epa regulat* plaintiff*
+defendant* court settlement agreement employee* plant manufactur*
+""".split()
+
+# markers of cover sheets, fax transmittals, signature pages & exhibit stubs
+BOILERPLATE = [r"fax", r"facsimile", r"transmittal", r"cover\s+(?:sheet|page)", r"number\s+of\s+pages",
+               r"including\s+(?:this\s+)?cover", r"signature", r"signed", r"notary", r"exhibit\s+\w+",
+               r"intentionally\s+left\s+blank", r"please\s+(?:call|notify)", r"if\s+you\s+(?:do\s+not|did\s+not)\s+receive"]
+
+
+class DocumentFilter(LoggingHandler):
+    """
+    Local relevance score of a document, computed before any LLM call (under a millisecond per document, on at
+    most `max_chars` of its text): character-class ratios (letters vs. OCR garbage), the rate of common English words,
+    the density of domain keywords and of entity-like tokens (capitalised words, acronyms, numbers), discounted for
+    very short texts and for cover sheet / fax / signature page markers.
+    Documents scoring below `skip_below` are not extracted, the ones below `cheap_below` go to `cheap_model`.
+    """
+    def __init__(self, skip_below: float = 0.2, cheap_below: float = None, cheap_model: str = None,
+                 keywords: Iterable[str] = None, max_chars: int = 3000):
+        """
+        :param skip_below: score under which a document is skipped
+        :param cheap_below: score under which a document is extracted with `cheap_model` (disabled if None)
+        :param cheap_model: model for low-scoring documents
+        :param keywords: domain keywords (lower case, `*` marks a prefix), `DOMAIN_KEYWORDS` if None
+        :param max_chars: characters scored - beginning, middle & end of longer texts
+        """
+        super().__init__(self)
+        if (cheap_below is None) != (cheap_model is None):
+            raise ValueError("`cheap_below` and `cheap_model` go together.")
+        self.skip_below = skip_below
+        self.cheap_below = cheap_below
+        self.cheap_model = cheap_model
+        self.max_chars = max_chars
+        keywords = list(keywords) if keywords is not None else DOMAIN_KEYWORDS
+        self.keywords = frozenset(k for k in keywords if not k.endswith("*"))
+        self.keyword_prefixes = tuple(k[:-1] for k in keywords if k.endswith("*"))
+        self.boilerplate = re.compile(r"\b(?:" + "|".join(BOILERPLATE) + r")\b")
+
+    def sample(self, text: str) -> str:
+        if len(text) <= self.max_chars:
+            return text
+        n = self.max_chars // 3
+        middle = (len(text) - n) // 2
+        return "\n".join([text[:n], text[middle:middle + n], text[-n:]])
+
+    def features(self, text: str) -> dict:
+        text = self.sample(text)
+        n_chars = len(text) - text.count(" ") - text.count("\n")
+        words = _WORDS.findall(text)
+        n_words = len(words)
+        if n_chars == 0 or n_words == 0:
+            return {'chars': n_chars, 'words': n_words}
+        n_letters = sum(map(len, words))
+        lower_text = text.lower()
+        lower = _WORDS.findall(lower_text)
+        return {'chars': n_chars, 'words': n_words,
+                'letters': n_letters / n_chars,
+                'garbage': len(_GARBAGE.findall(text)) / n_chars,
+                'wordlike': 1. - len(_NO_VOWELS.findall(lower_text)) / n_words,
+                'common': sum(1 for w in lower if w in COMMON_WORDS) / n_words,
+                'keywords': sum(1 for w in lower if w in self.keywords or w.startswith(self.keyword_prefixes)) / n_words,
+                # capitalised words & acronyms, numbers (dates, amounts, measurements)
+                'entities': (sum(1 for w in words if w[0].isupper()) + len(_NUMBERS.findall(text))) / n_words,
+                # cover sheet markers are at the top
+                'boilerplate': len(self.boilerplate.findall(lower_text, 0, 1000))}
+
+    def score(self, text: str) -> Tuple[float, dict]:
+        """:return: score in [0, 1] and the features it is made of"""
+        f = self.features(text or "")
+        if 'letters' not in f:
+            return 0., f
+        quality = min(1., f['letters'] / 0.75) * max(0., 1. - 4 * f['garbage']) * f['wordlike']
+        content = (0.45 * min(1., f['common'] / 0.3) + 0.3 * min(1., f['keywords'] / 0.02) +
+                   0.25 * min(1., f['entities'] / 0.1))
+        length = min(1., math.log1p(f['words']) / math.log1p(300))
+        penalty = 0.15 * min(f['boilerplate'], 3) * (1. if f['words'] < 300 else 0.2)
+        return max(0., min(1., quality * content * length - penalty)), f
+
+    def decide(self, text: str) -> dict:
+        """:return: `decision` (`skip`, `cheap` or `extract`), `score` and `model` (cheap model, None otherwise)"""
+        score, _ = self.score(text)
+        if score < self.skip_below:
+            decision = SKIP
+        elif self.cheap_below is not None and score < self.cheap_below:
+            decision = CHEAP
+        else:
+            decision = EXTRACT
+        return {'decision': decision, 'score': round(score, 4), 'model': self.cheap_model if decision == CHEAP else None}
@@ -0,0 +1,181 @@
+import re
+from difflib import SequenceMatcher
+from typing import Iterable, Dict, Tuple, List
+from src.utils import LoggingHandler
+
+_PARENTHESES = re.compile(r"\([^)]*\)|\[[^\]]*\]")
+_NON_WORD = re.compile(r"[^\w\s]")
+# tokens ignored when comparing names
+STOP_TOKENS = {'the', 'of', 'and', 'inc', 'incorporated', 'ltd', 'limited', 'llc', 'llp', 'lp', 'plc', 'co', 'corp',
+               'corporation', 'company', 'companies', 'gmbh', 'sa', 'ag', 'nv', 'bv'}
+# similarity of a name to its acronym ("EPA" ~ "Environmental Protection Agency") and to a longer form starting
+# with it ("DuPont" ~ "E.I. du Pont de Nemours")
+ACRONYM_SIMILARITY = 0.9
+PREFIX_SIMILARITY = 0.9
+_SOUNDEX = {c: str(d) for d, letters in enumerate(["aeiouyhw", "bfpv", "cgjkqsxz", "dt", "l", "mn", "r"])
+            for c in letters}
+
+
+def normalize_name(name: str) -> List[str]:
+    """Lowercase tokens of a name without parenthesised parts, punctuation, initials & legal-form suffixes."""
+    name = _NON_WORD.sub(" ", _PARENTHESES.sub(" ", str(name).lower()))
+    return [t for t in name.split() if (len(t) > 1 or t.isdigit()) and t not in STOP_TOKENS]
+
+
+def soundex(token: str) -> str:
+    codes = [_SOUNDEX.get(c, "") for c in token if c.isalpha()]
+    if not codes:
+        return token
+    out, last = [token[0]], codes[0]
+    for code in codes[1:]:
+        if code not in ("", "0") and code != last:
+            out.append(code)
+        if code != "":
+            last = code
+    return "".join(out)[:4].ljust(4, "0")
+
+
+class _Record:
+    __slots__ = ('name', 'wikipedia_id', 'count', 'tokens', 'key', 'prefixes', 'acronym')
+
+    def __init__(self, name: str, wikipedia_id: str, count: int):
+        self.name, self.wikipedia_id, self.count = name, wikipedia_id, count
+        tokens = normalize_name(name)
+        # "du pont" ~ "dupont": adjacent tokens also joined
+        self.tokens = set(tokens) | {a + b for a, b in zip(tokens, tokens[1:])}
+        self.key = "".join(tokens) or str(name).lower().strip()
+        # leading tokens, joined: "du pont de nemours" -> "du", "dupont", "dupontde"
+        self.prefixes = {"".join(tokens[:k]) for k in range(1, len(tokens))}
+        self.acronym = "".join(t[0] for t in tokens) if len(tokens) > 1 else None
+
+
+class EntityResolver(LoggingHandler):
+    """
+    Clusters names of entities (of one label) referring to the same real-world entity.
+    Names are only compared within blocks - names sharing a token, a phonetic (Soundex) token code, the normalised
+    name or `wikipedia_id` - and blocks larger than `max_block_size` (too common tokens) are skipped, so the
+    number of comparisons stays far below all pairs. Within a block, names with the same `wikipedia_id` match,
+    names with different ones never do, others match when the string similarity of their normalised forms reaches
+    `threshold` (an acronym and a leading part of a longer name, at least `min_prefix_length` characters, match as
+    well); names with different numbers never match. Matches are merged best first, a merge of two clusters only
+    when each name of the matching pair also matches the other cluster's canonical name (or the pair shares a
+    `wikipedia_id`) and the clusters' `wikipedia_id`s don't differ - so a chain of similar names doesn't merge
+    dissimilar ones.
+    """
+    def __init__(self, threshold: float = 0.85, max_block_size: int = 200, min_token_length: int = 3,
+                 min_prefix_length: int = 5):
+        super().__init__(self)
+        self.threshold = threshold
+        self.max_block_size = max_block_size
+        self.min_token_length = min_token_length
+        self.min_prefix_length = min_prefix_length
+
+    def blocking_keys(self, record: _Record) -> set:
+        keys = {"k:" + record.key}
+        if record.wikipedia_id:
+            keys.add("w:" + str(record.wikipedia_id))
+        if record.acronym is not None:
+            keys.add("a:" + record.acronym)
+        elif record.key.isalpha() and len(record.key) <= 6:  # may be an acronym
+            keys.add("a:" + record.key)
+        for token in record.tokens:
+            if len(token) >= self.min_token_length and not token.isdigit():
+                keys.add("t:" + token)
+                keys.add("p:" + soundex(token))
+        return keys
+
+    def similarity(self, a: _Record, b: _Record) -> float:
+        if a.wikipedia_id and b.wikipedia_id:
+            return 1. if a.wikipedia_id == b.wikipedia_id else 0.
+        if set(t for t in a.tokens if t.isdigit()) != set(t for t in b.tokens if t.isdigit()):
+            return 0.  # e.g. "Unit 1" & "Unit 2"
+        if a.key == b.key:
+            return 1.
+        if a.key == b.acronym or b.key == a.acronym:
+            return ACRONYM_SIMILARITY
+        short, long = (a, b) if len(a.key) < len(b.key) else (b, a)
+        if len(short.key) >= self.min_prefix_length and short.key in long.prefixes:
+            return PREFIX_SIMILARITY
+        jaccard = len(a.tokens & b.tokens) / max(len(a.tokens | b.tokens), 1)
+        return max(jaccard, SequenceMatcher(None, a.key, b.key).ratio())
+
+    def resolve(self, names: Iterable[Tuple[str, str, int]]) -> Tuple[Dict[Tuple[str, str], str], dict]:
+        """
+        :param names: distinct (name, wikipedia_id, number of entities) of one label
+        :return: canonical name of every (name, wikipedia_id) in a cluster of 2+ names - the most frequent name of
+        the cluster - and stats: names, blocks, skipped (oversized) blocks, max & mean block size, comparisons,
+        clusters, merged names, merges rejected as incoherent with a cluster
+        """
+        records = [_Record(*x) for x in names if x[0] is not None and str(x[0]).strip()]
+        blocks: Dict[str, List[int]] = dict()
+        for i, record in enumerate(records):
+            for key in self.blocking_keys(record):
+                blocks.setdefault(key, list()).append(i)
+
+        sizes = [len(b) for b in blocks.values() if len(b) > 1]
+        stats = {'names': len(records), 'blocks': len(sizes), 'skipped_blocks': 0,
+                 'max_block_size': max(sizes, default=0),
+                 'mean_block_size': round(sum(sizes) / len(sizes), 2) if sizes else 0., 'comparisons': 0,
+                 'rejected_merges': 0}
+        compared, matches = set(), list()
+        for key, members in blocks.items():
+            if len(members) < 2:
+                continue
+            if len(members) > self.max_block_size and not key.startswith(("w:", "k:")):
+                stats['skipped_blocks'] += 1
+                continue
+            for x, i in enumerate(members):
+                for j in members[x + 1:]:
+                    if (i, j) in compared:
+                        continue
+                    compared.add((i, j))
+                    score = self.similarity(records[i], records[j])
+                    if score >= self.threshold:
+                        matches.append((score, i, j))
+        stats['comparisons'] = len(compared)
+
+        # clusters: union-find, each root with its canonical record & wikipedia id
+        parent = list(range(len(records)))
+        canonical = list(range(len(records)))
+        wikipedia_ids = [r.wikipedia_id for r in records]
+
+        def find(x):
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+
+        def rank(i):
+            return records[i].count, -len(records[i].name), records[i].name
+
+        for score, i, j in sorted(matches, key=lambda m: -m[0]):
+            root_i, root_j = find(i), find(j)
+            if root_i == root_j:
+                continue
+            wiki_i, wiki_j = wikipedia_ids[root_i], wikipedia_ids[root_j]
+            if wiki_i and wiki_j and wiki_i != wiki_j:
+                stats['rejected_merges'] += 1
+                continue
+            a, b = records[i], records[j]
+            same_wiki = a.wikipedia_id and a.wikipedia_id == b.wikipedia_id
+            if not same_wiki and (self.similarity(a, records[canonical[root_j]]) < self.threshold or
+                                  self.similarity(b, records[canonical[root_i]]) < self.threshold):
+                stats['rejected_merges'] += 1
+                continue
+            parent[root_i] = root_j
+            canonical[root_j] = max(canonical[root_i], canonical[root_j], key=rank)
+            wikipedia_ids[root_j] = wiki_j or wiki_i
+
+        clusters: Dict[int, List[_Record]] = dict()
+        for i, record in enumerate(records):
+            clusters.setdefault(find(i), list()).append(record)
+        resolved = dict()
+        for members in clusters.values():
+            if len(members) < 2:
+                continue
+            name = max(members, key=lambda r: (r.count, -len(r.name), r.name)).name
+            for r in members:
+                resolved[(r.name, r.wikipedia_id)] = name
+        stats['clusters'] = sum(len(m) > 1 for m in clusters.values())
+        stats['merged_names'] = len(resolved)
+        return resolved, stats
@@ -0,0 +1,105 @@
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Callable, Optional, List, Tuple
+from src.utils import LoggingHandler
+from src.metrics import in_context
+
+_DONE = object()
+
+
+class ExtractionEngine(LoggingHandler):
+    """
+    Runs the slow (LLM) step of many documents concurrently in a bounded thread pool, while a single separate writer
+    thread stores finished results, so that LLM latency and DB latency overlap. Results that are ready at the same
+    time are stored together (up to `write_batch_size` documents per call of `store`).
+    """
+    def __init__(self, concurrency: int = 4, queue_size: int = None, write_batch_size: int = 1):
+        super().__init__(self)
+        self.concurrency = max(1, concurrency)
+        self.write_batch_size = max(1, write_batch_size)
+        # results waiting for the writer; a full queue makes extraction wait for the DB
+        self.queue_size = queue_size if queue_size is not None else 2 * self.concurrency
+        self.lock = threading.Lock()
+
+    def run(self, docs: Iterable[dict], extract: Callable[[dict], Optional[dict]],
+            store: Callable[[List[Tuple[dict, dict]]], None]) -> dict:
+        """
+        Process all documents.
+        :param docs: iterable of documents, consumed lazily (only a bounded number of them is in flight)
+        :param extract: LLM step, `extract(doc) -> result`; returning None skips the document
+        :param store: DB step, `store([(doc, result), ...])`, always called from the one writer thread; a failing
+        batch is re-tried document by document
+        :return: counts of documents, skipped, extracted, stored & failed, and total time; an error reading `docs`
+        is raised once the results extracted before it are stored
+        """
+        stats = {'documents': 0, 'skipped': 0, 'extracted': 0, 'stored': 0, 'failed': 0}
+        results = queue.Queue(maxsize=self.queue_size)
+        # worker threads record their metrics in the caller's stage
+        writer = threading.Thread(target=in_context(self._write_loop), args=(results, store, stats), daemon=True)
+        writer.start()
+
+        t_start = time.time()
+        in_flight = threading.BoundedSemaphore(2 * self.concurrency)
+        extract_doc = in_context(self._extract)
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="llm") as pool:
+                for doc in docs:
+                    in_flight.acquire()
+                    stats['documents'] += 1
+                    future = pool.submit(extract_doc, extract, doc, results, stats)
+                    future.add_done_callback(lambda _: in_flight.release())
+        finally:
+            # also when reading the documents fails: results extracted so far are stored before it is raised
+            results.put(_DONE)
+            writer.join()
+
+        stats['seconds'] = time.time() - t_start
+        self.log.info(f"Processed {stats['documents']} documents in {round(stats['seconds'], 1)} sec "
+                      f"({round(stats['documents'] / max(stats['seconds'], 1e-6), 2)} docs/s): "
+                      f"{stats['stored']} stored, {stats['skipped']} skipped, {stats['failed']} failed.")
+        return stats
+
+    def _count(self, stats: dict, key: str):
+        with self.lock:
+            stats[key] += 1
+
+    def _extract(self, extract: Callable, doc: dict, results: queue.Queue, stats: dict):
+        try:
+            result = extract(doc)
+        except Exception as e:
+            self.log.error(f"Extraction failed for document {doc.get('element_id')}: {e}")
+            self._count(stats, 'failed')
+            return
+        if result is None:
+            self._count(stats, 'skipped')
+            return
+        self._count(stats, 'extracted')
+        results.put((doc, result))
+
+    def _write_loop(self, results: queue.Queue, store: Callable, stats: dict):
+        done = False
+        while not done:
+            batch = [results.get()]
+            while len(batch) < self.write_batch_size and not results.empty():
+                batch.append(results.get())
+            if batch[-1] is _DONE:
+                done = True
+                batch = batch[:-1]
+            if batch:
+                self._store(store, batch, stats)
+
+    def _store(self, store: Callable, batch: list, stats: dict):
+        try:
+            store(batch)
+            with self.lock:
+                stats['stored'] += len(batch)
+        except Exception as e:
+            if len(batch) > 1:
+                self.log.warning(f"Failure when storing a batch of {len(batch)} documents, storing them one by one: {e}")
+                for item in batch:
+                    self._store(store, [item], stats)
+                return
+            self.log.error(f"Failure when storing results of document {batch[0][0].get('element_id')}: {e}")
+            self._count(stats, 'failed')
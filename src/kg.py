@@ -2,20 +2,96 @@ import json
 import csv
 import os
 import time
-from src.utils import LoggingHandler
+import threading
+from contextlib import nullcontext
+from src.utils import LoggingHandler, estimate_tokens
 from src.neo4jWriter import Neo4jWriter
+from src.bulkWriter import BulkWriter
 from src.dataLoader import DataLoader
+from src.manifest import FileManifest
 from src.openaiQuery import OpenAIQuery
+from src.llmOutput import JSON_MODE
+from src.rateLimiter import RateLimiter
+from src.responseCache import ResponseCache
+from src.extractionEngine import ExtractionEngine
+from src.batchExtraction import BatchExtractor
+from src.textCleaner import TextCleaner
+from src.dedup import MinHasher, DuplicateFinder
+from src.entityResolution import EntityResolver
+from src.metrics import Metrics, stage
+from src.workQueue import WorkQueue
+from src.migrations import Migrator
+from src.snapshot import SnapshotBuilder
+from src.contentStore import ContentStore
+from src.docFilter import DocumentFilter, SKIP, CHEAP, EXTRACT
 
 
 class KnowledgeGraph(LoggingHandler):
-    def __init__(self, neo4j_db: str, config_dir: str):
+    # token counts of a document before & after text cleaning (see `TextCleaner`)
+    QUERY_TEXT_STATS = """UNWIND $rows AS row
+        MATCH (n)
+        WHERE elementId(n) = row.element_id
+        SET n._tokens_raw = row.tokens_raw,
+            n._tokens_clean = row.tokens_clean,
+            n._boilerplate_lines = row.boilerplate_lines
+        """
+    QUERY_FILE_ELEMENT_IDS = """MATCH (f:File)
+        WHERE f.id IN $ids
+        RETURN elementId(f) AS element_id
+        """
+    QUERY_REMOVE_FILES = """UNWIND $rows AS row
+        MATCH (f:File {id: row.id})
+        CALL { WITH f MATCH (f)-[:CONTAINS_PAGE]->(p:Page) DETACH DELETE p }
+        CALL { WITH f MATCH (f)-[:MENTIONS_ENTITY]->(e:Entity) DETACH DELETE e }
+        CALL { WITH f MATCH (f)<-[:_FROM_DOC]-(ex:ExplainRelation) DETACH DELETE ex }
+        DETACH DELETE f
+        """
+    # decision of the local pre-filter (see `DocumentFilter`)
+    QUERY_FILTER_DECISIONS = """UNWIND $rows AS row
+        MATCH (n)
+        WHERE elementId(n) = row.element_id
+        SET n._filter_score = row.score,
+            n._filter_decision = row.decision,
+            n._filter_model = row.model
+        """
+    # partial output of a document whose chunks failed in part: it stays to be extracted again
+    QUERY_PARTIAL_OUTPUT = """MATCH (n)
+        WHERE elementId(n) = $element_id
+        REMOVE n:LLMProcessed
+        """
+    # LLM metadata blobs moved to the content store (see `ContentStore.externalize`)
+    QUERY_METADATA_REFS = """MATCH (n)
+        WHERE elementId(n) = $element_id
+        SET n += $props
+        """
+
+    def __init__(self, neo4j_db: str, config_dir: str, max_connection_pool_size: int = 50, neo: Neo4jWriter = None,
+                 metrics: Metrics = None, initialise: bool = True, bulk_load: bool = False,
+                 content_store: ContentStore = None):
+        """
+        :param neo4j_db: Neo4j database name
+        :param config_dir: directory with prompts, queries & KG schema
+        :param max_connection_pool_size: Neo4j driver connection pool size
+        :param neo: writer to use instead of creating one (e.g. an in-process stand-in for benchmarks)
+        :param metrics: registry shared by all pipeline components (see `export_metrics`), new one if None
+        :param initialise: bring the DB schema (constraints & indices) up to date; without it, nothing connects to
+        Neo4j until the first query (e.g. for generating Cypher only)
+        :param bulk_load: defer the full-text indices until `ingest_data` finishes, so that they are built once
+        rather than maintained row by row during the initial load
+        :param content_store: keep large page properties & LLM metadata in this blob store, nodes hold references
+        and previews only (see `ContentStore`); extraction reads texts through it
+        """
         super().__init__(self)
+        self.metrics = metrics if metrics is not None else Metrics()
         self.neo4j_db = neo4j_db
-        #self.neo = Neo4jWriter(neo4j_db)
+        self.max_connection_pool_size = max_connection_pool_size
+        self._neo = neo
         self.config_dir = config_dir
         self.queries = self.read_queries()
-        self.initialise_indices()
+        self.bulk_load = bulk_load
+        self.content_store = content_store
+        if initialise:
+            self.initialise_indices(defer=bulk_load)
 
         # read desired KG schema
         schema_path = os.path.join(self.config_dir, 'schema.txt')
@@ -24,45 +100,48 @@ class KnowledgeGraph(LoggingHandler):
         with open(schema_path, 'r') as f:
             reader = csv.reader(f)
             self.SCHEMA = list(reader)
+        # allowed (label, relation, label) triples, looked up by the projection query (see `create_kg.txt`)
+        self.schema_index = {"|".join(x.strip() for x in row): True for row in self.SCHEMA if len(row) == 3}
+
+    @property
+    def neo(self) -> Neo4jWriter:
+        """One long-lived Neo4j writer (driver & connection pool) shared by all operations, created on first use."""
+        if self._neo is None:
+            self._neo = Neo4jWriter(self.neo4j_db, self.max_connection_pool_size, self.metrics)
+        return self._neo
+
+    def close(self):
+        if self._neo is not None:
+            self._neo.close()
+            self._neo = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
-    #def close(self):
-    #    self.neo.close()
-
-    def initialise_indices(self):
-        QUERIES = [
-            {'query': "CREATE CONSTRAINT IF NOT EXISTS FOR (n:Directory) REQUIRE n.id IS NODE KEY", 'data': None},
-            {'query': "CREATE CONSTRAINT IF NOT EXISTS FOR (n:File) REQUIRE n.id IS NODE KEY", 'data': None},
-            {'query': "CREATE CONSTRAINT IF NOT EXISTS FOR (n:Page) REQUIRE n.id IS NODE KEY", 'data': None},
-
-            # node indices
-            {'query': "CREATE TEXT INDEX node_entity_name IF NOT EXISTS FOR (n:Entity) ON (n.name)", 'data': None},
-            {'query': "CREATE TEXT INDEX node_entity_label IF NOT EXISTS FOR (n:Entity) ON (n._label_llm)", 'data': None},
-            {'query': "CREATE TEXT INDEX per_name IF NOT EXISTS FOR (n:Person) ON (n.name)", 'data': None},
-            {'query': "CREATE TEXT INDEX org_name IF NOT EXISTS FOR (n:Organization) ON (n.name)", 'data': None},
-            {'query': "CREATE TEXT INDEX fac_name IF NOT EXISTS FOR (n:Facility) ON (n.name)", 'data': None},
-            {'query': "CREATE TEXT INDEX loc_name IF NOT EXISTS FOR (n:Location) ON (n.name)", 'data': None},
-            {'query': "CREATE TEXT INDEX substance_name IF NOT EXISTS FOR (n:Substance) ON (n.name)", 'data': None},
-            {'query': "CREATE TEXT INDEX health_name IF NOT EXISTS FOR (n:HealthFactor) ON (n.name)", 'data': None},
-            {'query': "CREATE TEXT INDEX product_name IF NOT EXISTS FOR (n:Product) ON (n.name)", 'data': None},
-            {'query': "CREATE TEXT INDEX event_name IF NOT EXISTS FOR (n:Event) ON (n.name)", 'data': None},
-
-            # fulltext indices
-            {'query': "CREATE FULLTEXT INDEX pageTexts IF NOT EXISTS FOR (n:Page) ON EACH [n.text]", 'data': None},
-            {'query': "CREATE FULLTEXT INDEX fileNames IF NOT EXISTS FOR (n:File) ON EACH [n.name]", 'data': None},
-            {'query': "CREATE FULLTEXT INDEX entityNames IF NOT EXISTS FOR (n:Entity) ON EACH [n.name]", 'data': None},
-            {'query': "CREATE FULLTEXT INDEX perNames IF NOT EXISTS FOR (n:Person) ON EACH [n.name]", 'data': None},
-            {'query': "CREATE FULLTEXT INDEX orgNames IF NOT EXISTS FOR (n:Organization) ON EACH [n.name]", 'data': None},
-            {'query': "CREATE FULLTEXT INDEX facNames IF NOT EXISTS FOR (n:Facility) ON EACH [n.name]", 'data': None},
-            {'query': "CREATE FULLTEXT INDEX locNames IF NOT EXISTS FOR (n:Location) ON EACH [n.name]", 'data': None},
-            {'query': "CREATE FULLTEXT INDEX substanceNames IF NOT EXISTS FOR (n:Substance) ON EACH [n.name]", 'data': None},
-            {'query': "CREATE FULLTEXT INDEX healthNames IF NOT EXISTS FOR (n:HealthFactor) ON EACH [n.name]", 'data': None},
-            {'query': "CREATE FULLTEXT INDEX productNames IF NOT EXISTS FOR (n:Product) ON EACH [n.name]", 'data': None}
-            #{'query': "", 'data': None}
-        ]
-        neo = Neo4jWriter(self.neo4j_db)
-        self.log.info(f"Creating {len(QUERIES)} Neo4j indices & constraints.")
-        neo.run_multi_queries(QUERIES)
-        neo.close()
+    def export_metrics(self, prometheus_path: str = None, json_path: str = None) -> dict:
+        """
+        Export metrics of this run: LLM latency, tokens & cost per model, retries, Neo4j write counters etc. per stage.
+        :param prometheus_path: Prometheus text file to write (e.g. for the node exporter's textfile collector)
+        :param json_path: JSON run summary to write
+        :return: run summary
+        """
+        if prometheus_path is not None:
+            self.metrics.write_prometheus(prometheus_path)
+        if json_path is not None:
+            self.metrics.write_json(json_path)
+        return self.metrics.summary()
+
+    def initialise_indices(self, defer: bool = False) -> list:
+        """
+        Create Neo4j constraints & indices by applying the schema migrations missing in the DB (see `migrations`),
+        no DDL is sent to an up-to-date DB.
+        :param defer: leave out the heavy (full-text) indices, e.g. before a bulk load
+        :return: versions of the applied migrations
+        """
+        return Migrator(self.neo).migrate(defer)
 
     def read_queries(self) -> dict:
         """
@@ -86,111 +165,587 @@ class KnowledgeGraph(LoggingHandler):
         self.log.debug(f"Reading KG creation query.")
         with open(os.path.join(dir, "create_kg.txt"), 'r') as f:
             queries['create_kg'] = f.read()
+        self.log.debug(f"Reading KG retraction query.")
+        with open(os.path.join(dir, "retract_kg.txt"), 'r') as f:
+            queries['retract_kg'] = f.read()
         return queries
 
-    def ingest_data(self, data_dir: str):
+    @stage("ingest")
+    def ingest_data(self, data_dir: str, batch_size: int = 200, max_batch_bytes: int = 8 * 1024 * 1024,
+                    manifest_path: str = None, signatures: bool = True, workers: int = None, writers: int = 1):
         """
         Crawl the specified directory with all its subdirectories and store this data structure & file contents
-        to Neo4j DB.
+        to Neo4j DB. Directory pairs and files are written in UNWIND batches, see `BulkWriter`. Files are parsed in
+        a process pool (see `DataLoader.iter_payloads`) while `writers` threads write the parsed ones.
+        With a manifest (see `FileManifest`), only new or modified files are written (modified ones lose their
+        previous extraction results so that they get re-extracted) and files deleted from disk are removed from
+        the graph together with their pages & meta-KG entities.
         :param data_dir:
+        :param batch_size: max number of rows (dir pairs or files) per write transaction
+        :param max_batch_bytes: max serialised payload size of one batch
+        :param manifest_path: SQLite file recording ingested files, full (re-)ingestion if None
+        :param signatures: store MinHash signatures of file texts (`_minhash`) for `find_duplicates`
+        :param workers: file parsing processes, one per CPU core if None, 0 parses in this process
+        :param writers: threads writing files to Neo4j concurrently
         :return:
         """
-        QUERY_DIRS = """MERGE (d1:Directory {id: $id1}) SET d1.name = $name1
-        MERGE (d2:Directory {id: $id2}) SET d2.name = $name2
+        QUERY_DIRS = """UNWIND $rows AS row
+        MERGE (d1:Directory {id: row.id1}) SET d1.name = row.name1
+        MERGE (d2:Directory {id: row.id2}) SET d2.name = row.name2
         MERGE (d1)-[:CONTAINS_DIR]->(d2)
         """
 
-        QUERY_FILES = """MATCH (d:Directory {id: $directory_id})
-        MERGE (f:File {id: $id}) 
-        SET f.name = $name
+        QUERY_FILES = """UNWIND $rows AS row
+        MATCH (d:Directory {id: row.directory_id})
+        MERGE (f:File {id: row.id}) 
+        SET f.name = row.name,
+            f._minhash = row.minhash,
+            f += coalesce(row.file_meta, {})
         MERGE (d)-[:CONTAINS_FILE]->(f)
         
-        WITH f
-        UNWIND $pages AS page
+        // modified file: drop pages that no longer exist and results of the previous extraction
+        WITH f, row
+        CALL {
+            WITH f, row
+            MATCH (f)-[:CONTAINS_PAGE]->(old:Page)
+            WHERE row.changed AND NOT old.id IN [page IN row.pages | page.id]
+            DETACH DELETE old
+        }
+        CALL {
+            WITH f, row
+            MATCH (f)-[:MENTIONS_ENTITY]->(e:Entity)
+            WHERE row.changed
+            DETACH DELETE e
+        }
+        FOREACH (_ IN CASE WHEN row.changed THEN [1] ELSE [] END |
+            REMOVE f:LLMProcessed:LLMError SET f._meta_kg_updated = timestamp())
+        
+        WITH f, row
+        UNWIND row.pages AS page
         
         MERGE (p:Page {id: page.id})
         SET p += page.others
         MERGE (f)-[:CONTAINS_PAGE]->(p)
         """
 
-        neo = Neo4jWriter(self.neo4j_db)
-        data = DataLoader.from_path(data_dir)
-
-        full_content = data.crawl_and_identify()
-
-        self.log.info(f"Storing directory structure ({len(full_content['directory_pairs'])} dir-subdir pairs) to Neo4j.")
-        for dirs in full_content['directory_pairs']:
-            payload = {'id1': dirs['source'], 'name1': dirs['source'].split("/")[-1],
-                       'id2': dirs['target'], 'name2': dirs['target'].split("/")[-1]
-                       }
-            neo.run_simple_query(QUERY_DIRS, payload)
-
-        self.log.info(f"Storing {len(full_content['files'])} files to Neo4j.")
-        wait_counter = 0
-        for file in full_content['files']:
-            wait_counter += 1
-            if wait_counter % 50 == 0:
-                self.log.info(f"Waiting 5 sec because of Neo4j Aura `Unable to retrieve routing information` error.")
-                wait_counter = 0
-                time.sleep(5)
-            payload = {'id': file['path'],
-                       'name': file['name'],
-                       'directory_id': file['directory'],
-                       'pages': list()
-                       }
-            pages = data.read_json(file['path']) # typically, files are sub-structured into pages
-            for page in pages:
-                if 'text' not in page:
-                    self.log.warning(f"A page in given file missing `text` field: {file['path']}")
-                    page['text'] = ""
-                else:
-                    page['text'] = page['text'].strip()
-                if 'pageNumber' not in page:
-                    self.log.error(f"A page in given file missing `pageNumber` field: {file['path']}")
+        data = DataLoader.from_path(data_dir, self.metrics)
+        writer = BulkWriter(self.neo, batch_size, max_batch_bytes)
+        manifest = FileManifest(manifest_path) if manifest_path is not None else None
+        counts = {'new': 0, 'changed': 0, 'unchanged': 0, 'removed': 0}
+        manifest_lock = threading.Lock()  # manifest is shared with the writer threads
+
+        self.log.info("Storing directory structure to Neo4j.")
+        dir_rows = ({'id1': dirs['source'], 'name1': dirs['source'].split("/")[-1],
+                     'id2': dirs['target'], 'name2': dirs['target'].split("/")[-1]
+                     } for dirs in data.iter_directory_pairs())
+        writer.write(QUERY_DIRS, dir_rows, "directories")
+
+        def files():
+            for file in data.iter_files():
+                if manifest is None:
+                    yield file
+                    continue
+                with manifest_lock:
+                    status, record = manifest.classify(file['path'])
+                counts[status] += 1
+                if status == 'unchanged':
                     continue
-                if 'id' in page:
-                    page['id_page'] = page['id']
-                    del page['id']
-                for key, val in page.items():
-                    if isinstance(val, dict):
-                        page[key] = str(val)
-                payload['pages'].append({'id': f"{file['path']}__{page['pageNumber']}",
-                                         'others': page
-                                         })
+                yield {**file, 'file_meta': record, 'changed': status == 'changed'}
+
+        def file_rows():
+            for file, row in data.iter_payloads(files(), workers, signatures):
+                if manifest is not None:
+                    row['file_meta'], row['changed'] = file['file_meta'], file['changed']
+                if self.content_store is not None:
+                    for page in row['pages']:
+                        page['others'] = self.content_store.externalize(page['others'])
+                yield row
+
+        def record_files(rows: list):
+            with manifest_lock:
+                for row in rows:
+                    manifest.update(row['id'], row['file_meta'])
+                manifest.commit()
+
+        self.log.info("Storing files to Neo4j.")
+        stats = writer.write_parallel(QUERY_FILES, file_rows(), "files", on_batch=record_files if manifest else None,
+                                      writers=writers)
+
+        if manifest is not None:
+            removed = list(manifest.removed())
+            counts['removed'] = len(removed)
+            if removed:
+                self.log.info(f"Removing {len(removed)} files deleted from disk from Neo4j.")
+                self.remove_files(removed, batch_size, on_batch=manifest.delete)
+            manifest.close()
+            self.log.info(f"Incremental ingestion: {counts['new']} new, {counts['changed']} changed, "
+                          f"{counts['unchanged']} unchanged, {counts['removed']} removed files.")
+
+        if self.bulk_load:  # indices deferred for the load are built once, over all the data
+            self.log.info("Bulk load finished, creating the deferred indices.")
+            self.initialise_indices()
+            self.bulk_load = False
+
+        return stats['rows'] + stats['failed'] + counts['unchanged'] > 0
+
+    def remove_files(self, paths: list, batch_size: int = 200, on_batch=None) -> int:
+        """
+        Remove files with their pages, meta-KG entities & relation explanations. Their contribution to the KG layer
+        is retracted in the same transaction (see `retract_kg.txt`): relationship counts are decremented and
+        KG entities no longer explained by any document are deleted with their mentions.
+        :param paths: ids of the files
+        :param batch_size: files per transaction
+        :param on_batch: called with the paths of each removed batch
+        :return: number of removed files
+        """
+        n_removed = 0
+        for i in range(0, len(paths), batch_size):
+            batch = paths[i:i + batch_size]
+            file_ids = [x['element_id'] for x in self.neo.run_simple_query(self.QUERY_FILE_ELEMENT_IDS, {'ids': batch})]
+            self.neo.run_multi_queries([{'query': self.queries['retract_kg'], 'data': {'file_ids': file_ids}},
+                                        {'query': self.QUERY_REMOVE_FILES,
+                                         'data': {'rows': [{'id': path} for path in batch]}}])
+            if on_batch is not None:
+                on_batch(batch)
+            n_removed += len(batch)
+        return n_removed
+
+    def import_page_properties(self, path: str, batch_size: int = 1000) -> dict:
+        """
+        Set page properties the CSV export couldn't hold (see `BulkExporter`) after `neo4j-admin database import`.
+        :param path: `page_properties.jsonl` written by the export
+        :param batch_size: pages per write transaction
+        :return: write stats, see `BulkWriter.write`
+        """
+        QUERY = """UNWIND $rows AS row
+        MATCH (p:Page {id: row.id})
+        SET p += row.properties
+        """
+        def rows():
+            with open(path, 'r', encoding="utf-8") as f:
+                for line in f:
+                    yield json.loads(line)
+        return BulkWriter(self.neo, batch_size).write(QUERY, rows(), "page properties")
+
+    @stage("extract")
+    def extract_knowledge(self, data_query: str, model: str, prompt_version: str, max_tokens: int=2000,
+                          concurrency: int = 4, rate_limits: dict = None, cache_path: str = None,
+                          replay: bool = False, chunk_concurrency: int = 4, fetch_size: int = 100,
+                          write_batch_size: int = 10, clean_text: bool = True, skip_duplicates: bool = True,
+                          json_mode: bool = False, max_continuations: int = 1, work_queue: WorkQueue = None,
+                          doc_filter: DocumentFilter = None):
+        """
+        Run LLM knowledge extraction for documents returned by `data_query`. The query must return `element_id` and
+        either `text` or `pages` (list of page texts, in order) or both; with a content store, texts may be its
+        references (e.g. `coalesce(p.text, p.text_ref)`). Documents exceeding the model's context are
+        split on page boundaries and their chunks extracted in parallel, see `OpenAIQuery.query_document`.
+        Documents are streamed from Neo4j while being processed; a query using `$last_key` & `$limit` parameters is
+        paginated instead (see `Neo4jWriter.paginate_query`), which keeps every read transaction short.
+        Up to `concurrency` documents are processed in parallel (within per-model requests/min & tokens/min limits,
+        see `RateLimiter`), results are stored to Neo4j by a separate writer thread.
+        :param data_query: Cypher query returning the documents to process
+        :param model: OpenAI model
+        :param prompt_version: prompt prefix in `<config_dir>/prompts`
+        :param max_tokens: max output tokens per LLM call
+        :param concurrency: number of documents processed in parallel
+        :param rate_limits: overrides of `MODEL_LIMITS`, e.g. `{'gpt-4': {'rpm': 500, 'tpm': 40000}}`
+        :param cache_path: SQLite file with cached LLM responses (see `ResponseCache`), no caching if None
+        :param replay: use only cached responses, documents missing in the cache are skipped
+        :param chunk_concurrency: number of parallel LLM calls for the chunks of one long document
+        :param fetch_size: documents fetched from Neo4j per round-trip (or page)
+        :param write_batch_size: max documents whose results are committed in one transaction
+        :param clean_text: collapse whitespace & strip boilerplate repeated across pages before the LLM call (see
+        `TextCleaner`), token counts before & after are stored on the document node
+        :param skip_duplicates: skip near-duplicates of other files (see `find_duplicates`), their knowledge is the
+        one of the file they are `NEAR_DUPLICATE_OF`
+        :param json_mode: request JSON output (`response_format`), for models supporting it
+        :param max_continuations: continuation requests for an output cut off at `max_tokens`, its complete part is
+        salvaged when still incomplete (the document node then gets `_truncated`)
+        :param work_queue: pull documents from this queue (see `enqueue_documents`) instead of running `data_query`
+        over the whole corpus, so that several workers can share it; `data_query` must then return the documents
+        whose element ids are in `$ids`
+        :param doc_filter: score documents locally before the LLM call (see `DocumentFilter`): low-scoring ones
+        (cover sheets, fax transmittals, OCR garbage ...) are skipped or extracted with its cheap model; decisions
+        are stored on the document nodes (`_filter_score`, `_filter_decision`, `_filter_model`) as the run goes,
+        with the document's results or, for skipped documents, every `write_batch_size` of them. Documents skipped
+        by an earlier run are not scored again (remove their `_filter_decision` to re-score them)
+        :return: processing stats
+        """
+        neo = self.neo
+        if work_queue is not None:
+            data = self.leased_documents(work_queue, data_query, 2 * concurrency)
+        elif "$last_key" in data_query:
+            data = neo.paginate_query(data_query, page_size=fetch_size)
+        else:
+            data = neo.stream_query(data_query, fetch_size=fetch_size)
+        self.log.info(f"Extracting knowledge from documents of query:\n{data_query}")
+
+        cache = ResponseCache(cache_path, read_only=replay) if cache_path is not None else None
+        openai = OpenAIQuery(os.path.join(self.config_dir, "prompts"), prompt_version, max_tokens,
+                             rate_limiter=RateLimiter(rate_limits), cache=cache, metrics=self.metrics,
+                             max_continuations=max_continuations, response_format=JSON_MODE if json_mode else None)
+
+        cleaner = TextCleaner() if clean_text else None
+        duplicates = self.duplicate_ids() if skip_duplicates else set()
+        filtered = self.filtered_ids() if doc_filter is not None else set()
+        filter_counts, filter_lock = {x: 0 for x in [EXTRACT, CHEAP, SKIP]}, threading.Lock()
+        # decisions of skipped documents (the others are stored with the documents' results, see `store_results`)
+        skip_decision, flush_skipped = self._buffered_writer(self.QUERY_FILTER_DECISIONS, "filter decisions",
+                                                             write_batch_size)
+
+        def extract(doc: dict):
+            if doc['element_id'] in duplicates:
+                self.metrics.inc('llm_calls_saved_total', reason="duplicate")
+                return None
+            if doc['element_id'] in filtered:
+                return None
+            pages = self.document_pages(doc, cleaner)
+            if pages is None:
+                return None
+            doc_model = model
+            if doc_filter is not None:
+                decision = self.filter_document(doc, pages, doc_filter)
+                with filter_lock:
+                    filter_counts[decision['decision']] += 1
+                if decision['decision'] == SKIP:
+                    skip_decision(decision)
+                    return None
+                doc['_filter'] = decision
+                doc_model = decision['model'] or model
+            self.log.info(f"Running LLM ({doc_model}) for document ID {doc['element_id']}")
+            return openai.query_document(pages, doc_model, chunk_concurrency)
+
+        def extract_job(doc: dict):
             try:
-                neo.run_simple_query(QUERY_FILES, payload)
+                result = extract(doc)
             except Exception as e:
-                self.log.error(f"Failure when storing a file to Neo4j: {e}\n\tFile: {file['path']}")
-                self.log.debug(f"\n\tContent: {payload}")
+                work_queue.fail(doc['element_id'], e)
+                raise
+            if result is None:
+                work_queue.complete([doc['element_id']])
+            return result
 
-        neo.close()
+        with work_queue.heartbeat() if work_queue is not None else nullcontext():
+            try:
+                stats = ExtractionEngine(concurrency, write_batch_size=write_batch_size).run(
+                    data, extract if work_queue is None else extract_job,
+                    lambda batch: self.store_results(batch, work_queue))
+            finally:
+                flush_skipped()
+        stats['duplicates_skipped'] = int(self.metrics.get('llm_calls_saved_total', reason="duplicate", stage="extract"))
+        if doc_filter is not None:
+            stats['filter'] = {**filter_counts, 'skipped_earlier': len(filtered)}
+        for status in ['stored', 'skipped', 'failed']:
+            self.metrics.inc('documents_total', stats[status], status=status)
 
-        return len(full_content['files']) > 0
+        if cache is not None:
+            stats['cache'] = cache.stats()
+            cache.close()
+        if work_queue is not None:
+            stats['queue'] = work_queue.stats()
 
-    def extract_knowledge(self, data_query: str, model: str, prompt_version: str, max_tokens: int=2000):
-        neo = Neo4jWriter(self.neo4j_db)
-        data = neo.run_simple_query(data_query)
-        self.log.info(f"Extracting knowledge from {len(data)} documents.")
+        return stats
 
-        openai = OpenAIQuery(os.path.join(self.config_dir, "prompts"), prompt_version, max_tokens)
-        for doc in data:
-            #if 'text' not in doc['properties']:
-            #    self.log.info(f"Missing text property in document with ID {doc['elementId']}")
-            #    continue
-            if len(doc['text']) < 100: #doc['properties']
-                self.log.info(f"Text too short in document with ID {doc['element_id']}")
-                continue
-            self.log.info(f"Running LLM for document ID {doc['element_id']}")
-            result = openai.query(doc['text'], model)
-            #with open("resources/gpt_output.json", 'w') as f:
-            #    json.dump(result, f)
-            queries = self.generate_cypher(doc['element_id'], result)
-            if queries is None:
-                continue
-            self.log.info(f"Storing {len(result['entities'])} entities and {len(result['relations'])} relations to Neo4j.")
-            neo.run_multi_queries(queries)
+    @stage("extract_batch")
+    def extract_knowledge_batch(self, data_query: str, model: str, prompt_version: str, max_tokens: int = 2000,
+                                state_dir: str = "batches", batch_ids: list = None, poll_interval: float = 60.,
+                                timeout: float = None, fetch_size: int = 100, write_batch_size: int = 10,
+                                max_requests_per_batch: int = 50000, clean_text: bool = True,
+                                skip_duplicates: bool = True, json_mode: bool = False,
+                                doc_filter: DocumentFilter = None):
+        """
+        Knowledge extraction through the OpenAI Batch API (half the cost, no per-minute rate limits, results within
+        24h) for bulk backfills, see `BatchExtractor`. Documents of `data_query` (as in `extract_knowledge`) are
+        written as JSONL requests and submitted, then the batches are polled and their results stored to Neo4j
+        like in `extract_knowledge`.
+        Re-running with the same `state_dir` resumes batches submitted but not yet collected instead of
+        submitting new ones; specific batches can be collected by passing their `batch_ids`.
+        :param data_query: Cypher query returning the documents to process
+        :param model: OpenAI model
+        :param prompt_version: prompt prefix in `<config_dir>/prompts`
+        :param max_tokens: max output tokens per LLM call
+        :param state_dir: directory for request files & the record of submitted batches
+        :param batch_ids: collect these batches (no new submission)
+        :param poll_interval: seconds between batch status checks
+        :param timeout: max seconds to wait for one batch, no limit if None
+        :param fetch_size: documents fetched from Neo4j per round-trip
+        :param write_batch_size: max documents whose results are committed in one transaction
+        :param max_requests_per_batch: max LLM requests per submitted batch
+        :param clean_text: clean document texts before submitting them, see `extract_knowledge`
+        :param skip_duplicates: don't submit near-duplicates of other files, see `extract_knowledge`
+        :param json_mode: request JSON output, see `extract_knowledge`
+        :param doc_filter: don't submit documents the local pre-filter skips, see `extract_knowledge`; all other
+        documents go to `model` (a batch has a single model)
+        :return: processing stats
+        """
+        openai = OpenAIQuery(os.path.join(self.config_dir, "prompts"), prompt_version, max_tokens,
+                             metrics=self.metrics, response_format=JSON_MODE if json_mode else None)
+        extractor = BatchExtractor(openai, state_dir, max_requests_per_batch)
+        stats = {'batches': 0, 'documents': 0, 'stored': 0, 'failed': 0}
+
+        if batch_ids is None:
+            batch_ids = extractor.pending()
+            if batch_ids:
+                self.log.info(f"Resuming {len(batch_ids)} batches submitted earlier: {batch_ids}")
+        if not batch_ids:
+            self.log.info(f"Submitting documents of query:\n{data_query}")
+            cleaner = TextCleaner() if clean_text else None
+            duplicates = self.duplicate_ids() if skip_duplicates else set()
+            filtered = self.filtered_ids() if doc_filter is not None else set()
+            text_stats, decisions = list(), list()
+            skip_decision, flush_skipped = self._buffered_writer(self.QUERY_FILTER_DECISIONS, "filter decisions",
+                                                                 write_batch_size)
+            if doc_filter is not None:
+                stats['filtered'] = 0
+
+            def docs():
+                for doc in self.neo.stream_query(data_query, fetch_size=fetch_size):
+                    if doc['element_id'] in duplicates:
+                        self.metrics.inc('llm_calls_saved_total', reason="duplicate")
+                        continue
+                    if doc['element_id'] in filtered:
+                        continue
+                    pages = self.document_pages(doc, cleaner)
+                    if pages is None:
+                        continue
+                    if '_text_stats' in doc:
+                        text_stats.append({'element_id': doc['element_id'], **doc['_text_stats']})
+                    if doc_filter is not None:
+                        decision = self.filter_document(doc, pages, doc_filter, cheap=False)
+                        if decision['decision'] == SKIP:
+                            skip_decision(decision)
+                            stats['filtered'] += 1
+                            continue
+                        decisions.append(decision)
+                    yield doc['element_id'], pages
+
+            try:
+                paths = extractor.write_requests(docs(), model)
+            finally:
+                flush_skipped()
+            BulkWriter(self.neo).write(self.QUERY_TEXT_STATS, text_stats, "text stats")
+            if decisions:  # of the submitted documents
+                BulkWriter(self.neo).write(self.QUERY_FILTER_DECISIONS, decisions, "filter decisions")
+            batch_ids = [extractor.submit(path, model) for path in paths]
+
+        for batch_id in batch_ids:
+            batch = extractor.wait(batch_id, poll_interval, timeout)
+            buffer = list()
+            for element_id, result in extractor.collect(batch):
+                stats['documents'] += 1
+                stats['failed'] += 'error' in result
+                buffer.append(({'element_id': element_id}, result))
+                if len(buffer) >= write_batch_size:
+                    self.store_results(buffer)
+                    stats['stored'] += len(buffer)
+                    buffer = list()
+            if buffer:
+                self.store_results(buffer)
+                stats['stored'] += len(buffer)
+            extractor.mark_collected(batch_id)
+            stats['batches'] += 1
 
-        neo.close()
+        self.log.info(f"Batch extraction: {stats['documents']} documents from {stats['batches']} batches, "
+                      f"{stats['failed']} with errors.")
+        return stats
+
+    def find_duplicates(self, threshold: float = 0.85, fetch_size: int = 1000, batch_size: int = 1000) -> dict:
+        """
+        Group near-duplicate files (estimated Jaccard similarity of their word 5-grams >= `threshold`) by the MinHash
+        signatures stored during ingestion, see `DuplicateFinder`. Each group keeps one representative - a file
+        already extracted if there is one, otherwise the one with the smallest id - and the other files get
+        `(dup)-[:NEAR_DUPLICATE_OF {similarity}]->(representative)` and `dup._duplicate_of`, which makes
+        extraction skip them. Previous grouping is replaced.
+        :param threshold: min similarity of near-duplicates
+        :param fetch_size: signatures fetched from Neo4j per round-trip
+        :param batch_size: duplicates written per transaction
+        :return: stats - documents, comparisons, groups, duplicates (= LLM calls saved)
+        """
+        QUERY_SIGNATURES = """MATCH (f:File)
+            WHERE f._minhash IS NOT NULL
+            RETURN f.id AS id, f._minhash AS minhash
+            ORDER BY CASE WHEN f:LLMProcessed THEN 0 ELSE 1 END, f.id
+            """
+        QUERY_RESET = """MATCH (f:File)
+            WHERE f._duplicate_of IS NOT NULL
+            WITH f LIMIT $limit
+            OPTIONAL MATCH (f)-[r:NEAR_DUPLICATE_OF]->()
+            DELETE r
+            REMOVE f._duplicate_of
+            RETURN count(DISTINCT f) AS n_deleted
+            """
+        QUERY_DUPLICATES = """UNWIND $rows AS row
+            MATCH (f:File {id: row.id})
+            MATCH (rep:File {id: row.representative})
+            MERGE (f)-[r:NEAR_DUPLICATE_OF]->(rep)
+            SET r.similarity = row.similarity,
+                f._duplicate_of = rep.id
+            """
+        neo = self.neo
+        finder = DuplicateFinder(threshold)
+        groups, stats = finder.group((row['id'], row['minhash'])
+                                     for row in neo.stream_query(QUERY_SIGNATURES, fetch_size=fetch_size))
+
+        res = [{'n_deleted': 1}]
+        while res[0]['n_deleted'] > 0:
+            res = neo.run_write_query(QUERY_RESET, {'limit': batch_size})
+        rows = ({'id': dup, 'representative': group[0],
+                 'similarity': MinHasher.similarity(finder.signatures[dup], finder.signatures[group[0]])}
+                for group in groups for dup in group[1:])
+        BulkWriter(neo, batch_size).write(QUERY_DUPLICATES, rows, "near-duplicates")
+        self.log.info(f"Found {stats['duplicates']} near-duplicate files in {stats['groups']} groups: "
+                      f"{stats['duplicates']} LLM extractions saved.")
+        return stats
+
+    def duplicate_ids(self) -> set:
+        """:return: element ids of files marked as near-duplicates by `find_duplicates`"""
+        QUERY = """MATCH (f:File)
+            WHERE f._duplicate_of IS NOT NULL
+            RETURN elementId(f) AS id
+            """
+        return set(x['id'] for x in self.neo.run_simple_query(QUERY))
+
+    def filtered_ids(self) -> set:
+        """:return: element ids of files skipped by the local pre-filter of an earlier run (see `DocumentFilter`)"""
+        QUERY = """MATCH (f:File)
+            WHERE f._filter_decision = "skip"
+            RETURN elementId(f) AS id
+            """
+        return set(x['id'] for x in self.neo.run_simple_query(QUERY))
+
+    def _buffered_writer(self, query: str, label: str, batch_size: int):
+        """
+        Rows collected by several threads and written by `BulkWriter` every `batch_size` of them, so that they are
+        stored as the run goes rather than at its end.
+        :return: `add(row)` and `flush()` (writes the rest, call it when the run ends)
+        """
+        rows, lock = list(), threading.Lock()
+
+        def flush(min_rows: int = 1):
+            with lock:
+                if len(rows) < min_rows:
+                    return
+                batch = rows[:]
+                rows.clear()
+            BulkWriter(self.neo, batch_size).write(query, batch, label)
+
+        def add(row: dict):
+            with lock:
+                rows.append(row)
+            flush(batch_size)
+
+        return add, flush
+
+    def document_pages(self, doc: dict, cleaner: TextCleaner = None) -> list:
+        """
+        :param doc: document returned by an extraction data query
+        :param cleaner: text cleaner; its token stats are added to the document as `_text_stats`
+        :return: page texts of the document (cleaned), None if its text is too short
+        """
+        #if 'text' not in doc['properties']:
+        #    self.log.info(f"Missing text property in document with ID {doc['elementId']}")
+        #    return None
+        pages = doc['pages'] if doc.get('pages') is not None else [doc['text']]
+        if self.content_store is not None:  # texts may be references to the content store
+            pages = [self.content_store.resolve(x) or "" for x in pages]
+            if doc.get('text') is not None:
+                doc['text'] = self.content_store.resolve(doc['text']) or ""
+        text = doc['text'] if doc.get('text') is not None else "\n\n".join(pages)
+        if len(text) < 100: #doc['properties']
+            self.log.info(f"Text too short in document with ID {doc['element_id']}")
+            return None
+        if cleaner is not None:
+            pages, doc['_text_stats'] = cleaner.clean(pages)
+            self.metrics.inc('llm_input_tokens_raw_total', doc['_text_stats']['tokens_raw'])
+            self.metrics.inc('llm_input_tokens_clean_total', doc['_text_stats']['tokens_clean'])
+        return pages
+
+    def filter_document(self, doc: dict, pages: list, doc_filter: DocumentFilter, cheap: bool = True) -> dict:
+        """
+        Pre-filter decision of a document, LLM calls & input tokens saved by skipping it are counted in metrics.
+        :param cheap: allow routing to the filter's cheap model, otherwise such documents are extracted as usual
+        :return: `element_id` with the decision, see `DocumentFilter.decide`
+        """
+        text = "\n\n".join(pages)
+        decision = {'element_id': doc['element_id'], **doc_filter.decide(text)}
+        if decision['model'] is not None and not cheap:
+            decision.update(decision=EXTRACT, model=None)
+        self.metrics.inc('filter_decisions_total', decision=decision['decision'])
+        if decision['decision'] == SKIP:
+            self.log.info(f"Skipping document ID {doc['element_id']}, filter score {decision['score']}")
+            self.metrics.inc('llm_calls_saved_total', reason="filtered")
+            self.metrics.inc('llm_input_tokens_saved_total', estimate_tokens(text), reason="filtered")
+        return decision
+
+    def enqueue_documents(self, data_query: str, work_queue: WorkQueue, requeue: bool = False,
+                          fetch_size: int = 1000, batch_size: int = 1000) -> int:
+        """
+        Add documents to the extraction work queue, e.g. before starting workers (`extract_knowledge(work_queue=...)`).
+        Documents already in the queue keep their state unless `requeue`.
+        :param data_query: Cypher query returning `element_id` of the documents
+        :param work_queue: the queue
+        :param requeue: reset documents already queued (incl. done & failed) to pending
+        :param fetch_size: element ids fetched from Neo4j per round-trip
+        :param batch_size: documents enqueued per transaction
+        :return: number of documents enqueued
+        """
+        work_queue.initialise_index()
+        n, ids = 0, list()
+        for row in self.neo.stream_query(data_query, fetch_size=fetch_size):
+            ids.append(row['element_id'])
+            if len(ids) >= batch_size:
+                n += work_queue.enqueue(ids, requeue)
+                ids = list()
+        if ids:
+            n += work_queue.enqueue(ids, requeue)
+        self.log.info(f"Enqueued {n} documents: {work_queue.stats()}")
+        return n
+
+    def leased_documents(self, work_queue: WorkQueue, data_query: str, lease_size: int):
+        """
+        Lease jobs from the queue `lease_size` at a time (lazily, as the documents are consumed) and yield their
+        documents returned by `data_query` for `$ids`. Leased documents the query doesn't return (e.g. already
+        processed) are completed right away.
+        """
+        while True:
+            ids = work_queue.lease(lease_size)
+            if not ids:
+                return
+            docs = self.neo.run_simple_query(data_query, {'ids': ids})
+            found = set(doc['element_id'] for doc in docs)
+            if len(found) < len(ids):
+                work_queue.complete([x for x in ids if x not in found])
+            yield from docs
+
+    def store_results(self, batch: list, work_queue: WorkQueue = None):
+        """
+        Store LLM outputs of several documents, `[(doc, output), ...]`, to Neo4j in one transaction.
+        :param batch: documents & their LLM outputs
+        :param work_queue: queue whose jobs of these documents are finished in the same transaction
+        """
+        queries = list()
+        for doc, result in batch:
+            doc_queries = self.generate_cypher(doc['element_id'], result)
+            if doc_queries is None:
+                continue
+            if 'error' not in result:
+                self.log.info(f"Storing {len(result['entities'])} entities and {len(result['relations'])} relations to Neo4j.")
+            queries += doc_queries
+        text_stats = [{'element_id': doc['element_id'], **doc['_text_stats']} for doc, _ in batch if '_text_stats' in doc]
+        if text_stats:
+            queries.append({'query': self.QUERY_TEXT_STATS, 'data': {'rows': text_stats}})
+        decisions = [doc['_filter'] for doc, _ in batch if '_filter' in doc]
+        if decisions:
+            queries.append({'query': self.QUERY_FILTER_DECISIONS, 'data': {'rows': decisions}})
+        if work_queue is not None:
+            # a job with failed chunks is re-tried like a failed one
+            queries.append(work_queue.finish_query([{'element_id': doc['element_id'],
+                                                     'error': result.get('error') or
+                                                     (f"{result['_failed_chunks']} chunks failed"
+                                                      if result.get('_failed_chunks') else None)}
+                                                    for doc, result in batch]))
+        if queries:
+            self.neo.run_multi_queries(queries)
 
     def generate_cypher(self, element_id: str, gpt_output: dict) -> list:
         self.log.debug("Generating Cypher from LLM output.")
@@ -210,36 +765,163 @@ class KnowledgeGraph(LoggingHandler):
         for label, arr in gpt_output['entities'].items():
             for e in arr:
                 e['_label_llm'] = label.strip()
+                if e.get('id') is None:  # part of the entity's key, see `entities.txt`
+                    e['id'] = f"_{len(ents)}"
                 #e['_label'] = "".join([x[0].upper() + x[1:].lower() for x in label.strip().split()])
                 if 'wikipedia_id' in e and e['wikipedia_id'] is not None:
                     e['wikipedia_url'] = "https://en.wikipedia.org/wiki/" + e['wikipedia_id']
-                e['_all_properties'] = str({k:v for k,v in e.items() if not k.startswith("_") and k not in ["id"]})
                 ents.append(e)
         for rel_type, arr in gpt_output['relations'].items():
             for r in arr:
                 r['_type_llm'] = rel_type.strip()
                 #r['_type'] = "_".join(rel_type.strip().upper().split())
-                r['_all_properties'] = str({k:v for k,v in r.items() if not k.startswith("_") and k not in ["source", "target"]})
                 rels.append(r)
 
-        return [{'query': self.queries['entities'], 'data': {'element_id': element_id, 'entities': ents, 'content_type': content_type}},
-                {'query': self.queries['relations'], 'data': {'element_id': element_id, 'relations': rels}}]
+        queries = [{'query': self.queries['entities'], 'data': {'element_id': element_id, 'entities': ents, 'content_type': content_type,
+                                                             'truncated': gpt_output.get('_truncated'),
+                                                             'failed_chunks': gpt_output.get('_failed_chunks')}},
+                   {'query': self.queries['relations'], 'data': {'element_id': element_id, 'relations': rels}}]
+        if gpt_output.get('_failed_chunks'):
+            self.log.warning(f"{gpt_output['_failed_chunks']} chunks of document ID {element_id} failed, storing "
+                             f"its partial output without marking it processed.")
+            queries.append({'query': self.QUERY_PARTIAL_OUTPUT, 'data': {'element_id': element_id}})
+        if self.content_store is not None:
+            metadata = {'LLM_metadata_entities': json.dumps({"LLMMetadataEntities": ents}, ensure_ascii=False),
+                        'LLM_metadata_relations': json.dumps({"LLMMetadataRelations": rels}, ensure_ascii=False)}
+            queries.append({'query': self.QUERY_METADATA_REFS,
+                            'data': {'element_id': element_id,
+                                     'props': self.content_store.externalize(metadata, min_bytes=0)}})
+        return queries
 
-    def create_knowledge_layer(self):
-        neo = Neo4jWriter(self.neo4j_db)
+    @stage("resolve_entities")
+    def resolve_entities(self, threshold: float = 0.85, max_block_size: int = 200, batch_size: int = 1000) -> dict:
+        """
+        Entity resolution of the meta-KG, run between extraction and `create_knowledge_layer`: per `_label_llm`,
+        distinct entity names are clustered (see `EntityResolver`) and entities of a cluster get its canonical name
+        as `_resolved_name`, which the KG layer merges on. Only changes are written; files mentioning entities whose
+        resolution changed are marked for incremental re-projection.
+        Works on distinct names aggregated by Neo4j, one label at a time, so memory is bounded by the number of
+        distinct names of the largest label.
+        :param threshold: min name similarity of a match
+        :param max_block_size: blocks of more names (too common tokens) are not compared
+        :param batch_size: entity name updates per transaction
+        :return: stats per label - names, blocks, block sizes, comparisons, clusters, merged & updated names
+        """
+        QUERY_LABELS = """MATCH (e:Entity)
+            RETURN DISTINCT e._label_llm AS label
+            """
+        QUERY_NAMES = """MATCH (e:Entity)
+            WHERE e._label_llm = $label
+            RETURN e.name AS name, e.wikipedia_id AS wikipedia_id, count(*) AS n,
+                collect(DISTINCT e._resolved_name) AS resolved
+            """
+        QUERY_UPDATE = """UNWIND $rows AS row
+            MATCH (e:Entity {_label_llm: row.label, name: row.name})
+            WHERE e.wikipedia_id IS NULL AND row.wikipedia_id IS NULL OR e.wikipedia_id = row.wikipedia_id
+            SET e._resolved_name = row.resolved
+            WITH e
+            MATCH (f:File)-[:MENTIONS_ENTITY]->(e)
+            SET f._meta_kg_updated = timestamp()
+            """
+        neo = self.neo
+        resolver = EntityResolver(threshold, max_block_size)
+        writer = BulkWriter(neo, batch_size)
+        report = dict()
+        for label in [x['label'] for x in neo.run_simple_query(QUERY_LABELS) if x['label'] is not None]:
+            rows = neo.run_simple_query(QUERY_NAMES, {'label': label})
+            resolved, stats = resolver.resolve((x['name'], x['wikipedia_id'], x['n']) for x in rows)
+            updates = list()
+            for x in rows:
+                new = resolved.get((x['name'], x['wikipedia_id']))
+                if x['resolved'] != ([new] if new is not None else []):
+                    updates.append({'label': label, 'name': x['name'], 'wikipedia_id': x['wikipedia_id'],
+                                    'resolved': new})
+            writer.write(QUERY_UPDATE, updates, f"{label} names")
+            stats['updated_names'] = len(updates)
+            self.metrics.inc('er_comparisons_total', stats['comparisons'], label=label)
+            self.metrics.observe('er_max_block_size', stats['max_block_size'], label=label)
+            self.log.info(f"Resolved {label}: {stats}")
+            report[label] = stats
+        return report
 
-        # Reset the knowledge layer
-        QUERY_DELETE_KG = """MATCH (n) 
-            WHERE n:KGEntity OR n:ExplainRelation
+    @stage("create_kg")
+    def create_knowledge_layer(self, incremental: bool = False, batch_size: int = 100, delete_batch_size: int = 10000):
+        """
+        Project the meta-KG to the final KG layer using the schema, in transactions of `batch_size` files.
+        Full mode deletes the whole KG layer (in batches) and projects all files. Incremental mode only re-projects
+        files whose meta-KG changed since their last projection: their previous contribution is retracted first
+        (see `retract_kg.txt`).
+        :param incremental: re-project only changed files
+        :param batch_size: files per projection transaction
+        :param delete_batch_size: nodes per transaction when deleting the KG layer
+        :return: number of relationships in the KG layer
+        """
+        QUERY_DELETE_KG = """MATCH (n:%s)
+            WITH n LIMIT $limit
             DETACH DELETE n
+            RETURN count(*) AS n_deleted
+            """
+        QUERY_ALL_FILES = """MATCH (f:File)
+            WHERE (f)-[:MENTIONS_ENTITY]->()
+            RETURN elementId(f) AS id
+            """
+        # `_meta_kg_updated` is set whenever extraction (re)writes the document's entities
+        QUERY_CHANGED_FILES = """MATCH (f:File)
+            WHERE f._meta_kg_updated > coalesce(f._kg_built, 0)
+                OR (f:LLMProcessed AND f._kg_built IS NULL)
+            RETURN elementId(f) AS id
+            """
+        QUERY_MARK_BUILT = """UNWIND $file_ids AS file_id
+            MATCH (f:File)
+            WHERE elementId(f) = file_id
+            SET f._kg_built = timestamp()
             """
-        self.log.info("Cleansing the knowledge layer.")
-        neo.run_simple_query(QUERY_DELETE_KG)
+        QUERY_COUNT_RELS = """MATCH (:KGEntity)-[r]->(:KGEntity)
+            RETURN count(r) AS n_rels
+            """
+
+        neo = self.neo
+
+        if incremental:
+            file_ids = [x['id'] for x in neo.run_simple_query(QUERY_CHANGED_FILES)]
+            self.log.info(f"Incremental update of the knowledge layer: {len(file_ids)} changed files.")
+        else:
+            # Reset the knowledge layer
+            self.log.info("Cleansing the knowledge layer.")
+            for label in ["ExplainRelation", "KGEntity"]:
+                n_deleted, res = 0, [{'n_deleted': 1}]
+                while res[0]['n_deleted'] > 0:
+                    res = neo.run_write_query(QUERY_DELETE_KG % label, {'limit': delete_batch_size})
+                    n_deleted += res[0]['n_deleted']
+                self.log.info(f"Deleted {n_deleted} {label} nodes.")
+            file_ids = [x['id'] for x in neo.run_simple_query(QUERY_ALL_FILES)]
+            self.log.info(f"Creating final knowledge layer from {len(file_ids)} files.")
 
-        self.log.info("Creating final knowledge layer.")
-        res = neo.run_simple_query(self.queries['create_kg'], {'schema': self.SCHEMA})
-        self.log.info(f"Created {res[0]['n_rels']} relationships.")
+        t_start = time.time()
+        for i in range(0, len(file_ids), batch_size):
+            batch = file_ids[i:i + batch_size]
+            queries = [{'query': self.queries['create_kg'], 'data': {'file_ids': batch, 'schema_index': self.schema_index}},
+                       {'query': QUERY_MARK_BUILT, 'data': {'file_ids': batch}}]
+            if incremental:
+                queries.insert(0, {'query': self.queries['retract_kg'], 'data': {'file_ids': batch}})
+            # retraction, projection & marking of one batch are committed together
+            res = neo.run_multi_queries(queries)[-2]
+            elapsed = time.time() - t_start
+            self.log.info(f"Projected {i + len(batch)}/{len(file_ids)} files ({res[0]['n_rels']} relationships in "
+                          f"the last batch), {round((i + len(batch)) / max(elapsed, 1e-6), 1)} files/s.")
 
-        neo.close()
+        n_rels = neo.run_simple_query(QUERY_COUNT_RELS)[0]['n_rels']
+        self.log.info(f"Knowledge layer has {n_rels} relationships.")
 
-        return res[0]['n_rels']
\ No newline at end of file
+        return n_rels
+
+    @stage("snapshot")
+    def export_snapshot(self, path: str, refresh: bool = True, fetch_size: int = 10000) -> dict:
+        """
+        Export the KG layer to a columnar, memory-mapped snapshot for analytics (open it with `Snapshot(path)`).
+        :param path: snapshot directory
+        :param refresh: re-read only files projected since the existing snapshot at `path` (see `SnapshotBuilder`)
+        :param fetch_size: records per round-trip of the streaming reads
+        :return: snapshot metadata, see `SnapshotBuilder.build`
+        """
+        return SnapshotBuilder(self.neo, fetch_size).build(path, refresh)
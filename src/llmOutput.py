@@ -0,0 +1,70 @@
+import json
+from typing import Optional
+
+# response formats for `OpenAIQuery(response_format=...)`
+JSON_MODE = {"type": "json_object"}
+
+CONTINUATION_PROMPT = "Your output was cut off. Continue the JSON exactly where it stopped, output only the rest."
+
+
+def salvage_json(text: str, max_attempts: int = 200) -> Optional[dict]:
+    """
+    Recover a truncated JSON object: cut the text after the last complete object or array and close the brackets
+    left open, so that every complete entity & relation is kept and the incomplete tail dropped.
+    :param text: JSON text cut off at an arbitrary position
+    :param max_attempts: number of cut points (from the end) to try
+    :return: parsed object, None if nothing could be recovered
+    """
+    stack, cuts = list(), list()
+    in_string, escape = False, False
+    start = text.find("{")
+    if start < 0:
+        return None
+    for i in range(start, len(text)):
+        c = text[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif c == "\\":
+                escape = True
+            elif c == '"':
+                in_string = False
+            continue
+        if c == '"':
+            in_string = True
+        elif c in "{[":
+            stack.append(c)
+        elif c in "}]":
+            if not stack:
+                break
+            stack.pop()
+            if not stack:  # complete, nothing to salvage beyond this point
+                return _loads(text[start:i + 1])
+            cuts.append((i + 1, "".join("}" if b == "{" else "]" for b in reversed(stack))))
+    for end, closing in reversed(cuts[-max_attempts:]):
+        output = _loads(text[start:end] + closing)
+        if output is not None:
+            return output
+    return None
+
+
+def _loads(text: str) -> Optional[dict]:
+    try:
+        output = json.loads(text)
+    except ValueError:
+        return None
+    return output if isinstance(output, dict) else None
+
+
+def summarize_output(output: dict) -> str:
+    """Readable summary of extracted entities & relations (entity names looked up by id)."""
+    names = {e.get('id'): e.get('name') for arr in output.get('entities', dict()).values() for e in arr}
+    lines = ["--- Entities ---"]
+    for label, arr in output.get('entities', dict()).items():
+        lines.append(f"{label}: {[x.get('name') for x in arr]}")
+    lines.append("--- Relations ---")
+    for rel_type, arr in output.get('relations', dict()).items():
+        for x in arr:
+            props = {key: val for key, val in x.items() if key not in ['source', 'target']}
+            lines.append(f"{names.get(x.get('source'))} - {rel_type.upper()} ({props}) -> {names.get(x.get('target'))}")
+    return "\n".join(lines)
@@ -0,0 +1,75 @@
+import os
+import sqlite3
+import hashlib
+from typing import Iterator, List
+from src.utils import LoggingHandler
+
+
+class FileManifest(LoggingHandler):
+    """
+    Local (SQLite) record of ingested files - path, size, mtime and content hash - used to ingest only new or
+    modified files and to detect files removed from disk since the previous run.
+    Content is hashed only when size or mtime differ from the recorded ones.
+    """
+    def __init__(self, path: str):
+        super().__init__(self)
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)  # guarded by the caller when shared by threads
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY, size INTEGER, mtime REAL, hash TEXT, run INTEGER)""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS files_run ON files (run)")
+        self.conn.commit()
+        # every file seen in this run gets this run id, the ones left with older ids were removed
+        self.run = self.conn.execute("SELECT COALESCE(MAX(run), 0) FROM files").fetchone()[0] + 1
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    @staticmethod
+    def file_hash(path: str, chunk_size: int = 1024 ** 2) -> str:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def classify(self, path: str) -> tuple:
+        """
+        Compare the file on disk with the manifest. Unchanged files are marked as seen in this run right away.
+        :param path: file path
+        :return: (status, record) with status `new`, `changed` or `unchanged` and record the current
+        `size`, `mtime` and `content_hash` of the file
+        """
+        st = os.stat(path)
+        row = self.conn.execute("SELECT size, mtime, hash FROM files WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0] == st.st_size and row[1] == st.st_mtime:
+            self.conn.execute("UPDATE files SET run = ? WHERE path = ?", (self.run, path))
+            return 'unchanged', {'size': st.st_size, 'mtime': st.st_mtime, 'content_hash': row[2]}
+
+        record = {'size': st.st_size, 'mtime': st.st_mtime, 'content_hash': self.file_hash(path)}
+        if row is None:
+            return 'new', record
+        if row[2] == record['content_hash']:  # only touched
+            self.update(path, record)
+            return 'unchanged', record
+        # still present on disk; the new state is recorded by `update` once the file is written
+        self.conn.execute("UPDATE files SET run = ? WHERE path = ?", (self.run, path))
+        return 'changed', record
+
+    def update(self, path: str, record: dict):
+        """Record a file as successfully ingested in this run."""
+        self.conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                          (path, record['size'], record['mtime'], record['content_hash'], self.run))
+
+    def commit(self):
+        self.conn.commit()
+
+    def removed(self) -> Iterator[str]:
+        """:return: paths recorded in previous runs but not seen in this run (call after all files were classified)"""
+        for (path,) in self.conn.execute("SELECT path FROM files WHERE run < ?", (self.run,)).fetchall():
+            yield path
+
+    def delete(self, paths: List[str]):
+        self.conn.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in paths])
+        self.conn.commit()
@@ -0,0 +1,213 @@
+import json
+import time
+import bisect
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, Tuple, Callable
+from src.utils import LoggingHandler
+
+# USD per 1K tokens (input, output)
+MODEL_PRICES = {
+    'gpt-4': (0.03, 0.06),
+    'gpt-4-32k': (0.06, 0.12),
+    'gpt-4-turbo': (0.01, 0.03),
+    'gpt-4o': (0.005, 0.015),
+    'gpt-4o-mini': (0.00015, 0.0006),
+    'gpt-3.5-turbo': (0.0005, 0.0015),
+    'default': (0.03, 0.06)
+}
+
+# latency histogram buckets (sec)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60., 120.)
+
+# current stage per `Metrics` registry (by id), inherited by the threads started through `in_context`
+_STAGES = contextvars.ContextVar('metrics_stages', default=dict())
+
+# Neo4j write counters recorded per stage
+NEO4J_COUNTERS = ('nodes_created', 'nodes_deleted', 'relationships_created', 'relationships_deleted',
+                  'properties_set', 'labels_added', 'labels_removed')
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self.count, self.sum, self.max = 0, 0., 0.
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket containing the `q` quantile (the max for the +Inf bucket)."""
+        if self.count == 0:
+            return 0.
+        rank, seen = q * self.count, 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+        return self.max
+
+    def summary(self) -> dict:
+        return {'count': self.count, 'sum': round(self.sum, 4), 'mean': round(self.sum / max(self.count, 1), 4),
+                'p50': self.quantile(0.5), 'p95': self.quantile(0.95), 'max': round(self.max, 4)}
+
+
+class Metrics(LoggingHandler):
+    """
+    Thread-safe registry of counters & histograms (with labels) of one pipeline run, exported to the Prometheus text
+    format (e.g. for the node exporter's textfile collector) and to a JSON run summary.
+    Metrics recorded inside a `stage` block get its name as the `stage` label. The stage is a context variable, so
+    concurrent stages don't mix; threads working for a stage must run in its context (see `in_context`).
+    """
+    def __init__(self, prefix: str = "legal_kg"):
+        super().__init__(self)
+        self.prefix = prefix
+        self.counters: Dict[Tuple[str, tuple], float] = dict()
+        self.histograms: Dict[Tuple[str, tuple], Histogram] = dict()
+        self.lock = threading.Lock()
+        self.t_start = time.time()
+
+    @property
+    def stage_name(self) -> str:
+        """Stage of the calling context, None outside of any."""
+        return _STAGES.get().get(id(self))
+
+    def _labels(self, labels: dict) -> tuple:
+        stage_name = self.stage_name
+        if stage_name is not None and 'stage' not in labels:
+            labels = {**labels, 'stage': stage_name}
+        return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, self._labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, self._labels(labels))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        t_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t_start, **labels)
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time a pipeline stage and label everything recorded meanwhile in this context with it."""
+        token = _STAGES.set({**_STAGES.get(), id(self): name})
+        t_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            _STAGES.reset(token)
+            self.inc('stage_seconds_total', time.perf_counter() - t_start, stage=name)
+
+    def record_llm_usage(self, model: str, usage, price_factor: float = 1.):
+        """
+        Token counters and cost of one LLM response.
+        :param usage: `usage` of the OpenAI API response (object or dict), may be None
+        :param price_factor: multiplier of `MODEL_PRICES` (e.g. 0.5 for the Batch API)
+        """
+        if usage is None:
+            return
+        if isinstance(usage, dict):
+            prompt_tokens, completion_tokens = usage.get('prompt_tokens') or 0, usage.get('completion_tokens') or 0
+        else:
+            prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+            completion_tokens = getattr(usage, 'completion_tokens', 0) or 0
+        price_in, price_out = (x * price_factor for x in MODEL_PRICES.get(model, MODEL_PRICES['default']))
+        self.inc('llm_prompt_tokens_total', prompt_tokens, model=model)
+        self.inc('llm_completion_tokens_total', completion_tokens, model=model)
+        self.inc('llm_cost_usd_total', (prompt_tokens * price_in + completion_tokens * price_out) / 1000, model=model)
+
+    def record_neo4j(self, counters: dict):
+        """Write counters of one Neo4j query (see `neo4j.SummaryCounters`)."""
+        for key in NEO4J_COUNTERS:
+            if counters.get(key):
+                self.inc(f"neo4j_{key}_total", counters[key])
+
+    def get(self, name: str, **labels) -> float:
+        """Sum of counter `name` over all label sets matching given labels."""
+        wanted = set((k, str(v)) for k, v in labels.items())
+        with self.lock:
+            return sum(v for (n, lbl), v in self.counters.items() if n == name and wanted <= set(lbl))
+
+    def to_prometheus(self) -> str:
+        def fmt(labels: tuple, extra: tuple = ()) -> str:
+            items = [f'{k}="{v}"' for k, v in labels + extra]
+            return "{" + ",".join(items) + "}" if items else ""
+
+        lines = list()
+        with self.lock:
+            for name in sorted(set(n for n, _ in self.counters)):
+                lines.append(f"# TYPE {self.prefix}_{name} counter")
+                for (n, labels), value in sorted(self.counters.items()):
+                    if n == name:
+                        lines.append(f"{self.prefix}_{name}{fmt(labels)} {value}")
+            for name in sorted(set(n for n, _ in self.histograms)):
+                lines.append(f"# TYPE {self.prefix}_{name} histogram")
+                for (n, labels), h in sorted(self.histograms.items(), key=lambda x: x[0]):
+                    if n != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(h.buckets + ("+Inf",), h.counts):
+                        cumulative += count
+                        lines.append(f"{self.prefix}_{name}_bucket{fmt(labels, (('le', str(bound)),))} {cumulative}")
+                    lines.append(f"{self.prefix}_{name}_sum{fmt(labels)} {h.sum}")
+                    lines.append(f"{self.prefix}_{name}_count{fmt(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> dict:
+        """JSON-serialisable run summary: all counters & histogram statistics, with labels."""
+        with self.lock:
+            return {'seconds': round(time.time() - self.t_start, 3),
+                    'counters': [{'name': n, 'labels': dict(lbl), 'value': round(v, 6)}
+                                 for (n, lbl), v in sorted(self.counters.items())],
+                    'histograms': [{'name': n, 'labels': dict(lbl), **h.summary()}
+                                   for (n, lbl), h in sorted(self.histograms.items(), key=lambda x: x[0])]}
+
+    def write_prometheus(self, path: str):
+        with open(path, 'w') as f:
+            f.write(self.to_prometheus())
+
+    def write_json(self, path: str):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+def in_context(fn: Callable) -> Callable:
+    """:return: `fn` running in (a copy of) the calling context - its metrics stage - from any thread"""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
+
+
+def count_retry(retry_state):
+    """Tenacity `before_sleep` hook: count the retry in the `metrics` of the object whose method is retried."""
+    obj = retry_state.args[0] if retry_state.args else None
+    metrics = getattr(obj, 'metrics', None)
+    if metrics is not None:
+        metrics.inc('retries_total', component=obj.__class__.__name__, function=retry_state.fn.__name__)
+
+
+def stage(name: str):
+    """Method decorator: run the method as pipeline stage `name` of the object's `metrics`."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.stage(name):
+                return fn(self, *args, **kwargs)
+        return wrapper
+    return decorator
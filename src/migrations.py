@@ -0,0 +1,129 @@
+import json
+import hashlib
+from typing import List, Dict
+from src.utils import LoggingHandler
+
+SCHEMA_ID = "legal_kg"
+
+# Versioned schema changes, applied in order and recorded in the graph. Never edit an applied migration's meaning,
+# add a new one instead (an edited migration is re-applied, as its hash changes). Migrations marked `deferrable`
+# hold heavy indices which a bulk load creates only after the data is in (see `Migrator.migrate`).
+MIGRATIONS = [
+    {'version': 1, 'description': "Node keys of the document structure",
+     'queries': ["CREATE CONSTRAINT IF NOT EXISTS FOR (n:Directory) REQUIRE n.id IS NODE KEY",
+                 "CREATE CONSTRAINT IF NOT EXISTS FOR (n:File) REQUIRE n.id IS NODE KEY",
+                 "CREATE CONSTRAINT IF NOT EXISTS FOR (n:Page) REQUIRE n.id IS NODE KEY"]},
+    {'version': 2, 'description': "Entity name & label indices",
+     'queries': ["CREATE TEXT INDEX node_entity_name IF NOT EXISTS FOR (n:Entity) ON (n.name)",
+                 "CREATE TEXT INDEX node_entity_label IF NOT EXISTS FOR (n:Entity) ON (n._label_llm)",
+                 "CREATE INDEX entity_label_name IF NOT EXISTS FOR (n:Entity) ON (n._label_llm, n.name)",
+                 "CREATE TEXT INDEX per_name IF NOT EXISTS FOR (n:Person) ON (n.name)",
+                 "CREATE TEXT INDEX org_name IF NOT EXISTS FOR (n:Organization) ON (n.name)",
+                 "CREATE TEXT INDEX fac_name IF NOT EXISTS FOR (n:Facility) ON (n.name)",
+                 "CREATE TEXT INDEX loc_name IF NOT EXISTS FOR (n:Location) ON (n.name)",
+                 "CREATE TEXT INDEX substance_name IF NOT EXISTS FOR (n:Substance) ON (n.name)",
+                 "CREATE TEXT INDEX health_name IF NOT EXISTS FOR (n:HealthFactor) ON (n.name)",
+                 "CREATE TEXT INDEX product_name IF NOT EXISTS FOR (n:Product) ON (n.name)",
+                 "CREATE TEXT INDEX event_name IF NOT EXISTS FOR (n:Event) ON (n.name)"]},
+    {'version': 3, 'description': "Full-text indices", 'deferrable': True,
+     'queries': ["CREATE FULLTEXT INDEX pageTexts IF NOT EXISTS FOR (n:Page) ON EACH [n.text]",
+                 "CREATE FULLTEXT INDEX fileNames IF NOT EXISTS FOR (n:File) ON EACH [n.name]",
+                 "CREATE FULLTEXT INDEX entityNames IF NOT EXISTS FOR (n:Entity) ON EACH [n.name]",
+                 "CREATE FULLTEXT INDEX perNames IF NOT EXISTS FOR (n:Person) ON EACH [n.name]",
+                 "CREATE FULLTEXT INDEX orgNames IF NOT EXISTS FOR (n:Organization) ON EACH [n.name]",
+                 "CREATE FULLTEXT INDEX facNames IF NOT EXISTS FOR (n:Facility) ON EACH [n.name]",
+                 "CREATE FULLTEXT INDEX locNames IF NOT EXISTS FOR (n:Location) ON EACH [n.name]",
+                 "CREATE FULLTEXT INDEX substanceNames IF NOT EXISTS FOR (n:Substance) ON EACH [n.name]",
+                 "CREATE FULLTEXT INDEX healthNames IF NOT EXISTS FOR (n:HealthFactor) ON EACH [n.name]",
+                 "CREATE FULLTEXT INDEX productNames IF NOT EXISTS FOR (n:Product) ON EACH [n.name]"]},
+    {'version': 4, 'description': "Work queue state of files (see `WorkQueue`)",
+     'queries': ["CREATE INDEX file_job_state IF NOT EXISTS FOR (n:File) ON (n._job_state)"]},
+    {'version': 5, 'description': "Meta-KG entities keyed by document & local id",
+     # entities written before the key get it from their document; the ones without a local id get a unique one
+     # (they are distinct entities, not copies); copies of an entity left by retried transactions are removed, so
+     # that the constraint can be created. Data queries return counts, logged by `Migrator.migrate`.
+     'queries': ["MATCH (n)-[:MENTIONS_ENTITY]->(e:Entity) WHERE e._doc_id IS NULL "
+                 "CALL { WITH n, e SET e._doc_id = elementId(n) } IN TRANSACTIONS OF 10000 ROWS "
+                 "RETURN count(e) AS entities_keyed_by_document",
+                 "MATCH (e:Entity) WHERE e._doc_id IS NOT NULL AND e.id IS NULL "
+                 "CALL { WITH e SET e.id = '_legacy_' + elementId(e) } IN TRANSACTIONS OF 10000 ROWS "
+                 "RETURN count(e) AS entities_without_id",
+                 "MATCH (e:Entity) WHERE e._doc_id IS NOT NULL AND e.id IS NOT NULL "
+                 "WITH e._doc_id AS doc_id, e.id AS id, collect(e) AS copies WHERE size(copies) > 1 "
+                 "UNWIND copies[1..] AS copy "
+                 "CALL { WITH copy DETACH DELETE copy } IN TRANSACTIONS OF 10000 ROWS "
+                 "RETURN count(copy) AS duplicate_entities_removed",
+                 "CREATE CONSTRAINT entity_doc_key IF NOT EXISTS FOR (e:Entity) REQUIRE (e._doc_id, e.id) IS UNIQUE"]},
+    {'version': 6, 'description': "Page full-text index covering previews of externalised texts", 'deferrable': True,
+     # pages whose text is in the content store keep only `text_preview` (see `ContentStore`)
+     'queries': ["DROP INDEX pageTexts IF EXISTS",
+                 "CREATE FULLTEXT INDEX pageTexts IF NOT EXISTS FOR (n:Page) ON EACH [n.text, n.text_preview]"]},
+]
+
+
+def migration_hash(migration: dict) -> str:
+    return hashlib.sha256(json.dumps([migration['version'], migration['queries']]).encode("utf-8")).hexdigest()[:16]
+
+
+def fingerprint(migrations: List[dict]) -> str:
+    """:return: fingerprint of a schema - hash of all its migrations"""
+    return hashlib.sha256("|".join(migration_hash(m) for m in migrations).encode("utf-8")).hexdigest()[:16]
+
+
+class Migrator(LoggingHandler):
+    """
+    Applies the schema migrations missing in the DB. Applied migrations (versions & hashes) and the fingerprint of
+    the whole schema are recorded on a `SchemaMigration` node, so an up-to-date DB costs one read query and no DDL.
+    """
+    QUERY_STATE = """MATCH (v:SchemaMigration {id: $id})
+        RETURN v.versions AS versions, v.hashes AS hashes, v.fingerprint AS fingerprint
+        """
+    QUERY_RECORD = """MERGE (v:SchemaMigration {id: $id})
+        SET v.versions = $versions, v.hashes = $hashes, v.fingerprint = $fingerprint, v.updated = timestamp()
+        """
+
+    def __init__(self, neo, migrations: List[dict] = None, schema_id: str = SCHEMA_ID):
+        super().__init__(self)
+        self.neo = neo
+        self.migrations = sorted(migrations if migrations is not None else MIGRATIONS, key=lambda m: m['version'])
+        self.schema_id = schema_id
+
+    def state(self) -> dict:
+        """:return: recorded `versions` & `hashes` of the applied migrations and the schema `fingerprint`"""
+        res = self.neo.run_simple_query(self.QUERY_STATE, {'id': self.schema_id})
+        return res[0] if res else {'versions': None, 'hashes': None, 'fingerprint': None}
+
+    def migrate(self, defer: bool = False) -> List[int]:
+        """
+        Apply the migrations missing in the DB (or changed since applied), in order; each one is recorded as soon
+        as it succeeds, so a failed run resumes where it stopped.
+        :param defer: skip `deferrable` migrations (heavy indices), e.g. before a bulk load; run again without it
+        when the load is done
+        :return: versions of the applied migrations
+        """
+        state = self.state()
+        if state['fingerprint'] == fingerprint(self.migrations):
+            self.log.debug(f"Schema is up to date ({state['fingerprint']}).")
+            return list()
+        applied = dict(zip(state['versions'] or list(), state['hashes'] or list()))
+        todo = [m for m in self.migrations
+                if applied.get(m['version']) != migration_hash(m) and not (defer and m.get('deferrable'))]
+        for m in todo:
+            self.log.info(f"Applying schema migration {m['version']}: {m['description']} ({len(m['queries'])} queries).")
+            for query in m['queries']:  # schema changes, each in its own (auto-commit) transaction
+                for record in self.neo.run_simple_query(query):
+                    self.log.info(f"Migration {m['version']}: {record}")
+            applied[m['version']] = migration_hash(m)
+            self._record(applied)
+        deferred = [m['version'] for m in self.migrations if applied.get(m['version']) != migration_hash(m)]
+        if deferred:
+            self.log.info(f"Schema migrations {deferred} deferred.")
+        return [m['version'] for m in todo]
+
+    def _record(self, applied: Dict[int, str]):
+        versions = sorted(applied)
+        done = [m for m in self.migrations if applied.get(m['version']) == migration_hash(m)]
+        # the fingerprint marks the schema as up to date only when every migration is applied
+        self.neo.run_simple_query(self.QUERY_RECORD, {
+            'id': self.schema_id, 'versions': versions, 'hashes': [applied[v] for v in versions],
+            'fingerprint': fingerprint(done) if len(done) == len(self.migrations) else None})
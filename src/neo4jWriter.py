@@ -1,14 +1,17 @@
 import os
-from typing import List, Dict
+import time
+from typing import List, Dict, Iterator, Tuple
 from neo4j import GraphDatabase, basic_auth
 from tenacity import retry, wait_exponential, stop_after_attempt
 from src.utils import LoggingHandler
+from src.metrics import Metrics, count_retry
 
 
 class Neo4jWriter(LoggingHandler):
-    def __init__(self, db: str):#, uri:str, username: str, pwd: str):
+    def __init__(self, db: str, max_connection_pool_size: int = 50, metrics: Metrics = None):#, uri:str, username: str, pwd: str):
         super().__init__(self)
         self.db = db
+        self.metrics = metrics if metrics is not None else Metrics()
 
         if 'NEO4J_URI' not in os.environ:
             self.log.error(f"Missing environment variable: NEO4J_URI")
@@ -21,13 +24,38 @@ class Neo4jWriter(LoggingHandler):
         #self.driver = GraphDatabase.driver(uri, auth=basic_auth(username, pwd))
         self.driver = GraphDatabase.driver(
             os.environ['NEO4J_URI'],
-            auth=basic_auth(os.environ['NEO4J_USER'], os.environ['NEO4J_PWD'])
+            auth=basic_auth(os.environ['NEO4J_USER'], os.environ['NEO4J_PWD']),
+            max_connection_pool_size=max_connection_pool_size
         )
 
     def close(self):
         self.driver.close()
 
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=1, max=8))
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def _run(tx, query: str, data: dict) -> Tuple[List[Dict], object, float]:
+        """
+        Run query in given session or transaction.
+        :return: records, summary & latency, to be recorded by `_record` - for a transaction function only once it
+        is committed, as the driver may run the function several times
+        """
+        t_start = time.perf_counter()
+        result = tx.run(query, data) if data is not None else tx.run(query)
+        records = result.data()
+        return records, result.consume(), time.perf_counter() - t_start
+
+    def _record(self, summary, operation: str, seconds: float):
+        """Record latency and write counters of a query."""
+        self.metrics.observe('neo4j_query_seconds', seconds, operation=operation)
+        self.metrics.inc('neo4j_queries_total', operation=operation)
+        self.metrics.record_neo4j(vars(summary.counters))
+
+    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=1, max=8), before_sleep=count_retry)
     def run_simple_query(self, query: str, data: dict = None, db: str = None) -> List[Dict]:
         """
         Execute simple read or write (can contain payload in `data` parameter) query.
@@ -37,19 +65,100 @@ class Neo4jWriter(LoggingHandler):
         :return: list of dicts corresponding to the RETURN Cypher statement
         """
         with self.driver.session(database=self.db if db is None else db) as session:
-            result = session.run(query, data).data() if data is not None\
-                else session.run(query).data()
+            result, summary, seconds = self._run(session, query, data)
+            self._record(summary, 'simple', seconds)
             self.log.debug(result)
         return result
 
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=1, max=8))
-    def run_multi_queries(self, queries: list, db: str = None) -> List[List[Dict]]:
-        results = list()
+    def run_write_query(self, query: str, data: dict = None, db: str = None) -> List[Dict]:
+        """
+        Execute write query in a managed transaction, re-tried by the driver on transient errors (no retries on top
+        of the driver's own, unlike `run_simple_query`'s auto-commit transactions).
+        :param query: Cypher query
+        :param data: query parameters
+        :param db: Neo4j DB to execute against (optional)
+        :return: list of dicts corresponding to the RETURN Cypher statement
+        """
         with self.driver.session(database=self.db if db is None else db) as session:
+            result, summary, seconds = session.execute_write(lambda tx: self._run(tx, query, data))
+            self._record(summary, 'write', seconds)
+            self.log.debug(result)
+        return result
+
+    def stream_query(self, query: str, data: dict = None, db: str = None, fetch_size: int = 1000) -> Iterator[Dict]:
+        """
+        Execute read query and yield its records one by one as they arrive, fetching `fetch_size` records per
+        round-trip, so the client memory stays constant whatever the result size.
+        The session (and its transaction) stays open until the generator is exhausted or closed.
+        :param query: Cypher query
+        :param data: query parameters
+        :param db: Neo4j DB to execute against (optional)
+        :param fetch_size: number of records fetched per network round-trip
+        :return: generator of dicts corresponding to the RETURN Cypher statement
+        """
+        with self.driver.session(database=self.db if db is None else db, fetch_size=fetch_size) as session:
+            t_start = time.perf_counter()
+            result = session.run(query, data)
+            for record in result:
+                yield record.data()
+            self._record(result.consume(), 'stream', time.perf_counter() - t_start)
+
+    def paginate_query(self, query: str, data: dict = None, db: str = None, page_size: int = 1000,
+                       key: str = 'element_id') -> Iterator[Dict]:
+        """
+        Keyset pagination: run the query repeatedly, each time in a new short transaction, for the next page of
+        records. The query must filter on `$last_key` and order & limit its output, e.g.
+        `WHERE elementId(n) > $last_key ... RETURN elementId(n) AS element_id ... ORDER BY element_id LIMIT $limit`.
+        :param query: Cypher query using `$last_key` and `$limit` parameters
+        :param data: other query parameters
+        :param db: Neo4j DB to execute against (optional)
+        :param page_size: records per page
+        :param key: returned field the query orders by
+        :return: generator of dicts corresponding to the RETURN Cypher statement
+        """
+        last_key = ""
+        while True:
+            page = self.run_simple_query(query, {**(data or dict()), 'last_key': last_key, 'limit': page_size}, db)
+            yield from page
+            if len(page) < page_size:
+                return
+            last_key = page[-1][key]
+
+    def run_multi_queries(self, queries: list, db: str = None) -> List[List[Dict]]:
+        """
+        Execute several write queries in one managed transaction: either all of them are committed or none. The
+        transaction is re-tried by the driver on transient errors.
+        :param queries: list of dicts with `query` and `data` (parameters, can be None)
+        :param db: Neo4j DB to execute against (optional)
+        :return: list of results, one per query
+        """
+        def work(tx):
+            results = list()
             for q in queries:
                 self.log.debug(f"Query: {q}")
-                result = session.run(q['query'], q['data']).data() if q['data'] is not None \
-                    else session.run(q['query']).data()
+                result = self._run(tx, q['query'], q['data'])
                 results.append(result)
-                self.log.debug(f"Result: {result}")
-        return results
\ No newline at end of file
+                self.log.debug(f"Result: {result[0]}")
+            return results
+
+        with self.driver.session(database=self.db if db is None else db) as session:
+            results = session.execute_write(work)
+        for _, summary, seconds in results:  # only the committed attempt
+            self._record(summary, 'multi', seconds)
+        return [records for records, _, _ in results]
+
+    def write_batch(self, query: str, rows: List[Dict], db: str = None) -> dict:
+        """
+        Execute one batched write query in a managed transaction. No retries on top of the driver's own: the caller
+        (see BulkWriter) decides how to back off.
+        :param query: Cypher query reading the batch through `$rows` parameter
+        :param rows: list of row dicts
+        :param db: Neo4j DB to execute against (optional)
+        :return: write counters of the query
+        """
+        t_start = time.perf_counter()
+        with self.driver.session(database=self.db if db is None else db) as session:
+            summary = session.execute_write(lambda tx: tx.run(query, {'rows': rows}).consume())
+        self._record(summary, 'batch', time.perf_counter() - t_start)
+        self.metrics.inc('neo4j_rows_written_total', len(rows))
+        return {k: v for k, v in vars(summary.counters).items() if not k.startswith("_")}
@@ -1,57 +1,244 @@
 import os
 import json
 import time
+import logging
 from typing import List, Dict
-from openai import OpenAI
+from concurrent.futures import ThreadPoolExecutor
+from openai import OpenAI, RateLimitError, InternalServerError, APIConnectionError
 from tenacity import retry, wait_exponential, stop_after_attempt
-from src.utils import LoggingHandler
+from src.utils import LoggingHandler, estimate_tokens
+from src.rateLimiter import RateLimiter
+from src.responseCache import ResponseCache
+from src.chunker import Chunker, merge_results
+from src.metrics import Metrics, count_retry, in_context
+from src.llmOutput import salvage_json, summarize_output, CONTINUATION_PROMPT
 
 
 class OpenAIQuery(LoggingHandler):
-    def __init__(self, prompt_path: str, prompt_version: str, max_tokens: int):
+    def __init__(self, prompt_path: str, prompt_version: str, max_tokens: int, rate_limiter: RateLimiter = None,
+                 base_url: str = None, max_rate_limit_retries: int = 5, cache: ResponseCache = None,
+                 metrics: Metrics = None, max_continuations: int = 1, response_format: dict = None,
+                 max_error_retries: int = 3, error_backoff: float = 1.):
+        """
+        :param prompt_path: directory with prompts
+        :param prompt_version: prompt prefix
+        :param max_tokens: max output tokens per LLM call
+        :param rate_limiter: per-model requests/min & tokens/min limits, none if None
+        :param base_url: OpenAI-compatible API endpoint, the default one if None
+        :param max_rate_limit_retries: retries of a call answered with HTTP 429
+        :param cache: cache of LLM responses, none if None
+        :param metrics: metrics registry
+        :param max_continuations: continuation requests for an output cut off at `max_tokens`
+        :param response_format: e.g. `JSON_MODE` (see `llmOutput`) or a JSON schema format, model's default if None
+        :param max_error_retries: retries of a call failing transiently (HTTP 5xx, timeout, connection error)
+        :param error_backoff: seconds before the first such retry, doubled with every next one
+        """
         super().__init__(self)
         self.prompt_path = prompt_path
         self.prompt_version = prompt_version
         self.max_tokens = max_tokens
-        self.gpt_client = OpenAI(api_key=os.environ['OPENAI_API_KEY'])
+        self.rate_limiter = rate_limiter
+        self.max_rate_limit_retries = max_rate_limit_retries
+        self.max_error_retries = max_error_retries
+        self.error_backoff = error_backoff
+        self.cache = cache
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.max_continuations = max_continuations
+        self.request_options = {'response_format': response_format} if response_format is not None else dict()
+        # HTTP 429 (honouring `Retry-After`) and transient errors are re-tried here, so the client must not retry
+        self.gpt_client = OpenAI(api_key=os.environ['OPENAI_API_KEY'], base_url=base_url, max_retries=0)
 
         if not os.path.exists(prompt_path):
             self.log.error(f"Path {prompt_path} does not exist.")
         if not os.path.isdir(prompt_path):
             self.log.error(f"Path {prompt_path} should be a directory.")
         self.messages = self.build_prompt(prompt_path, prompt_version)
+        self.prompt_tokens = sum(estimate_tokens(m) for m in self.messages.values())
+        self.chunker = Chunker(self.prompt_tokens, self.max_tokens)
 
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=1, max=8))
+    def build_messages(self, query: str) -> List[Dict]:
+        return [{"role": "system", "content": self.messages['task']},
+                {"role": "user", "content": self.messages['example']},
+                {"role": "assistant", "content": self.messages['example_output']},
+                {"role": "user", "content": query}
+                ]
+
+    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=1, max=8), before_sleep=count_retry)
     def query(self, query: str, model: str) -> dict:
-        prompt = [{"role": "system", "content": self.messages['task']},
-                  {"role": "user", "content": self.messages['example']},
-                  {"role": "assistant", "content": self.messages['example_output']},
-                  {"role": "user", "content": query}
-                  ]
+        """
+        Extract entities & relations from given text.
+        :param query: document text
+        :param model: OpenAI model
+        :return: parsed LLM output, or dict with `error` and `response` keys on failure; None when the response
+        cache is in read-only (replay) mode and doesn't contain this query
+        """
+        cache_key = None
+        if self.cache is not None:
+            cache_key = ResponseCache.make_key(model, self.prompt_version, self.messages, self.max_tokens, query)
+            output = self.cache.get(cache_key)
+            if output is not None:
+                self.log.debug("Response cache hit.")
+                self.metrics.inc('llm_cache_hits_total', model=model)
+                return output
+            self.metrics.inc('llm_cache_misses_total', model=model)
+            if self.cache.read_only:
+                self.log.info("Response not in cache, skipping the LLM call (replay mode).")
+                return None
+
+        prompt = self.build_messages(query)
+        # OpenAI counts `max_tokens` against the tokens/min limit upfront
+        n_tokens = self.prompt_tokens + estimate_tokens(query) + self.max_tokens
 
         self.log.debug(f"Calling model {model} ...")
 
         t_start = time.time()
-        try:
-            response = self.gpt_client.chat.completions.create(model=model, messages=prompt,
-                                                               temperature=0., max_tokens=self.max_tokens
-                                                               )
-            self.log.debug(response)
-        except Exception as e:
-            self.log.error(f"OpenAI API call failed: {e}\nQuery: {query}")
-            return {"error": str(e), "response": str(response)}
-        # print(response.choices[0].message.content)
+        response, error = self._call(prompt, model, n_tokens)
+        if error is not None:
+            self.log.error(f"{error['error']}\nQuery: {query}")
+            return error
+        content = response.choices[0].message.content or ""
+        finish_reason = response.choices[0].finish_reason
+        if finish_reason == "length":
+            self.metrics.inc('llm_truncated_total', model=model)
+        # output cut off at `max_tokens`: ask for the rest instead of re-running the whole document
+        for _ in range(self.max_continuations):
+            if finish_reason != "length":
+                break
+            self.log.warning(f"LLM output truncated at {self.max_tokens} tokens, requesting continuation.")
+            self.metrics.inc('llm_continuations_total', model=model)
+            messages = prompt + [{"role": "assistant", "content": content},
+                                 {"role": "user", "content": CONTINUATION_PROMPT}]
+            # in JSON mode the model would answer with a new, complete JSON object instead of the missing part
+            response, error = self._call(messages, model, n_tokens + estimate_tokens(content), request_options={})
+            if error is not None:
+                self.log.warning(f"Continuation failed, salvaging the truncated output: {error['error']}")
+                break
+            content += response.choices[0].message.content or ""
+            finish_reason = response.choices[0].finish_reason
         self.log.debug(f"Query time: {round(time.time() - t_start, 1)} sec\n")
 
+        output = self.parse_output(content, model, response)
+        if 'error' in output:
+            return output
+        if self.cache is not None and not output.get('_truncated'):  # incomplete outputs are re-tried next run
+            self.cache.put(cache_key, model, self.prompt_version, output)
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug(summarize_output(output))
+
+        return output
+
+    def _call(self, messages: List[Dict], model: str, n_tokens: int, request_options: dict = None) -> tuple:
+        """
+        One chat completion, re-tried when rate limited and, with exponential back-off, on transient errors (HTTP 5xx,
+        timeouts & connection errors).
+        :param request_options: extra request parameters, `self.request_options` if None
+        :return: (response, None) on success, (None, output with `error` & `response` keys) on failure
+        """
+        response = None
+        options = self.request_options if request_options is None else request_options
+        n_errors, attempt = 0, 0
+        while attempt <= self.max_rate_limit_retries:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(model, n_tokens)
+            try:
+                with self.metrics.timer('llm_request_seconds', model=model):
+                    response = self.gpt_client.chat.completions.create(model=model, messages=messages,
+                                                                       temperature=0., max_tokens=self.max_tokens,
+                                                                       **options)
+                self.log.debug(response)
+                self.metrics.inc('llm_requests_total', model=model, status="ok")
+                self.metrics.record_llm_usage(model, response.usage)
+                return response, None
+            except RateLimitError as e:
+                self.metrics.inc('llm_requests_total', model=model, status="rate_limited")
+                wait = self.retry_after(e, attempt)
+                self.log.warning(f"Rate limited by OpenAI API (attempt {attempt + 1}), retrying in {wait} sec.")
+                if self.rate_limiter is not None:
+                    self.rate_limiter.pause(model, wait)
+                else:
+                    time.sleep(wait)
+                attempt += 1
+            except (InternalServerError, APIConnectionError) as e:  # incl. `APITimeoutError`
+                self.metrics.inc('llm_requests_total', model=model, status="transient_error")
+                if n_errors >= self.max_error_retries:
+                    return None, {"error": f"OpenAI API call failed after {n_errors + 1} attempts: {e}",
+                                  "response": str(response)}
+                wait = self.error_backoff * 2 ** n_errors
+                n_errors += 1
+                self.log.warning(f"OpenAI API call failed ({type(e).__name__}: {e}), retrying in {wait} sec.")
+                time.sleep(wait)
+            except Exception as e:
+                self.metrics.inc('llm_requests_total', model=model, status="error")
+                return None, {"error": f"OpenAI API call failed: {e}", "response": str(response)}
+        return None, {"error": "Rate limit retries exhausted", "response": str(response)}
+
+    def parse_output(self, content: str, model: str, response=None) -> dict:
+        """
+        :param content: LLM reply
+        :param model: OpenAI model
+        :param response: whole API response, reported on failure
+        :return: parsed output, or dict with `error` and `response` keys when the reply isn't valid JSON
+        """
         # string -> json
         try:
-            output = json.loads(response.choices[0].message.content)
+            return json.loads(content)
         except Exception as e:
+            # truncated output: keep the complete entities & relations
+            output = salvage_json(content or "")
+            if output is not None and 'entities' in output:
+                output.setdefault('relations', dict())
+                output['_truncated'] = True
+                self.metrics.inc('llm_salvaged_total', model=model)
+                self.log.warning(f"Recovered {sum(len(x) for x in output['entities'].values())} entities & "
+                                 f"{sum(len(x) for x in output['relations'].values())} relations from incomplete "
+                                 f"LLM output ({e}).")
+                return output
+            self.metrics.inc('llm_parse_errors_total', model=model)
             self.log.error(f"FAILED to parse GPT output.\n{e}\n{response}")
             return {"error": f"GPT output parsing (str -> JSON) failed with: {str(e)}", "response": str(response)}
-        self.pretty_print_rels(output)
 
-        return output
+    def query_document(self, pages: List[str], model: str, concurrency: int = 4) -> dict:
+        """
+        Extract entities & relations from a document too long for one LLM call: pages are packed into chunks
+        fitting the model's context (see `Chunker`), chunks are queried in parallel and their outputs merged.
+        :param pages: texts of document pages, in order
+        :param model: OpenAI model
+        :param concurrency: max parallel LLM calls for the chunks of this document
+        :return: merged output, see `query`; chunks which failed or are missing in the cache (replay mode) are
+        counted in `_failed_chunks`
+        """
+        chunks = self.chunker.split(pages, model)
+        if len(chunks) <= 1:
+            return self.query(chunks[0] if chunks else "", model)
+        self.log.info(f"Document split into {len(chunks)} chunks.")
+        self.metrics.inc('llm_chunked_documents_total', model=model)
+        self.metrics.inc('llm_chunks_total', len(chunks), model=model)
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(chunks)), thread_name_prefix="chunk") as pool:
+            results = list(pool.map(in_context(lambda chunk: self.query(chunk, model)), chunks))
+        results = [r for r in results if r is not None]  # not in cache (replay mode)
+        if not results:
+            return None
+        merged = merge_results(results)
+        if len(results) < len(chunks):
+            self.log.warning(f"Only {len(results)} of {len(chunks)} chunks found in the response cache.")
+            if 'error' not in merged:
+                merged['_failed_chunks'] = merged.get('_failed_chunks', 0) + len(chunks) - len(results)
+        if merged.get('_failed_chunks'):
+            self.metrics.inc('llm_failed_chunks_total', merged['_failed_chunks'], model=model)
+        return merged
+
+    @staticmethod
+    def retry_after(error: RateLimitError, attempt: int) -> float:
+        """Wait time requested by the API (`Retry-After` headers), exponential back-off if there is none."""
+        headers = error.response.headers if error.response is not None else dict()
+        try:
+            if headers.get('retry-after-ms') is not None:
+                return float(headers['retry-after-ms']) / 1000
+            if headers.get('retry-after') is not None:
+                return float(headers['retry-after'])
+        except ValueError:
+            pass
+        return float(min(2 ** attempt, 60))
 
     @staticmethod
     def build_prompt(path: str, prefix: str):
@@ -63,18 +250,3 @@ class OpenAIQuery(LoggingHandler):
         with open(os.path.join(path, prefix + "_example_output.txt"), 'r') as f:
             messages['example_output'] = f.read()
         return messages
-
-    @staticmethod
-    def pretty_print_rels(output: dict):
-        print("--- Entities ---")
-        for e in output['entities'].keys():
-            print(f"{e}: {[x['name'] for x in output['entities'][e]]}")
-        print("\n--- Relations ---")
-        for r in output['relations'].keys():
-            for x in output['relations'][r]:
-                sources = [e['name'] for arr in output['entities'].values() for e in arr if e['id'] == x['source']]
-                source = sources[0] if len(sources) > 0 else None
-                targets = [e['name'] for arr in output['entities'].values() for e in arr if e['id'] == x['target']]
-                target = targets[0] if len(targets) > 0 else None
-                x2 = {key: val for key, val in x.items() if key not in ['source', 'target']}
-                print(f"{source} - {r.upper()} ({x2}) -> {target}")
\ No newline at end of file
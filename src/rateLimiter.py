@@ -0,0 +1,87 @@
+import time
+import threading
+from src.utils import LoggingHandler
+
+# Requests/min and tokens/min per model. Defaults are conservative, adjust them to your OpenAI account tier.
+MODEL_LIMITS = {
+    'gpt-4': {'rpm': 500, 'tpm': 40000},
+    'gpt-4-32k': {'rpm': 500, 'tpm': 80000},
+    'gpt-4-turbo': {'rpm': 500, 'tpm': 30000},
+    'gpt-4o': {'rpm': 500, 'tpm': 30000},
+    'gpt-3.5-turbo': {'rpm': 3500, 'tpm': 60000},
+    'default': {'rpm': 500, 'tpm': 30000}
+}
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled continuously at `rate_per_min`. `acquire` blocks until enough capacity is
+    available, `pause` blocks all callers for given time (e.g. after HTTP 429 with `Retry-After`).
+    """
+    def __init__(self, rate_per_min: float, capacity: float = None):
+        self.rate = rate_per_min / 60.
+        self.capacity = capacity if capacity is not None else rate_per_min
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount: float = 1.) -> float:
+        """
+        Take `amount` tokens, waiting as long as needed.
+        :return: total time spent waiting (sec)
+        """
+        amount = min(amount, self.capacity)  # a single oversized request must not block forever
+        waited = 0.
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                elif self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+                else:
+                    wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def pause(self, seconds: float):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class RateLimiter(LoggingHandler):
+    """Requests/min and tokens/min limits per model, shared by all threads calling the OpenAI API."""
+    def __init__(self, limits: dict = None):
+        super().__init__(self)
+        self.limits = dict(MODEL_LIMITS)
+        if limits is not None:
+            self.limits.update(limits)
+        self.buckets = dict()
+        self.lock = threading.Lock()
+
+    def _buckets(self, model: str):
+        with self.lock:
+            if model not in self.buckets:
+                limits = self.limits.get(model, self.limits['default'])
+                self.log.debug(f"Rate limits for model {model}: {limits}")
+                self.buckets[model] = (TokenBucket(limits['rpm']), TokenBucket(limits['tpm']))
+            return self.buckets[model]
+
+    def acquire(self, model: str, tokens: int) -> float:
+        requests, token_bucket = self._buckets(model)
+        waited = requests.acquire(1)
+        waited += token_bucket.acquire(tokens)
+        if waited > 1:
+            self.log.debug(f"Rate limiter delayed {model} call by {round(waited, 1)} sec.")
+        return waited
+
+    def pause(self, model: str, seconds: float):
+        for bucket in self._buckets(model):
+            bucket.pause(seconds)
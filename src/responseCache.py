@@ -0,0 +1,96 @@
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from src.utils import LoggingHandler
+
+
+class ResponseCache(LoggingHandler):
+    """
+    Persistent (SQLite) cache of parsed LLM outputs, content-addressed by a hash of everything that determines
+    the response: model, prompt version & texts, max_tokens and the document text.
+    Least recently used entries are evicted once the cache grows over `max_bytes`.
+    In `read_only` (replay) mode the cache file is never modified.
+    """
+    def __init__(self, path: str, max_bytes: int = 2 * 1024 ** 3, read_only: bool = False):
+        super().__init__(self)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.read_only = read_only
+        self.hits, self.misses = 0, 0
+        self.lock = threading.Lock()
+
+        if read_only:
+            self.conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY, model TEXT, prompt_version TEXT, response TEXT,
+                size INTEGER, created REAL, accessed REAL)""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+            self.conn.commit()
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def close(self):
+        self.log.info(f"Response cache {self.path}: {self.stats()}")
+        self.conn.close()
+
+    @staticmethod
+    def make_key(model: str, prompt_version: str, messages: dict, max_tokens: int, text: str) -> str:
+        content = json.dumps([model, prompt_version, messages['task'], messages['example'],
+                              messages['example_output'], max_tokens, text], ensure_ascii=False)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        """
+        :return: cached output, None if not present
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if not self.read_only:
+                self.conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+                self.conn.commit()
+        return json.loads(row[0])
+
+    def put(self, key: str, model: str, prompt_version: str, output: dict):
+        if self.read_only:
+            return
+        response = json.dumps(output, ensure_ascii=False)
+        now = time.time()
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (key, model, prompt_version, response, len(response), now, now))
+            self.conn.commit()
+            self.total_bytes += len(response) - (old[0] if old is not None else 0)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Drop least recently used entries until the cache is back under 90% of `max_bytes`."""
+        target = int(self.max_bytes * 0.9)
+        n_evicted = 0
+        while self.total_bytes > target:
+            rows = self.conn.execute("SELECT key, size FROM responses ORDER BY accessed LIMIT 1000").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self.total_bytes <= target:
+                    break
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.total_bytes -= size
+                n_evicted += 1
+        self.conn.commit()
+        self.log.info(f"Evicted {n_evicted} entries from response cache, size is now "
+                      f"{round(self.total_bytes / 1024 ** 2, 1)} MB.")
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total > 0 else 0.,
+                'size_bytes': self.total_bytes}
@@ -0,0 +1,343 @@
+import os
+import json
+import mmap
+import time
+import shutil
+from array import array
+from collections import Counter
+from typing import Dict, List, Iterable
+from src.utils import LoggingHandler
+
+SNAPSHOT_VERSION = 1
+
+
+def _csr(n: int, src: array) -> tuple:
+    """Counting sort of edges by source. :return: `indptr` (n + 1 offsets) and the edge order"""
+    indptr = array('q', bytes(8 * (n + 1)))
+    for s in src:
+        indptr[s + 1] += 1
+    for i in range(n):
+        indptr[i + 1] += indptr[i]
+    pos, order = array('q', indptr[:-1]), array('q', bytes(8 * len(src)))
+    for k, s in enumerate(src):
+        order[pos[s]] = k
+        pos[s] += 1
+    return indptr, order
+
+
+class _Interner:
+    def __init__(self, values: Iterable[str] = ()):
+        self.values = list()
+        self.ids = dict()
+        for value in values:
+            self.id(value)
+
+    def id(self, value: str) -> int:
+        i = self.ids.get(value)
+        if i is None:
+            i = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return i
+
+
+class _Strings:
+    """Memory-mapped string column: UTF-8 blob & `offsets`."""
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode("utf-8")
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class SnapshotBuilder(LoggingHandler):
+    """
+    Exports the KG layer into a columnar snapshot directory (see `Snapshot`) for in-process analytics:
+    - KG entities with dense integer ids, interned labels, names (and element ids, for refreshes);
+    - KG relationships as CSR adjacency (`indptr`, `indices`) with interned types & mention counts;
+    - mentions of entities by files (CSR by file) and `ExplainRelation` provenance (type, source, target, file).
+    The graph is read with streaming queries (`fetch_size` records per round-trip). A refresh reuses mentions &
+    provenance of files not re-projected since the previous snapshot (`_kg_built`) and reads only the changed ones.
+    """
+    QUERY_FILES = """MATCH (f:File)
+        WHERE f._kg_built IS NOT NULL
+        RETURN f.id AS file, f._kg_built AS built
+        """
+    QUERY_ENTITIES = """MATCH (n:KGEntity)
+        OPTIONAL MATCH (n)-[r]->(m:KGEntity)
+        RETURN elementId(n) AS id, [l IN labels(n) WHERE l <> "KGEntity"][0] AS label, n.name AS name,
+            collect(CASE WHEN m IS NULL THEN null ELSE [elementId(m), type(r), r.count] END) AS rels
+        """
+    QUERY_MENTIONS = """MATCH (f:File)-[m]->(n:KGEntity)
+        WHERE type(m) STARTS WITH "MENTIONS_" AND ($files IS NULL OR f.id IN $files)
+        RETURN f.id AS file, collect(elementId(n)) AS entities
+        """
+    QUERY_PROVENANCE = """MATCH (ex:ExplainRelation)-[:_FROM_DOC]->(f:File)
+        WHERE $files IS NULL OR f.id IN $files
+        // entities are merged on `name_normalized` (see `create_kg.txt`), `name` keeps the first spelling only
+        MATCH (n:KGEntity)-[:_EXPLAINED_BY]->(ex)
+        WITH ex, f, collect(n) AS nodes
+        RETURN ex.rel_type AS type, f.id AS file,
+            [n IN nodes WHERE n.name_normalized = toLower(ex.source) | elementId(n)][0] AS source,
+            [n IN nodes WHERE n.name_normalized = toLower(ex.target) | elementId(n)][0] AS target
+        """
+
+    def __init__(self, neo, fetch_size: int = 10000):
+        super().__init__(self)
+        self.neo = neo
+        self.fetch_size = fetch_size
+
+    def build(self, path: str, refresh: bool = True) -> dict:
+        """
+        Write a snapshot of the KG layer to directory `path` (replaced atomically once complete).
+        :param path: snapshot directory
+        :param refresh: reuse the existing snapshot at `path` for files not re-projected since it was taken; nothing
+        is written when no file changed
+        :return: snapshot metadata - counts, labels, relation types, `kg_built` watermark, build time & mode
+        """
+        t_start = time.time()
+        built = {x['file']: x['built'] for x in self.neo.stream_query(self.QUERY_FILES, fetch_size=self.fetch_size)}
+        previous = Snapshot(path) if refresh and os.path.exists(os.path.join(path, "meta.json")) else None
+        changed = list(built)
+        if previous is not None:
+            changed = [f for f, ts in built.items() if ts > previous.meta['kg_built']]
+            if not changed and set(built) == set(previous.files):
+                self.log.info(f"Snapshot {path} is up to date.")
+                meta = previous.meta
+                previous.close()
+                return {**meta, 'mode': "unchanged"}
+            if len(changed) > len(built) // 2:  # cheaper to read everything again
+                previous.close()
+                previous, changed = None, list(built)
+
+        # entities & relationships
+        ids, element_ids, names = dict(), list(), list()
+        node_label = array('i')
+        labels, types = _Interner(), _Interner()
+        src, dst, rel_type, rel_count = array('i'), array('i'), array('i'), array('i')
+
+        def node(element_id: str) -> int:
+            i = ids.get(element_id)
+            if i is None:
+                i = ids[element_id] = len(element_ids)
+                element_ids.append(element_id)
+                names.append("")
+                node_label.append(-1)
+            return i
+
+        for row in self.neo.stream_query(self.QUERY_ENTITIES, fetch_size=self.fetch_size):
+            i = node(row['id'])
+            node_label[i] = labels.id(row['label'] or "")
+            names[i] = row['name'] or ""
+            for target, t, count in row['rels']:
+                src.append(i)
+                dst.append(node(target))
+                rel_type.append(types.id(t))
+                rel_count.append(count or 0)
+        indptr, order = _csr(len(element_ids), src)
+
+        # mentions & provenance, of unchanged files copied from the previous snapshot
+        files = _Interner(sorted(built))
+        mention_file, mention_entity = array('i'), array('i')
+        prov = {name: array('i') for name in ['prov_type', 'prov_source', 'prov_target', 'prov_file']}
+        n_dropped, n_unresolved = 0, 0
+        if previous is not None:
+            keep = set(built) - set(changed)
+            old_ids = [ids.get(x, -1) for x in previous.element_ids]
+            for f_old, f in enumerate(previous.files):
+                if f not in keep:
+                    continue
+                for e in previous.file_entities(f_old):
+                    if old_ids[e] >= 0:
+                        mention_file.append(files.id(f))
+                        mention_entity.append(old_ids[e])
+            c = previous.columns
+            for k in range(len(c['prov_file'])):
+                f = previous.files[c['prov_file'][k]]
+                if f not in keep:
+                    continue
+                s, t = c['prov_source'][k], c['prov_target'][k]
+                if (s >= 0 and old_ids[s] < 0) or (t >= 0 and old_ids[t] < 0):
+                    n_dropped += 1
+                    continue
+                prov['prov_type'].append(types.id(previous.rel_types[c['prov_type'][k]]))
+                prov['prov_source'].append(old_ids[s] if s >= 0 else -1)
+                prov['prov_target'].append(old_ids[t] if t >= 0 else -1)
+                prov['prov_file'].append(files.id(f))
+            previous.close()
+
+        params = {'files': changed if previous is not None else None}
+        for row in self.neo.stream_query(self.QUERY_MENTIONS, params, fetch_size=self.fetch_size):
+            for e in row['entities']:
+                if e in ids:
+                    mention_file.append(files.id(row['file']))
+                    mention_entity.append(ids[e])
+        for row in self.neo.stream_query(self.QUERY_PROVENANCE, params, fetch_size=self.fetch_size):
+            prov['prov_type'].append(types.id(row['type']))
+            prov['prov_source'].append(ids.get(row['source'], -1))
+            prov['prov_target'].append(ids.get(row['target'], -1))
+            prov['prov_file'].append(files.id(row['file']))
+            n_unresolved += row['source'] not in ids or row['target'] not in ids
+        if n_unresolved:
+            self.log.warning(f"{n_unresolved} provenance rows with an endpoint not found in the KG layer (stored as -1).")
+        if n_dropped:
+            self.log.warning(f"Dropped {n_dropped} provenance rows of entities no longer in the KG layer.")
+        file_indptr, mention_order = _csr(len(files.values), mention_file)
+
+        columns = {'node_label': node_label, 'indptr': indptr,
+                   'indices': array('i', (dst[k] for k in order)),
+                   'rel_type': array('i', (rel_type[k] for k in order)),
+                   'rel_count': array('i', (rel_count[k] for k in order)),
+                   'file_indptr': file_indptr,
+                   'file_entities': array('i', (mention_entity[k] for k in mention_order)),
+                   **prov}
+        meta = {'version': SNAPSHOT_VERSION, 'created': time.time(),
+                'kg_built': max(built.values(), default=0),
+                'counts': {'entities': len(element_ids), 'relationships': len(src), 'files': len(files.values),
+                           'mentions': len(mention_file), 'provenance': len(prov['prov_file'])},
+                'labels': labels.values, 'rel_types': types.values,
+                'mode': "refresh" if previous is not None else "full", 'changed_files': len(changed)}
+        self._write(path, columns, {'names': names, 'element_ids': element_ids, 'files': files.values}, meta)
+        meta['seconds'] = time.time() - t_start
+        self.log.info(f"Snapshot ({meta['mode']}, {len(changed)} changed files) of {meta['counts']} written to "
+                      f"{path} in {round(meta['seconds'], 1)} sec.")
+        return meta
+
+    @staticmethod
+    def _write(path: str, columns: Dict[str, array], strings: Dict[str, List[str]], meta: dict):
+        tmp = path.rstrip("/") + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for name, values in columns.items():
+            with open(os.path.join(tmp, name + ".bin"), 'wb') as f:
+                values.tofile(f)
+        for name, values in strings.items():
+            offsets = array('q', [0])
+            with open(os.path.join(tmp, name + ".str"), 'wb') as f:
+                for value in values:
+                    data = value.encode("utf-8")
+                    f.write(data)
+                    offsets.append(offsets[-1] + len(data))
+            with open(os.path.join(tmp, name + ".offsets"), 'wb') as f:
+                offsets.tofile(f)
+        meta = {**meta, 'columns': {name: values.typecode for name, values in columns.items()},
+                'strings': list(strings)}
+        with open(os.path.join(tmp, "meta.json"), 'w') as f:
+            json.dump(meta, f, indent=1)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmp, path)
+
+
+class Snapshot:
+    """
+    Read-only, memory-mapped KG-layer snapshot written by `SnapshotBuilder`: columns are typed views of the mapped
+    files (only the touched pages are read), so graph-wide aggregations run in-process without Neo4j.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version {self.meta['version']} of {path}")
+        self._maps, self._views = list(), list()
+        self.columns = {name: self._map(name + ".bin", typecode) for name, typecode in self.meta['columns'].items()}
+        strings = {name: _Strings(self._map(name + ".offsets", 'q'), self._map(name + ".str", 'B'))
+                   for name in self.meta['strings']}
+        self.names, self.element_ids, self.files = strings['names'], strings['element_ids'], strings['files']
+        self.labels, self.rel_types = self.meta['labels'], self.meta['rel_types']
+
+    def _map(self, name: str, typecode: str):
+        path = os.path.join(self.path, name)
+        if os.path.getsize(path) == 0:
+            return array(typecode)
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mm)
+        view = memoryview(mm).cast(typecode)
+        self._views.append(view)
+        return view
+
+    def close(self):
+        for view in self._views:
+            view.release()
+        for mm in self._maps:
+            mm.close()
+        self._views, self._maps = list(), list()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def n_entities(self) -> int:
+        return self.meta['counts']['entities']
+
+    def neighbors(self, i: int) -> List[tuple]:
+        """:return: (target entity, relation type, count) of the outgoing relationships of entity `i`"""
+        c = self.columns
+        return [(c['indices'][k], self.rel_types[c['rel_type'][k]], c['rel_count'][k])
+                for k in range(c['indptr'][i], c['indptr'][i + 1])]
+
+    def file_entities(self, f: int):
+        c = self.columns
+        return c['file_entities'][c['file_indptr'][f]:c['file_indptr'][f + 1]]
+
+    def degrees(self) -> array:
+        """:return: number of relationships (in & out) of every entity"""
+        indptr = self.columns['indptr']
+        degrees = array('q', (indptr[i + 1] - indptr[i] for i in range(self.n_entities)))
+        for j in self.columns['indices']:
+            degrees[j] += 1
+        return degrees
+
+    def degree_stats(self) -> dict:
+        degrees = sorted(self.degrees())
+        if not degrees:
+            return {'entities': 0}
+        return {'entities': len(degrees), 'isolated': sum(1 for d in degrees if d == 0),
+                'mean': sum(degrees) / len(degrees), 'max': degrees[-1],
+                **{f"p{q}": degrees[min(len(degrees) - 1, len(degrees) * q // 100)] for q in [50, 90, 99]}}
+
+    def relation_type_histogram(self, weighted: bool = False) -> Dict[str, int]:
+        """:return: number of relationships per type; with `weighted`, number of their mentions (`count`)"""
+        histogram = Counter()
+        if weighted:
+            for t, count in zip(self.columns['rel_type'], self.columns['rel_count']):
+                histogram[t] += count
+        else:
+            histogram.update(self.columns['rel_type'])
+        return {self.rel_types[t]: n for t, n in histogram.most_common()}
+
+    def label_histogram(self) -> Dict[str, int]:
+        return {self.labels[x]: n for x, n in Counter(self.columns['node_label']).most_common()}
+
+    def mentions_per_file(self) -> Dict[str, int]:
+        """:return: number of KG entities mentioned by each file"""
+        indptr = self.columns['file_indptr']
+        return {self.files[f]: indptr[f + 1] - indptr[f] for f in range(len(self.files))}
+
+    def entity_mentions(self) -> array:
+        """:return: number of files mentioning each entity"""
+        mentions = array('q', bytes(8 * self.n_entities))
+        for e in self.columns['file_entities']:
+            mentions[e] += 1
+        return mentions
+
+    def top_entities(self, k: int = 10, by: str = "mentions") -> List[tuple]:
+        """:return: (name, label, value) of the `k` entities with most file mentions (`by="mentions"`) or relations"""
+        values = self.entity_mentions() if by == "mentions" else self.degrees()
+        top = sorted(range(self.n_entities), key=lambda i: -values[i])[:k]
+        return [(self.names[i], self.labels[self.columns['node_label'][i]], values[i]) for i in top]
+
+    def provenance_per_file(self) -> Dict[str, int]:
+        """:return: number of `ExplainRelation` provenance records per file"""
+        return {self.files[f]: n for f, n in Counter(self.columns['prov_file']).most_common()}
@@ -0,0 +1,61 @@
+import re
+import math
+from typing import List, Tuple
+from collections import Counter
+from src.utils import LoggingHandler, estimate_tokens
+
+_SPACES = re.compile(r"[ \t\f\v\u00a0]+")
+_BLANK_LINES = re.compile(r"\n{3,}")
+_DIGITS = re.compile(r"\d+")
+
+
+class TextCleaner(LoggingHandler):
+    """
+    Reduces OCR text before it is sent to the LLM: collapses runs of whitespace and strips boilerplate - lines
+    (letterheads, stamps, headers & footers) repeated on at least `min_ratio` of the pages of a document. Lines are
+    compared case-insensitively, short ones (up to `max_masked_length` characters) with numbers masked, so that e.g.
+    `Page 3 of 12` counts as repeated while body lines differing in numbers don't.
+    """
+    def __init__(self, min_pages: int = 2, min_ratio: float = 0.5, max_line_length: int = 200,
+                 max_masked_length: int = 40):
+        super().__init__(self)
+        self.max_masked_length = max_masked_length
+        self.min_pages = min_pages
+        self.min_ratio = min_ratio
+        self.max_line_length = max_line_length
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Collapse whitespace within lines and runs of empty lines (paragraph breaks are kept)."""
+        lines = [_SPACES.sub(" ", line).strip() for line in text.replace("\r\n", "\n").replace("\r", "\n").split("\n")]
+        return _BLANK_LINES.sub("\n\n", "\n".join(lines)).strip()
+
+    def line_key(self, line: str) -> str:
+        line = line.lower()
+        return _DIGITS.sub("#", line) if len(line) <= self.max_masked_length else line
+
+    def clean(self, pages: List[str]) -> Tuple[List[str], dict]:
+        """
+        :param pages: texts of document pages, in order
+        :return: cleaned pages and stats: `tokens_raw`, `tokens_clean`, `boilerplate_lines` (removed lines)
+        """
+        normalized = [self.normalize(p or "") for p in pages]
+        boilerplate = set()
+        if len(pages) >= self.min_pages:
+            counts = Counter(key for page in normalized
+                             for key in set(self.line_key(line) for line in page.split("\n")
+                                            if line and len(line) <= self.max_line_length))
+            threshold = max(2, math.ceil(self.min_ratio * len(pages)))
+            boilerplate = {key for key, n in counts.items() if n >= threshold}
+
+        cleaned, n_removed = list(), 0
+        for page in normalized:
+            lines = page.split("\n")
+            kept = [line for line in lines if not line or self.line_key(line) not in boilerplate]
+            n_removed += len(lines) - len(kept)
+            cleaned.append(_BLANK_LINES.sub("\n\n", "\n".join(kept)).strip())
+
+        stats = {'tokens_raw': sum(estimate_tokens(p) for p in pages if p),
+                 'tokens_clean': sum(estimate_tokens(p) for p in cleaned),
+                 'boilerplate_lines': n_removed}
+        return cleaned, stats
@@ -1,7 +1,24 @@
 import os
 import logging
 
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding("cl100k_base")
+except ImportError:
+    _ENCODING = None
+
 
 class LoggingHandler:
     def __init__(self, *args, **kwargs):
         self.log = logging.getLogger(self.__class__.__name__)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Number of tokens of given text: exact when `tiktoken` is installed, otherwise ~4 characters per token.
+    """
+    if not text:
+        return 0
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
@@ -0,0 +1,197 @@
+import os
+import time
+import random
+import socket
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import List, Dict
+from src.utils import LoggingHandler
+from src.metrics import in_context
+from src.neo4jWriter import Neo4jWriter
+
+PENDING, LEASED, DONE, FAILED = "pending", "leased", "done", "failed"
+
+
+class WorkQueue(LoggingHandler):
+    """
+    Durable extraction job queue kept in the graph itself, on the document nodes (`_job_state`, `_job_attempts`,
+    `_job_worker`, `_job_lease_until`, `_job_error`), so any number of worker processes on any number of machines
+    can pull from the same corpus without overlap.
+    A job is `pending` until a worker leases it; the lease expires after `lease_seconds` (a crashed worker's jobs
+    become available again) unless renewed by the worker's heartbeat. A finished job is `done`; a failed one goes
+    back to `pending` until it has been attempted `max_attempts` times, then it is `failed` - the dead-letter list.
+    Leasing locks the candidate nodes and re-checks their state, so two workers never lease the same job; candidates
+    are drawn at random from a window of available jobs, so that concurrent workers rarely contend for the same ones.
+    Lease times use the DB clock, so worker clocks don't matter.
+    """
+    QUERY_ENQUEUE = """UNWIND $ids AS id
+        MATCH (n:{label})
+        WHERE elementId(n) = id AND (n._job_state IS NULL OR $requeue)
+        SET n._job_state = "pending", n._job_attempts = 0, n._job_enqueued = timestamp()
+        REMOVE n._job_error, n._job_worker, n._job_lease_until
+        RETURN count(n) AS n
+        """
+    # leases which expired too many times (e.g. a document crashing its workers) go to the dead-letter list
+    QUERY_REAP = """MATCH (n:{label} {{_job_state: "leased"}})
+        WHERE n._job_lease_until < timestamp() AND n._job_attempts >= $max_attempts
+        SET n._job_state = "failed", n._job_error = coalesce(n._job_error, "Lease expired")
+        """
+    QUERY_LEASE = """MATCH (n:{label})
+        WHERE n._job_state = "pending" OR (n._job_state = "leased" AND n._job_lease_until < timestamp())
+        WITH n LIMIT $window
+        WITH n ORDER BY rand() LIMIT $limit
+        SET n._job_lock = true
+        WITH n
+        WHERE n._job_state = "pending" OR (n._job_state = "leased" AND n._job_lease_until < timestamp())
+        SET n._job_state = "leased", n._job_worker = $worker, n._job_lease_until = timestamp() + $lease_ms,
+            n._job_attempts = coalesce(n._job_attempts, 0) + 1
+        REMOVE n._job_lock
+        RETURN elementId(n) AS element_id
+        """
+    # jobs a lease can still get (expired leases past `max_attempts` are reaped instead)
+    QUERY_AVAILABLE = """MATCH (n:{label})
+        WHERE n._job_state = "pending" OR
+              (n._job_state = "leased" AND n._job_lease_until < timestamp() AND n._job_attempts < $max_attempts)
+        RETURN count(n) AS n
+        """
+    QUERY_RENEW = """MATCH (n:{label} {{_job_state: "leased", _job_worker: $worker}})
+        SET n._job_lease_until = timestamp() + $lease_ms
+        RETURN count(n) AS n
+        """
+    QUERY_FINISH = """UNWIND $rows AS row
+        MATCH (n:{label})
+        WHERE elementId(n) = row.element_id
+        SET n._job_state = CASE WHEN row.error IS NULL THEN "done"
+                                WHEN n._job_attempts >= $max_attempts THEN "failed"
+                                ELSE "pending" END,
+            n._job_error = row.error,
+            n._job_finished = timestamp()
+        REMOVE n._job_worker, n._job_lease_until
+        """
+    QUERY_STATS = """MATCH (n:{label})
+        WHERE n._job_state IS NOT NULL
+        RETURN n._job_state AS state, count(*) AS n
+        """
+    QUERY_DEAD_LETTERS = """MATCH (n:{label} {{_job_state: "failed"}})
+        RETURN elementId(n) AS element_id, n._job_attempts AS attempts, n._job_error AS error
+        LIMIT $limit
+        """
+    QUERY_REQUEUE_FAILED = """MATCH (n:{label} {{_job_state: "failed"}})
+        SET n._job_state = "pending", n._job_attempts = 0
+        REMOVE n._job_error
+        RETURN count(n) AS n
+        """
+
+    def __init__(self, neo: Neo4jWriter, label: str = "File", lease_seconds: float = 900., max_attempts: int = 3,
+                 worker_id: str = None):
+        """
+        :param neo: Neo4j writer
+        :param label: label of the document nodes
+        :param lease_seconds: how long a leased job is reserved for its worker without a heartbeat
+        :param max_attempts: attempts of a job before it is moved to the dead-letter list
+        :param worker_id: unique id of this worker, host, process & random suffix if None
+        """
+        super().__init__(self)
+        self.neo = neo
+        self.label = label
+        self.lease_ms = int(lease_seconds * 1000)
+        self.max_attempts = max_attempts
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    def _query(self, query: str) -> str:
+        return query.format(label=self.label)
+
+    def initialise_index(self):
+        self.neo.run_simple_query(f"CREATE INDEX {self.label.lower()}_job_state IF NOT EXISTS "
+                                  f"FOR (n:{self.label}) ON (n._job_state)")
+
+    def enqueue(self, element_ids: List[str], requeue: bool = False) -> int:
+        """
+        :param element_ids: documents to add
+        :param requeue: reset documents already in the queue (incl. done & failed ones) to pending
+        :return: number of documents enqueued
+        """
+        res = self.neo.run_write_query(self._query(self.QUERY_ENQUEUE), {'ids': element_ids, 'requeue': requeue})
+        return res[0]['n'] if res else 0
+
+    def lease(self, limit: int, window: int = 10) -> List[str]:
+        """
+        :param limit: max jobs to lease
+        :param window: candidates are drawn from `window * limit` available jobs
+        :return: element ids of up to `limit` jobs leased by this worker, empty list when none is available; a lease
+        that lost all its candidates to other workers is re-tried while jobs are available
+        """
+        params = {'limit': limit, 'window': window * limit, 'worker': self.worker_id, 'lease_ms': self.lease_ms,
+                  'max_attempts': self.max_attempts}
+        while True:
+            res = self.neo.run_multi_queries([{'query': self._query(self.QUERY_REAP), 'data': params},
+                                              {'query': self._query(self.QUERY_LEASE), 'data': params}])
+            if res[1] or self.available() == 0:
+                return [x['element_id'] for x in res[1]]
+            self.log.debug("Lease candidates taken by other workers, re-trying.")
+            time.sleep(random.uniform(0., 0.1))
+
+    def available(self) -> int:
+        """:return: number of jobs which can be leased (pending or with an expired lease)"""
+        res = self.neo.run_simple_query(self._query(self.QUERY_AVAILABLE), {'max_attempts': self.max_attempts})
+        return res[0]['n'] if res else 0
+
+    def renew(self) -> int:
+        """Extend the leases of all jobs held by this worker. :return: number of renewed leases"""
+        res = self.neo.run_write_query(self._query(self.QUERY_RENEW),
+                                       {'worker': self.worker_id, 'lease_ms': self.lease_ms})
+        return res[0]['n'] if res else 0
+
+    @contextmanager
+    def heartbeat(self, interval: float = None):
+        """Renew this worker's leases every `interval` seconds (a third of the lease time by default) in a thread."""
+        stop = threading.Event()
+        interval = interval if interval is not None else max(self.lease_ms / 3000, 1.)
+
+        def beat():
+            while not stop.wait(interval):
+                try:
+                    self.renew()
+                except Exception as e:
+                    self.log.warning(f"Lease renewal failed: {e}")
+
+        thread = threading.Thread(target=in_context(beat), daemon=True, name="lease-heartbeat")
+        thread.start()
+        try:
+            yield self
+        finally:
+            stop.set()
+            thread.join()
+
+    def finish_query(self, rows: List[Dict]) -> dict:
+        """
+        Query marking jobs as finished, to be run in the transaction storing their results.
+        :param rows: dicts with `element_id` and `error` (None on success)
+        """
+        return {'query': self._query(self.QUERY_FINISH), 'data': {'rows': rows, 'max_attempts': self.max_attempts}}
+
+    def complete(self, element_ids: List[str]):
+        q = self.finish_query([{'element_id': x, 'error': None} for x in element_ids])
+        self.neo.run_write_query(q['query'], q['data'])
+
+    def fail(self, element_id: str, error: str):
+        """Record a failed attempt: the job is re-tried, or moved to the dead-letter list after `max_attempts`."""
+        q = self.finish_query([{'element_id': element_id, 'error': str(error)}])
+        self.neo.run_write_query(q['query'], q['data'])
+
+    def stats(self) -> Dict[str, int]:
+        """:return: number of jobs per state"""
+        counts = {state: 0 for state in [PENDING, LEASED, DONE, FAILED]}
+        for x in self.neo.run_simple_query(self._query(self.QUERY_STATS)):
+            counts[x['state']] = x['n']
+        return counts
+
+    def dead_letters(self, limit: int = 1000) -> List[Dict]:
+        """:return: failed jobs - element id, attempts & last error"""
+        return self.neo.run_simple_query(self._query(self.QUERY_DEAD_LETTERS), {'limit': limit})
+
+    def requeue_failed(self) -> int:
+        """Give the dead-letter jobs another `max_attempts` attempts. :return: number of requeued jobs"""
+        res = self.neo.run_write_query(self._query(self.QUERY_REQUEUE_FAILED))
+        return res[0]['n'] if res else 0
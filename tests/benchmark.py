@@ -0,0 +1,225 @@
+"""
+End-to-end pipeline benchmark on a synthetic corpus, with a local fake LLM and (by default) an in-process stand-in
+of Neo4j, so it runs anywhere. Times crawling, parsing, ingestion, extraction, Cypher generation and KG layer
+creation separately and writes a JSON report (to the temp directory unless `--output` is given).
+
+Run from the `tests` directory:
+    PYTHONPATH=.. python benchmark.py --files 500 --pages 5 --llm-latency 0.2 --output /tmp/benchmark_report.json
+Add `--neo4j` to run against the Neo4j DB configured by the environment variables (see README) instead of the
+stand-in; this writes the synthetic corpus to that DB. KG layer creation runs entirely in Neo4j, so it is only
+measured with `--neo4j` (reported as not measured otherwise).
+"""
+import os
+import sys
+import copy
+import json
+import time
+import random
+import logging
+import platform
+import resource
+import argparse
+import threading
+import tempfile
+import subprocess
+from fake_openai import FakeOpenAI
+from src.kg import KnowledgeGraph
+from src.bulkExporter import BulkExporter
+from src.dataLoader import DataLoader
+from src.neo4jWriter import Neo4jWriter
+
+VOCABULARY = ("the of and to in for on with by at from as that this is was were be has have which plant "
+              "facility discharge groundwater sampling permit compliance inspection waste ash sludge resin "
+              "contamination remediation agency department environmental protection chemical lead mercury "
+              "PFOA PFAS fluorochemicals DuPont Chemours 3M Minnesota New Jersey Pompton Lakes Repauno "
+              "report letter directive order consent complaint court exhibit site soil water river lake").split()
+
+
+def generate_corpus(root: str, n_files: int, pages: int, depth: int, branching: int, words: int,
+                    seed: int = 42) -> dict:
+    """
+    Write a synthetic OCR-style JSON corpus: a directory tree `depth` levels deep with `branching` subdirectories
+    per level, files spread over the leaf directories, each with `pages` pages of `words` words (with per-word
+    boxes, like the real OCR output).
+    :return: corpus statistics
+    """
+    rnd = random.Random(seed)
+    leaves = [root]
+    for level in range(depth):
+        leaves = [os.path.join(d, f"dir_{level}_{i}") for d in leaves for i in range(branching)]
+    n_bytes = 0
+    for i in range(n_files):
+        directory = leaves[i % len(leaves)]
+        os.makedirs(directory, exist_ok=True)
+        content = list()
+        for n in range(1, pages + 1):
+            tokens = [rnd.choice(VOCABULARY) for _ in range(words)]
+            text = f"CONFIDENTIAL - Case No. 12-345\n{' '.join(tokens)}\nPage {n} of {pages}"
+            content.append({'pageNumber': n, 'id': f"{i}-{n}", 'text': text,
+                            'meta': {'width': 2550, 'height': 3300, 'confidence': round(rnd.random(), 3)},
+                            'words': [{'text': t, 'confidence': 0.9, 'boundingBox': [k, 10, k + 40, 30]}
+                                      for k, t in enumerate(tokens)]})
+        path = os.path.join(directory, f"document_{i}.json")
+        with open(path, 'w') as f:
+            json.dump(content, f)
+        n_bytes += os.path.getsize(path)
+    return {'files': n_files, 'pages': n_files * pages, 'bytes': n_bytes, 'leaf_directories': len(leaves)}
+
+
+class InMemoryGraph:
+    """
+    In-process stand-in of `Neo4jWriter`: keeps ingested pages in memory and only counts the rest, so the
+    benchmark measures the client-side cost of the pipeline. Stages whose work is done by Neo4j itself (KG layer
+    creation) can't be run on it.
+    """
+    def __init__(self):
+        self.files = dict()
+        self.extracted = set()
+        self.statements, self.rows, self.entities, self.relations = 0, 0, 0, 0
+        self.lock = threading.Lock()  # concurrent ingestion writers
+
+    def close(self):
+        pass
+
+    def write_batch(self, query: str, rows: list, db: str = None) -> dict:
+        with self.lock:
+            self.statements += 1
+            self.rows += len(rows)
+            for row in rows:
+                if 'pages' in row:
+                    self.files[row['id']] = [p['others'].get('text', "") for p in row['pages']]
+        return dict()
+
+    def run_simple_query(self, query: str, data: dict = None, db: str = None) -> list:
+        self.statements += 1
+        data = data or dict()
+        if 'entities' in data:
+            self.entities += len(data['entities'])
+            self.extracted.add(data['element_id'])
+        if 'relations' in data:
+            self.relations += len(data['relations'])
+        if 'limit' in data:
+            return [{'n_deleted': 0}]
+        if "_duplicate_of" in query:
+            return list()
+        if "AS id" in query:
+            return [{'id': x} for x in self.extracted]
+        return list()
+
+    run_write_query = run_simple_query
+
+    def run_multi_queries(self, queries: list, db: str = None) -> list:
+        return [self.run_simple_query(q['query'], q['data']) for q in queries]
+
+    def stream_query(self, query: str, data: dict = None, db: str = None, fetch_size: int = 1000):
+        self.statements += 1
+        for file_id, pages in list(self.files.items()):
+            yield {'element_id': file_id, 'pages': pages}
+
+    def paginate_query(self, query: str, data: dict = None, db: str = None, page_size: int = 1000,
+                       key: str = 'element_id'):
+        yield from self.stream_query(query, data)
+
+
+class Stages:
+    def __init__(self):
+        self.report = dict()
+
+    def run(self, name: str, items: int, fn, *args, **kwargs):
+        logging.getLogger("Benchmark").info(f"Stage `{name}` ...")
+        t_start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        seconds = time.perf_counter() - t_start
+        self.report[name] = {'seconds': round(seconds, 4), 'items': items,
+                             'items_per_sec': round(items / seconds, 2) if seconds > 0 else None}
+        return result
+
+    def skip(self, name: str, reason: str):
+        logging.getLogger("Benchmark").info(f"Stage `{name}` not measured: {reason}")
+        self.report[name] = {'measured': False, 'reason': reason}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--pages", type=int, default=5, help="pages per file")
+    parser.add_argument("--words", type=int, default=300, help="words per page")
+    parser.add_argument("--depth", type=int, default=3, help="directory tree depth")
+    parser.add_argument("--branching", type=int, default=3, help="subdirectories per directory")
+    parser.add_argument("--llm-latency", type=float, default=0.1, help="fake LLM response time (sec)")
+    parser.add_argument("--concurrency", type=int, default=8, help="parallel LLM calls")
+    parser.add_argument("--rpm", type=int, default=10 ** 6, help="LLM requests/min limit")
+    parser.add_argument("--tpm", type=int, default=10 ** 9, help="LLM tokens/min limit")
+    parser.add_argument("--batch-size", type=int, default=200, help="ingestion batch size (rows)")
+    parser.add_argument("--workers", type=int, default=None, help="file parsing processes (default: CPU cores)")
+    parser.add_argument("--writers", type=int, default=1, help="ingestion writer threads")
+    parser.add_argument("--model", default="gpt-4")
+    parser.add_argument("--prompt", default="generic_v4")
+    parser.add_argument("--neo4j", action="store_true", help="use the Neo4j DB from the environment")
+    parser.add_argument("--output", default=os.path.join(tempfile.gettempdir(), "benchmark_report.json"),
+                        help="JSON report path (default: in the temp directory)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(name)s - %(levelname)s: %(message)s")
+    logging.getLogger("Benchmark").setLevel(logging.INFO)
+    os.environ.setdefault('OPENAI_API_KEY', "sk-benchmark")
+    with open(os.path.join("resources", "prompts", args.prompt + "_example_output.txt")) as f:
+        llm_output = f.read()
+    with open(os.path.join("resources", "gpt_output.json")) as f:
+        gpt_output = json.load(f)
+
+    stages = Stages()
+    with tempfile.TemporaryDirectory() as tmp, FakeOpenAI(llm_output, latency=args.llm_latency) as api:
+        os.environ['OPENAI_BASE_URL'] = api.base_url
+        data_dir = os.path.join(tmp, "corpus")
+        corpus = stages.run("generate_corpus", args.files, generate_corpus, data_dir, args.files, args.pages,
+                            args.depth, args.branching, args.words)
+
+        loader = DataLoader.from_path(data_dir)
+        files = stages.run("crawl", args.files, lambda: list(loader.iter_files()))
+        stages.run("parse", corpus['pages'], lambda: [loader.build_file_payload(f) for f in files])
+        stages.run("parse_pool", corpus['pages'], lambda: list(loader.iter_payloads(files, args.workers)))
+        stages.run("bulk_export", args.files, BulkExporter(os.path.join(tmp, "import")).export, data_dir,
+                   args.workers)
+
+        neo = Neo4jWriter('neo4j') if args.neo4j else InMemoryGraph()
+        with KnowledgeGraph('neo4j', "resources", neo=neo) as kg:
+            stages.run("ingest", args.files, kg.ingest_data, data_dir, args.batch_size, workers=args.workers,
+                       writers=args.writers)
+
+            data_query = f"""MATCH (f:File)-[:CONTAINS_PAGE]->(p:Page)
+            WHERE f.id STARTS WITH {json.dumps(data_dir)} AND NOT f:LLMProcessed
+            WITH f, p ORDER BY p.pageNumber
+            RETURN elementId(f) AS element_id, collect(p.text) AS pages
+            """
+            stages.run("extract", args.files, kg.extract_knowledge, data_query, args.model, args.prompt, 2000,
+                       args.concurrency, {args.model: {'rpm': args.rpm, 'tpm': args.tpm}})
+            outputs = [copy.deepcopy(gpt_output) for _ in range(args.files)]
+            stages.run("generate_cypher", args.files,
+                       lambda: [kg.generate_cypher(str(i), x) for i, x in enumerate(outputs)])
+            if args.neo4j:
+                stages.run("create_knowledge_layer", args.files, kg.create_knowledge_layer)
+            else:
+                stages.skip("create_knowledge_layer", "runs in Neo4j, the in-process stand-in can't execute it")
+            metrics = kg.export_metrics()
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    report = {'config': vars(args), 'corpus': corpus, 'stages': stages.report,
+              'llm_requests': api.requests,
+              'graph': {'statements': neo.statements, 'rows': neo.rows, 'entities': neo.entities,
+                        'relations': neo.relations} if isinstance(neo, InMemoryGraph) else None,
+              'metrics': metrics,
+              'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+              'environment': {'python': sys.version.split()[0], 'platform': platform.platform(),
+                              'cpus': os.cpu_count(), 'commit': commit}}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report['stages'], indent=2))
+    print(f"Report written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+import os
+import json
+import time
+import threading
+from unittest import mock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+def use_fake_api_key(test):
+    """Set a fake `OPENAI_API_KEY` (the client requires one) for the duration of a test, from its `setUp`."""
+    patcher = mock.patch.dict(os.environ, {'OPENAI_API_KEY': "sk-test"})
+    patcher.start()
+    test.addCleanup(patcher.stop)
+
+
+class FakeOpenAI:
+    """
+    Local stand-in of the OpenAI-compatible HTTP API (chat completions, and files & batches of the Batch API) for
+    tests & benchmarks. A batch is answered at once, it reports `in_progress` for its first `batch_polls` retrievals.
+    Usage: `with FakeOpenAI(content) as api: OpenAIQuery(..., base_url=api.base_url)`
+    :param content: assistant reply; string or function `content(messages) -> str`, the function may also return
+    a (content, finish_reason) tuple, e.g. to simulate output cut off at `max_tokens` ("length"); bodies of the
+    chat completion requests are kept in `bodies`
+    :param latency: seconds to wait before replying
+    :param rate_limit_first: number of first requests answered with HTTP 429
+    :param retry_after: value of `Retry-After` header sent with 429
+    :param fail_first: number of first requests (after the rate limited ones) answered with HTTP 500
+    :param batch_polls: number of retrievals of a batch before it is `completed`
+    """
+    def __init__(self, content, latency: float = 0., rate_limit_first: int = 0, retry_after: float = 0.1,
+                 batch_polls: int = 1, fail_first: int = 0):
+        self.content = content
+        self.latency = latency
+        self.rate_limit_first = rate_limit_first
+        self.retry_after = retry_after
+        self.requests = 0
+        self.bodies = list()
+        self.rate_limited = 0
+        self.fail_first = fail_first
+        self.failed = 0
+        self.active = 0
+        self.max_active = 0
+        self.batch_polls = batch_polls
+        self.files = dict()
+        self.batches = dict()
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+        self.thread = None
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def chat_completion(self, body: dict) -> dict:
+        content = self.content(body['messages']) if callable(self.content) else self.content
+        content, finish_reason = content if isinstance(content, tuple) else (content, "stop")
+        prompt_tokens = sum(len(m['content']) // 4 for m in body['messages'])
+        return {'id': f"chatcmpl-{self.requests}", 'object': "chat.completion", 'created': int(time.time()),
+                'model': body['model'],
+                'choices': [{'index': 0, 'message': {'role': "assistant", 'content': content},
+                             'finish_reason': finish_reason}],
+                'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': len(content) // 4,
+                          'total_tokens': prompt_tokens + len(content) // 4}
+                }
+
+    def create_file(self, content: bytes, filename: str, purpose: str) -> dict:
+        file = {'id': f"file-{len(self.files)}", 'object': "file", 'bytes': len(content),
+                'created_at': int(time.time()), 'filename': filename, 'purpose': purpose, 'status': "processed"}
+        self.files[file['id']] = (file, content)
+        return file
+
+    def create_batch(self, body: dict) -> dict:
+        outputs, errors = list(), list()
+        for line in self.files[body['input_file_id']][1].decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            try:
+                completion = self.chat_completion(request['body'])
+            except Exception as e:  # `content` function failing = request failed
+                errors.append(json.dumps({'id': f"batch_req_e{len(errors)}", 'custom_id': request['custom_id'],
+                                          'response': None, 'error': {'code': "server_error", 'message': str(e)}}))
+                continue
+            outputs.append(json.dumps({'id': f"batch_req_{len(outputs)}", 'custom_id': request['custom_id'],
+                                       'response': {'status_code': 200, 'request_id': completion['id'],
+                                                    'body': completion},
+                                       'error': None}))
+        batch = {'id': f"batch_{len(self.batches)}", 'object': "batch", 'endpoint': body['endpoint'],
+                 'input_file_id': body['input_file_id'], 'completion_window': body['completion_window'],
+                 'status': "in_progress", 'created_at': int(time.time()), 'errors': None,
+                 'output_file_id': self.create_file("\n".join(outputs).encode("utf-8"), "output.jsonl",
+                                                    "batch_output")['id'],
+                 'error_file_id': self.create_file("\n".join(errors).encode("utf-8"), "errors.jsonl",
+                                                   "batch_output")['id'] if errors else None,
+                 'request_counts': {'total': len(outputs) + len(errors), 'completed': len(outputs),
+                                    'failed': len(errors)},
+                 '_polls': 0}
+        self.batches[batch['id']] = batch
+        return self._public(batch)
+
+    def retrieve_batch(self, batch_id: str) -> dict:
+        batch = self.batches[batch_id]
+        batch['_polls'] += 1
+        if batch['_polls'] > self.batch_polls:
+            batch['status'] = "completed"
+        return self._public(batch)
+
+    @staticmethod
+    def _public(batch: dict) -> dict:
+        out = {k: v for k, v in batch.items() if not k.startswith("_")}
+        if out['status'] != "completed":
+            out['output_file_id'] = None
+        return out
+
+    @staticmethod
+    def _multipart_file(body: bytes, content_type: str) -> tuple:
+        """:return: (content, filename, purpose) of a multipart/form-data file upload"""
+        boundary = content_type.split("boundary=")[-1].strip('"').encode("utf-8")
+        fields, content, filename = dict(), b"", "upload.jsonl"
+        for part in body.split(b"--" + boundary):
+            if b"\r\n\r\n" not in part:
+                continue
+            head, value = part.split(b"\r\n\r\n", 1)
+            value = value[:-2] if value.endswith(b"\r\n") else value
+            head = head.decode("utf-8")
+            name = head.split('name="')[1].split('"')[0]
+            if 'filename="' in head:
+                filename, content = head.split('filename="')[1].split('"')[0], value
+            else:
+                fields[name] = value.decode("utf-8")
+        return content, filename, fields.get('purpose')
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status: int, payload: dict, headers: dict = None):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for key, val in (headers or dict()).items():
+                    self.send_header(key, val)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path.startswith("/v1/batches/") and self.path.split("/")[-1] in fake.batches:
+                    with fake.lock:
+                        self._reply(200, fake.retrieve_batch(self.path.split("/")[-1]))
+                elif self.path.endswith("/content") and self.path.split("/")[-2] in fake.files:
+                    content = fake.files[self.path.split("/")[-2]][1]
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/octet-stream")
+                    self.send_header("Content-Length", str(len(content)))
+                    self.end_headers()
+                    self.wfile.write(content)
+                else:
+                    self._reply(404, {'error': {'message': f"Unknown path {self.path}"}})
+
+            def do_POST(self):
+                raw = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.path.endswith("/files"):
+                    with fake.lock:
+                        self._reply(200, fake.create_file(*fake._multipart_file(raw, self.headers["Content-Type"])))
+                    return
+                if self.path.endswith("/batches"):
+                    with fake.lock:
+                        self._reply(200, fake.create_batch(json.loads(raw)))
+                    return
+                body = json.loads(raw or b"{}")
+                with fake.lock:
+                    fake.requests += 1
+                    fake.bodies.append(body)
+                    limited = fake.rate_limited < fake.rate_limit_first
+                    if limited:
+                        fake.rate_limited += 1
+                    failing = not limited and fake.failed < fake.fail_first
+                    if failing:
+                        fake.failed += 1
+                    fake.active += 1
+                    fake.max_active = max(fake.max_active, fake.active)
+                try:
+                    if limited:
+                        self._reply(429, {'error': {'message': "Rate limit reached", 'type': "requests"}},
+                                    {'Retry-After': str(fake.retry_after)})
+                    elif failing:
+                        self._reply(500, {'error': {'message': "The server had an error", 'type': "server_error"}})
+                    elif self.path.endswith("/chat/completions"):
+                        time.sleep(fake.latency)
+                        self._reply(200, fake.chat_completion(body))
+                    else:
+                        self._reply(404, {'error': {'message': f"Unknown path {self.path}"}})
+                finally:
+                    with fake.lock:
+                        fake.active -= 1
+
+        return Handler
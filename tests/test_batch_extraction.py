@@ -0,0 +1,91 @@
+import os
+import tempfile
+import unittest
+import logging
+from fake_openai import FakeOpenAI, use_fake_api_key
+from src.kg import KnowledgeGraph
+from src.openaiQuery import OpenAIQuery
+from src.batchExtraction import BatchExtractor
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s: %(message)s")
+
+
+class FakeNeo:
+    """Returns given documents to the data query and records written queries instead of sending them to Neo4j."""
+    def __init__(self, docs: list):
+        self.docs = docs
+        self.written = list()
+
+    def run_simple_query(self, query, data=None, db=None):
+        return list()
+
+    def stream_query(self, query, data=None, db=None, fetch_size=1000):
+        yield from self.docs
+
+    def write_batch(self, query, rows, db=None):
+        self.written += [{'query': query, 'data': row} for row in rows]
+        return dict()
+
+    def run_multi_queries(self, queries, db=None):
+        self.written += queries
+        return [list() for _ in queries]
+
+    def close(self):
+        pass
+
+
+class TestBatchExtraction(unittest.TestCase):
+    def setUp(self):
+        use_fake_api_key(self)
+        with open("resources/prompts/generic_v4_example_output.txt") as f:
+            self.gpt_output = f.read()
+        self.docs = [{'element_id': "4:f:1", 'pages': ["First document. " * 20]},
+                     {'element_id': "4:f:2", 'pages': ["Too short."]},
+                     {'element_id': "4:f:3", 'pages': ["FAIL this document. " * 20]},
+                     {'element_id': "4:f:4", 'pages': [f"Page {i} of a long document. " * 600 for i in range(4)]}]
+
+    def content(self, messages):
+        if messages[-1]['content'].startswith("FAIL"):
+            raise ValueError("Model overloaded")
+        return self.gpt_output
+
+    def test_submit_poll_collect(self):
+        neo = FakeNeo(self.docs)
+        with tempfile.TemporaryDirectory() as tmp, FakeOpenAI(self.content, batch_polls=2) as api:
+            os.environ['OPENAI_BASE_URL'] = api.base_url
+            try:
+                with KnowledgeGraph('neo4j', "resources", neo=neo) as kg:
+                    # chunks of the long document end up in different batches
+                    stats = kg.extract_knowledge_batch("MATCH ...", "gpt-4", "generic_v4", 1000, state_dir=tmp,
+                                                       poll_interval=0.01, max_requests_per_batch=2)
+            finally:
+                del os.environ['OPENAI_BASE_URL']
+            self.assertEqual(api.requests, 0, "No synchronous chat completion expected.")
+
+        self.assertTrue(stats['batches'] >= 2)
+        self.assertEqual((stats['documents'], stats['stored'], stats['failed']), (3, 3, 1))
+        written = {q['data']['element_id'] for q in neo.written if 'rows' not in q['data'] and 'tokens_raw' not in q['data']}
+        self.assertEqual(written, {"4:f:1", "4:f:3", "4:f:4"})
+        errors = [q for q in neo.written if 'error' in q['data']]
+        self.assertEqual([q['data']['element_id'] for q in errors], ["4:f:3"])
+        self.assertTrue(kg.metrics.get('llm_cost_usd_total', model="gpt-4") > 0)
+
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as tmp, FakeOpenAI(self.gpt_output) as api:
+            openai = OpenAIQuery("resources/prompts", "generic_v4", 1000, base_url=api.base_url)
+            extractor = BatchExtractor(openai, tmp)
+            docs = [(d['element_id'], d['pages']) for d in self.docs[:1]]
+            batch_id = extractor.submit(extractor.write_requests(docs, "gpt-4")[0], "gpt-4")
+            del extractor  # interrupted run
+
+            extractor = BatchExtractor(openai, tmp)
+            self.assertEqual(extractor.pending(), [batch_id])
+            results = list(extractor.collect(extractor.wait(batch_id, poll_interval=0.01)))
+            extractor.mark_collected(batch_id)
+            self.assertEqual([x[0] for x in results], ["4:f:1"])
+            self.assertTrue('entities' in results[0][1])
+            self.assertEqual(BatchExtractor(openai, tmp).pending(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
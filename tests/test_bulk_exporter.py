@@ -0,0 +1,75 @@
+import os
+import csv
+import gzip
+import json
+import tempfile
+import unittest
+import logging
+from src.bulkExporter import BulkExporter
+from src.dataLoader import DataLoader
+from src.manifest import FileManifest
+
+logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(name)s - %(levelname)s: %(message)s")
+
+
+def read_csv(path: str) -> list:
+    with (gzip.open(path, 'rt', newline="") if path.endswith(".gz") else open(path, newline="")) as f:
+        return list(csv.reader(f))
+
+
+class TestBulkExporter(unittest.TestCase):
+    def test_export(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            corpus = os.path.join(tmp, "corpus")
+            for d in ["a/b", "a/c"]:
+                os.makedirs(os.path.join(corpus, d))
+            pages = [{'pageNumber': 1, 'id': "p1", 'text': " Line one,\n\"quoted\" line two. ", 'meta': {'dpi': 300}},
+                     {'pageNumber': 2, 'text': "", 'confidence': 0.9},
+                     {'pageNumber': 2, 'lang': "en"},  # same page id, merged
+                     {'pageNumber': "3a", 'text': "Appendix"}]
+            for path in ["a/b/1.json", "a/c/2.json"]:
+                with open(os.path.join(corpus, path), 'w') as f:
+                    json.dump(pages, f)
+            with open(os.path.join(corpus, "a/c/broken.json"), 'w') as f:
+                f.write("[{")
+
+            out = os.path.join(tmp, "import")
+            manifest_path = os.path.join(tmp, "manifest.db")
+            stats = BulkExporter(out, compress=True).export(corpus, workers=0, manifest_path=manifest_path)
+
+            loader = DataLoader(corpus)
+            files = sorted(f['path'] for f in loader.iter_files() if f['name'] != "broken.json")
+            expected_pages = sorted({p['id'] for f in loader.iter_files() if f['name'] != "broken.json"
+                                     for p in loader.build_file_payload(f)['pages']})
+            directories = read_csv(os.path.join(out, "directory.csv.gz"))
+            file_rows = read_csv(os.path.join(out, "file.csv.gz"))
+            page_rows = read_csv(os.path.join(out, "page.csv.gz"))
+            contains_file = read_csv(os.path.join(out, "contains_file.csv.gz"))
+            with open(os.path.join(out, BulkExporter.PROPERTIES_FILE)) as f:
+                spilled = {x['id']: x['properties'] for x in map(json.loads, f)}
+
+            manifest = FileManifest(manifest_path)
+            statuses = [manifest.classify(path)[0] for path in files]
+            manifest.close()
+
+        self.assertEqual(directories[0], ["id:ID(Directory)", "name"])
+        directory_ids = [row[0] for row in directories[1:]]
+        self.assertEqual(len(directory_ids), len(set(directory_ids)), "Directory nodes must be unique.")
+        self.assertTrue(all(row[0] in directory_ids for row in contains_file[1:]))
+        self.assertEqual(sorted(row[0] for row in file_rows[1:]), files, "File ids are the paths, as in ingest_data.")
+        self.assertEqual(len(file_rows[1][2].split(";")), 128, "MinHash signature as an array.")
+        self.assertEqual(sorted(row[0] for row in page_rows[1:]), expected_pages)
+
+        page_1 = [row for row in page_rows if row[0] == f"{files[0]}__1"][0]
+        self.assertEqual(page_1[1:], ["1", "Line one,\n\"quoted\" line two.", "p1"])
+        self.assertEqual(spilled[f"{files[0]}__1"], {'meta': "{'dpi': 300}"})
+        self.assertEqual(spilled[f"{files[0]}__2"], {'text': "", 'confidence': 0.9, 'lang': "en"})
+        self.assertEqual(spilled[f"{files[0]}__3a"], {'pageNumber': "3a"})
+
+        self.assertEqual((stats['nodes']['File'], stats['nodes']['Page'], stats['failed_files']), (2, 6, 1))
+        self.assertTrue(stats['files_per_sec'] > 0 and "neo4j-admin database import" in stats['command'])
+        self.assertEqual(statuses, ["unchanged", "unchanged"], "Exported files are recorded in the manifest.")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+import logging
+from neo4j.exceptions import TransientError
+from src.bulkWriter import BulkWriter, AdaptiveBackpressure
+
+logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(name)s - %(levelname)s: %(message)s")
+
+
+class FakeNeo:
+    """Records written batches instead of sending them to Neo4j."""
+    def __init__(self, fail_times: int = 0, bad_id: str = None):
+        self.batches = list()
+        self.calls = 0
+        self.fail_times = fail_times
+        self.bad_id = bad_id
+
+    def write_batch(self, query, rows, db=None):
+        self.calls += 1
+        if self.fail_times > 0:
+            self.fail_times -= 1
+            raise TransientError("Unable to retrieve routing information")
+        if any(r['id'] == self.bad_id for r in rows):
+            raise ValueError("Invalid row")
+        self.batches.append(rows)
+        return {}
+
+
+class TestBulkWriter(unittest.TestCase):
+    def test_batching_by_rows_and_bytes(self):
+        neo = FakeNeo()
+        writer = BulkWriter(neo, batch_size=10, max_batch_bytes=1000)
+        stats = writer.write("UNWIND $rows AS row RETURN row", ({'id': str(i)} for i in range(25)))
+        self.assertEqual([len(b) for b in neo.batches], [10, 10, 5])
+        self.assertEqual(stats['rows'], 25)
+
+        neo = FakeNeo()
+        writer = BulkWriter(neo, batch_size=100, max_batch_bytes=250)
+        writer.write("UNWIND $rows AS row RETURN row", ({'id': str(i), 'text': "x" * 100} for i in range(4)))
+        self.assertEqual([len(b) for b in neo.batches], [2, 2])
+
+    def test_transient_errors_and_bad_rows(self):
+        neo = FakeNeo(fail_times=2, bad_id="3")
+        writer = BulkWriter(neo, batch_size=8, backpressure=AdaptiveBackpressure(min_step=0.01))
+        stats = writer.write("UNWIND $rows AS row RETURN row", ({'id': str(i)} for i in range(8)))
+        self.assertEqual(stats['rows'], 7)
+        self.assertEqual(writer.failed_rows, ["3"])
+        self.assertEqual(stats['failed'], 1)
+
+    def test_db_unavailable(self):
+        # transient errors are not bisected: the write fails after `max_retries` attempts of the batch
+        neo = FakeNeo(fail_times=100)
+        writer = BulkWriter(neo, batch_size=8, max_retries=3, backpressure=AdaptiveBackpressure(min_step=0.01))
+        with self.assertRaises(TransientError):
+            writer.write("UNWIND $rows AS row RETURN row", ({'id': str(i)} for i in range(8)))
+        self.assertEqual(neo.calls, 3)
+
+    def test_parallel_writers(self):
+        neo = FakeNeo(bad_id="42")
+        written = list()
+        writer = BulkWriter(neo, batch_size=10)
+        stats = writer.write_parallel("UNWIND $rows AS row RETURN row", ({'id': str(i)} for i in range(200)),
+                                      on_batch=written.extend, writers=4)
+        self.assertEqual(stats['rows'], 199)
+        self.assertEqual(writer.failed_rows, ["42"])
+        self.assertEqual(sorted(int(r['id']) for b in neo.batches for r in b), [i for i in range(200) if i != 42])
+        self.assertEqual(len(written), 199)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+import logging
+from src.chunker import Chunker, merge_results
+from src.utils import estimate_tokens
+
+logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(name)s - %(levelname)s: %(message)s")
+
+
+class TestChunker(unittest.TestCase):
+    def test_split_on_page_boundaries(self):
+        chunker = Chunker(prompt_tokens=3000, max_tokens=2000, min_chunk_tokens=100)
+        budget = chunker.budget("gpt-4")
+        pages = [f"Page {i}. " + "word " * 1000 for i in range(10)] + ["Long page.\n\n" + "line of text\n" * 5000]
+        chunks = chunker.split(pages, "gpt-4")
+        self.assertTrue(all(estimate_tokens(c) <= budget for c in chunks), "Chunk over token budget.")
+        self.assertTrue(chunks[0].startswith("Page 0.") and "Page 1." in chunks[0])
+        self.assertEqual(sum(c.count("Page ") for c in chunks), 10, "Pages must not be split or lost.")
+
+    def test_merge_results(self):
+        chunk1 = {'content_type': "letter",
+                  'entities': {'Organization': [{'id': 0, 'name': "DuPont"}], 'Facility': [{'id': 1, 'name': "PLW"}]},
+                  'relations': {'OWNS_OR_OPERATES': [{'source': 0, 'target': 1}]}}
+        chunk2 = {'content_type': "letter",
+                  'entities': {'Facility': [{'id': 0, 'name': "plw"}], 'Organization': [{'id': 1, 'name': "DuPont"},
+                                                                                        {'id': 2, 'name': "3M"}]},
+                  'relations': {'OWNS_OR_OPERATES': [{'source': 1, 'target': 0}, {'source': 2, 'target': 0}]}}
+        merged = merge_results([chunk1, {"error": "failed", "response": None}, chunk2])
+        self.assertEqual(merged['content_type'], "letter")
+        self.assertEqual([e['name'] for e in merged['entities']['Organization']], ["DuPont", "3M"])
+        self.assertEqual(len(merged['entities']['Facility']), 1)
+        self.assertEqual(sorted((r['source'], r['target']) for r in merged['relations']['OWNS_OR_OPERATES']),
+                         [(0, 1), (2, 1)])
+        self.assertEqual(merged['_failed_chunks'], 1, "A failed chunk must not go unnoticed.")
+        self.assertNotIn('_failed_chunks', merge_results([chunk1, chunk2]))
+
+
+if __name__ == '__main__':
+    unittest.main()
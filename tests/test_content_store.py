@@ -0,0 +1,59 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import logging
+from src.contentStore import ContentStore
+from src.kg import KnowledgeGraph
+
+logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(name)s - %(levelname)s: %(message)s")
+
+
+class TestContentStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = ContentStore(os.path.join(self.dir, "blobs"), min_bytes=100, preview_chars=10)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_put_get(self):
+        text = "Exposure to PFOA in drinking water. " * 100
+        ref = self.store.put(text)
+        self.assertTrue(ContentStore.is_ref(ref))
+        self.assertEqual(self.store.put(text), ref, "Content-addressed.")
+        self.assertEqual(self.store.metrics.get('content_store_dedup_total'), 1)
+        self.assertLess(os.path.getsize(self.store.path(ref)), len(text) // 10, "Compressed.")
+
+        self.assertEqual(self.store.get(ref), text)
+        self.assertEqual(self.store.get(ref), text)
+        self.assertEqual(self.store.metrics.get('content_store_cache_hits_total'), 1)
+        self.assertIsNone(self.store.get("sha256:" + "0" * 64))
+        self.assertEqual(self.store.resolve("not a reference"), "not a reference")
+
+    def test_externalize(self):
+        ocr = str({'blocks': [{'text': "word", 'confidence': 0.9}] * 20})
+        props = self.store.externalize({'pageNumber': 1, 'text': "short", 'ocr': ocr})
+        self.assertEqual(props['text'], "short")
+        self.assertIsNone(props['ocr'], "Removes the inline value of a re-ingested page.")
+        self.assertEqual(props['ocr_preview'], ocr[:10])
+        self.assertEqual(self.store.get(props['ocr_ref']), ocr)
+
+    def test_kg_integration(self):
+        kg = KnowledgeGraph('neo4j', 'resources', initialise=False, content_store=self.store)
+        text = "The plant released PFOA into the Ohio River. " * 10
+        doc = {'element_id': "1", 'pages': [self.store.put(text), "Second page."]}
+        self.assertEqual(kg.document_pages(doc), [text, "Second page."])
+
+        with open("resources/gpt_output.json", 'r') as f:
+            gpt_output = json.load(f)
+        queries = kg.generate_cypher("1", gpt_output)
+        props = queries[-1]['data']['props']
+        self.assertIsNone(props['LLM_metadata_entities'])
+        entities = json.loads(self.store.get(props['LLM_metadata_entities_ref']))['LLMMetadataEntities']
+        self.assertEqual(entities, queries[0]['data']['entities'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,10 @@
+import os
+import json
+import tempfile
 import unittest
 import logging
 from src.dataLoader import DataLoader
+from src.metrics import Metrics
 
 logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(name)s - %(levelname)s: %(message)s")
 
@@ -25,6 +29,57 @@ class TestDataIngestion(unittest.TestCase):
         print(content[0].keys())
         print(content[0])
 
+    def test_streaming_pages(self):
+        pages = [{'pageNumber': 1, 'text': "He said \"[not a list]\" {x}\\", 'id': "a",
+                  'words': [{'text': "}]\"", 'box': [1, 2, 3, 4]}] * 50, 'meta': {'lang': "čeština"}},
+                 {'pageNumber': 2, 'words': [], 'text': "", 'confidence': 0.97, 'flags': [True, None]},
+                 {}]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "doc.json")
+            with open(path, 'w') as f:
+                json.dump(pages, f, indent=1, ensure_ascii=False)
+            content = list(DataLoader.iter_pages(path))
+        expected = [{k: v for k, v in p.items() if k != 'words'} for p in pages]
+        self.assertEqual(content, expected)
+
+    def test_lazy_crawling(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for d in ["a/b", "a/c/d", "e"]:
+                os.makedirs(os.path.join(tmp, d))
+            for f in ["a/b/1.json", "a/c/d/2.json", "a/c/d/3.txt", "e/4.txt"]:
+                with open(os.path.join(tmp, f), 'w') as fw:
+                    fw.write("[]")
+            loader = DataLoader.from_path(tmp)
+            files = sorted(f['name'] for f in loader.iter_files())
+            pairs = list(loader.iter_directory_pairs())
+        self.assertEqual(files, ["1.json", "2.json"])
+        # pairs continue up to the file system root, as the original crawler did
+        targets = [p['target'][len(tmp):] for p in pairs if p['target'].startswith(tmp + "/")]
+        self.assertEqual(sorted(targets), ["/a", "/a/b", "/a/c", "/a/c/d"])
+        self.assertEqual(len(targets), len(set(targets)), "Directory pairs must not repeat.")
+
+    def test_parallel_parsing(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for i in range(6):
+                with open(os.path.join(tmp, f"{i}.json"), 'w') as f:
+                    json.dump([{'pageNumber': p, 'id': f"{i}-{p}", 'text': f" Page {p} of file {i}. ",
+                                'meta': {'lang': "en"}} for p in range(1, 4)], f)
+            with open(os.path.join(tmp, "broken.json"), 'w') as f:
+                f.write('[{"pageNumber": 1, "text": "unterminated')
+            metrics = Metrics()
+            loader = DataLoader(tmp, metrics)
+            files = sorted(loader.iter_files(), key=lambda f: f['name'])
+            parsed = list(loader.iter_payloads(files, workers=2, signatures=True, prefetch=3))
+            expected = [loader.build_file_payload(f) for f in files if f['name'] != "broken.json"]
+
+        self.assertEqual([f['name'] for f, _ in parsed], [f"{i}.json" for i in range(6)], "Order must be kept.")
+        self.assertEqual([{k: v for k, v in p.items() if k != 'minhash'} for _, p in parsed], expected)
+        self.assertEqual(parsed[0][1]['pages'][0]['others'], {'pageNumber': 1, 'id_page': "0-1",
+                                                              'text': "Page 1 of file 0.", 'meta': "{'lang': 'en'}"})
+        self.assertTrue(all(len(p['minhash']) == 128 for _, p in parsed))
+        self.assertEqual(metrics.get('files_failed_total'), 1)
+        self.assertEqual(metrics.get('pages_parsed_total'), 2 * 18)
+
 
 if __name__ == '__main__':
     unittest.main()
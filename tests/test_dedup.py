@@ -0,0 +1,57 @@
+import random
+import unittest
+import logging
+from src.dedup import MinHasher, DuplicateFinder
+
+logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(name)s - %(levelname)s: %(message)s")
+
+WORDS = ("plant facility discharge groundwater sampling permit compliance inspection waste ash sludge resin "
+         "contamination remediation agency department environmental protection chemical lead mercury").split()
+
+
+def document(rnd: random.Random, n_words: int = 400) -> list:
+    return [rnd.choice(WORDS) for _ in range(n_words)]
+
+
+def near_copy(words: list, rnd: random.Random, n_changes: int = 3) -> list:
+    words = list(words)
+    for _ in range(n_changes):
+        words[rnd.randrange(len(words))] = "stamp"
+    return words
+
+
+class TestDedup(unittest.TestCase):
+    def test_signature_similarity(self):
+        rnd = random.Random(1)
+        hasher = MinHasher()
+        doc, other = document(rnd), document(rnd)
+        sig = hasher.signature(" ".join(doc))
+        self.assertEqual(len(sig), 128)
+        self.assertTrue(all(0 <= x < 2 ** 63 for x in sig), "Signature must fit into Neo4j integers.")
+        self.assertEqual(sig, hasher.signature(" ".join(doc).upper()))
+        self.assertTrue(MinHasher.similarity(sig, hasher.signature(" ".join(near_copy(doc, rnd)))) > 0.85)
+        self.assertTrue(MinHasher.similarity(sig, hasher.signature(" ".join(other))) < 0.2)
+        self.assertEqual(hasher.signature("  "), [])
+
+    def test_grouping(self):
+        rnd = random.Random(2)
+        hasher = MinHasher()
+        originals = [document(rnd) for _ in range(50)]
+        docs = [(f"doc_{i}", words) for i, words in enumerate(originals)]
+        # 3 copies of doc_0 (exact & near), 1 near copy of doc_1
+        docs += [("copy_0a", originals[0]), ("copy_0b", near_copy(originals[0], rnd)),
+                 ("copy_0c", near_copy(originals[0], rnd)), ("copy_1", near_copy(originals[1], rnd))]
+        rnd.shuffle(docs)
+        docs.sort(key=lambda x: not x[0].startswith("doc_"))  # originals first, they become the representatives
+
+        groups, stats = DuplicateFinder(threshold=0.8).group((key, hasher.signature(" ".join(words)))
+                                                             for key, words in docs)
+        self.assertEqual(sorted(sorted(g) for g in groups),
+                         [["copy_0a", "copy_0b", "copy_0c", "doc_0"], ["copy_1", "doc_1"]])
+        self.assertTrue(all(g[0].startswith("doc_") for g in groups))
+        self.assertEqual((stats['documents'], stats['groups'], stats['duplicates']), (54, 2, 4))
+        self.assertTrue(stats['comparisons'] < 54 * 53 / 2 / 10, f"Too many comparisons: {stats['comparisons']}")
+
+
+if __name__ == '__main__':
+    unittest.main()
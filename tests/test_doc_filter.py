@@ -0,0 +1,126 @@
+import os
+import unittest
+import logging
+from unittest import mock
+from fake_openai import FakeOpenAI, use_fake_api_key
+from src.docFilter import DocumentFilter, SKIP, CHEAP, EXTRACT
+from src.kg import KnowledgeGraph
+
+logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(name)s - %(levelname)s: %(message)s")
+
+REPORT = ("In 1983 the Commercial Chemicals Division of 3M reviewed the results of a study of PFOA exposure in "
+          "employees of the Cottage Grove plant. Serum concentrations of fluorochemicals in the blood of workers were "
+          "higher than expected, and the Environmental Laboratory recommended further monitoring of the liver effects "
+          "observed in rats. The company did not report these findings to the EPA at that time. ") * 3
+LETTER = ("Dear Mr. Smith,\n\nThank you for your letter of March 4. We have reviewed the proposal with our counsel "
+          "and would like to meet with you next week to discuss the terms. Please let me know which day works best "
+          "for you.\n\nSincerely,\nJohn Doe")
+FAX = ("FAX TRANSMITTAL\nTo: John Smith\nFrom: Mary Jones\nDate: 3/4/1999\nNumber of pages (including cover): 5\n"
+       "Fax: 612-555-0199\nPhone: 612-555-0100\nIf you do not receive all pages please call.")
+SIGNATURE = ("IN WITNESS WHEREOF the parties have signed this Agreement.\n\n____________________\nSignature\n"
+             "Name: R. A. Prokop\nTitle: Vice President\nDate: ________\nNotary Public")
+OCR_NOISE = "~~|l1 ,,;.. ^^ ~~ Ii|l ,.,. ~ ¦¦ ÷ ¬¬ rnrn ll11 |||| xjq zzk wvv ,,,, ____ ^^^ ~~ ,;, ¦ ÷÷ " * 10
+
+
+class FakeNeo:
+    """Returns given documents to the data query and records written queries; `skipped` are the files skipped earlier."""
+    def __init__(self, docs, skipped=()):
+        self.docs = docs
+        self.skipped = list(skipped)
+        self.batches = list()
+        self.transactions = list()
+
+    def run_simple_query(self, query, data=None, db=None):
+        if "_filter_decision" in query:
+            return [{'id': x} for x in self.skipped]
+        return list()
+
+    def stream_query(self, query, data=None, db=None, fetch_size=1000):
+        yield from self.docs
+
+    def write_batch(self, query, rows, db=None):
+        self.batches.append((query, rows))
+        return dict()
+
+    def run_multi_queries(self, queries, db=None):
+        self.transactions.append(queries)
+        return [list() for _ in queries]
+
+    def close(self):
+        pass
+
+
+class TestDocumentFilter(unittest.TestCase):
+    def test_scores(self):
+        doc_filter = DocumentFilter()
+        scores = {name: doc_filter.score(text)[0] for name, text in
+                  [("report", REPORT), ("letter", LETTER), ("fax", FAX), ("signature", SIGNATURE),
+                   ("noise", OCR_NOISE), ("empty", "")]}
+        self.assertGreater(scores['report'], 0.8)
+        self.assertGreater(scores['report'], scores['letter'], "Domain keywords raise the score.")
+        for name in ["fax", "signature", "noise", "empty"]:
+            self.assertLess(scores[name], doc_filter.skip_below, name)
+        self.assertLessEqual(len(doc_filter.sample(REPORT * 100)), doc_filter.max_chars + 2, "Long texts sampled.")
+
+    def test_decisions(self):
+        doc_filter = DocumentFilter(skip_below=0.2, cheap_below=0.6, cheap_model="gpt-3.5-turbo")
+        self.assertEqual(doc_filter.decide(FAX)['decision'], SKIP)
+        self.assertEqual(doc_filter.decide(LETTER), {'decision': CHEAP, 'score': doc_filter.decide(LETTER)['score'],
+                                                     'model': "gpt-3.5-turbo"})
+        self.assertEqual(doc_filter.decide(REPORT)['decision'], EXTRACT)
+        with self.assertRaises(ValueError):
+            DocumentFilter(cheap_below=0.5)
+
+    def test_saved_calls(self):
+        kg = KnowledgeGraph('neo4j', 'resources', initialise=False)
+        doc_filter = DocumentFilter(cheap_below=0.6, cheap_model="gpt-3.5-turbo")
+        decision = kg.filter_document({'element_id': "1"}, [FAX], doc_filter)
+        self.assertEqual((decision['element_id'], decision['decision']), ("1", SKIP))
+        self.assertEqual(kg.metrics.get('llm_calls_saved_total', reason="filtered"), 1)
+        self.assertGreater(kg.metrics.get('llm_input_tokens_saved_total', reason="filtered"), 0)
+
+        # a batch has one model: cheap documents are extracted as usual
+        decision = kg.filter_document({'element_id': "2"}, [LETTER], doc_filter, cheap=False)
+        self.assertEqual((decision['decision'], decision['model']), (EXTRACT, None))
+
+    def test_decisions_stored_during_run(self):
+        use_fake_api_key(self)
+        with open("resources/prompts/generic_v4_example_output.txt") as f:
+            gpt_output = f.read()
+
+        def docs():
+            yield {'element_id': "4:f:1", 'pages': [REPORT]}
+            yield {'element_id': "4:f:2", 'pages': [FAX]}
+            yield {'element_id': "4:f:3", 'pages': [SIGNATURE]}
+
+        def crashing():
+            yield from docs()
+            raise RuntimeError("Connection lost")
+
+        with FakeOpenAI(gpt_output) as api, mock.patch.dict(os.environ, {'OPENAI_BASE_URL': api.base_url}):
+            neo = FakeNeo(crashing())
+            kg = KnowledgeGraph('neo4j', "resources", neo=neo, initialise=False)
+            with self.assertRaises(RuntimeError):
+                kg.extract_knowledge("MATCH ...", "gpt-4", "generic_v4", 1000, concurrency=1, write_batch_size=1,
+                                     skip_duplicates=False, doc_filter=DocumentFilter())
+            # skipped documents: written by the bulk writer, one batch of `write_batch_size` at a time
+            skipped = [row['element_id'] for query, rows in neo.batches for row in rows
+                       if query == KnowledgeGraph.QUERY_FILTER_DECISIONS]
+            self.assertEqual(sorted(skipped), ["4:f:2", "4:f:3"], "Decisions of an interrupted run are kept.")
+            # extracted documents: in the transaction storing their results
+            stored = [q['data']['rows'] for t in neo.transactions for q in t
+                      if q['query'] == KnowledgeGraph.QUERY_FILTER_DECISIONS]
+            self.assertEqual([[row['element_id'] for row in rows] for rows in stored], [["4:f:1"]])
+
+            # the next run doesn't score (nor count) documents skipped earlier
+            neo = FakeNeo(docs(), skipped=["4:f:2", "4:f:3"])
+            kg = KnowledgeGraph('neo4j', "resources", neo=neo, initialise=False)
+            stats = kg.extract_knowledge("MATCH ...", "gpt-4", "generic_v4", 1000, skip_duplicates=False,
+                                         doc_filter=DocumentFilter())
+            self.assertEqual(stats['filter'], {EXTRACT: 1, CHEAP: 0, SKIP: 0, 'skipped_earlier': 2})
+            self.assertEqual(kg.metrics.get('llm_calls_saved_total', reason="filtered"), 0)
+            self.assertEqual(neo.batches, list())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+import logging
+from src.entityResolution import EntityResolver, normalize_name, soundex
+
+logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(name)s - %(levelname)s: %(message)s")
+
+
+class TestEntityResolution(unittest.TestCase):
+    def test_normalization(self):
+        self.assertEqual(normalize_name("DuPont (formerly Pont Ltd.))"), ["dupont"])
+        self.assertEqual(normalize_name("E. I. du Pont de Nemours & Co."), ["du", "pont", "de", "nemours"])
+        self.assertEqual(soundex("chemours"), soundex("chemors"))
+
+    def test_resolution(self):
+        names = [("DuPont", None, 10), ("DuPont (formerly Pont Ltd.))", None, 1), ("Du Pont Company", None, 2),
+                 ("E.I. du Pont de Nemours", "DuPont", 1), ("duPont", "DuPont", 3),
+                 ("The Chemours Company", None, 4), ("Chemors", None, 1),
+                 ("3M", None, 5), ("Minnesota Mining and Manufacturing", "3M", 1), ("3M Company", "3M", 2),
+                 ("Mercury", "Mercury_(element)", 1), ("Mercury", "Mercury_(planet)", 1),
+                 ("Department of Environmental Protection", None, 1), ("Department of Health", None, 1)]
+        resolved, stats = EntityResolver().resolve(names)
+
+        for name in ["DuPont (formerly Pont Ltd.))", "Du Pont Company", "E.I. du Pont de Nemours", "duPont"]:
+            self.assertEqual(resolved[(name, "DuPont" if "Nemours" in name or name == "duPont" else None)], "DuPont")
+        self.assertEqual(resolved[("Chemors", None)], "The Chemours Company")
+        self.assertEqual(resolved[("Minnesota Mining and Manufacturing", "3M")], "3M")
+        self.assertNotIn(("Mercury", "Mercury_(element)"), resolved, "Different Wikipedia ids must not merge.")
+        self.assertNotIn(("Department of Health", None), resolved)
+        self.assertEqual(stats['names'], len(names))
+        self.assertTrue(0 < stats['comparisons'] < len(names) * (len(names) - 1) / 2, stats)
+
+    def test_acronyms_and_longer_forms(self):
+        resolved, _ = EntityResolver().resolve([("DuPont", None, 10), ("E.I. du Pont de Nemours", None, 1)])
+        self.assertEqual(resolved[("E.I. du Pont de Nemours", None)], "DuPont")
+        resolved, _ = EntityResolver().resolve([("EPA", None, 3), ("U.S. Environmental Protection Agency", None, 1)])
+        self.assertEqual(resolved[("U.S. Environmental Protection Agency", None)], "EPA")
+
+    def test_coherent_clusters(self):
+        # "Hannifin" ~ "Hanifin" and "Hanifin" ~ "Hanlin", but "Hanlin" is not similar to the canonical "Hannifin"
+        names = [("Parker Hannifin", None, 5), ("Parker Hanifin", None, 1), ("Parker Hanlin", None, 1)]
+        resolved, stats = EntityResolver().resolve(names)
+        self.assertEqual(resolved, {("Parker Hannifin", None): "Parker Hannifin",
+                                    ("Parker Hanifin", None): "Parker Hannifin"})
+        self.assertEqual(stats['rejected_merges'], 1)
+
+    def test_oversized_blocks(self):
+        names = [(f"Pollution Control Agency {i}", None, 1) for i in range(50)]
+        resolved, stats = EntityResolver(max_block_size=10).resolve(names)
+        self.assertTrue(stats['skipped_blocks'] > 0)
+        self.assertTrue(stats['comparisons'] < 50 * 49 / 2, stats)
+        self.assertEqual(resolved, dict())
+
+        resolved, _ = EntityResolver().resolve([("Reactor Unit 1", None, 1), ("Reactor Unit 2", None, 1)])
+        self.assertEqual(resolved, dict(), "Names differing in numbers must not merge.")
+
+
+if __name__ == '__main__':
+    unittest.main()
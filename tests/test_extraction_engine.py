@@ -0,0 +1,93 @@
+import os
+import time
+import threading
+import unittest
+import logging
+from fake_openai import FakeOpenAI, use_fake_api_key
+from src.openaiQuery import OpenAIQuery
+from src.rateLimiter import RateLimiter, TokenBucket
+from src.extractionEngine import ExtractionEngine
+from src.metrics import Metrics
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s: %(message)s")
+LIMITS = {'gpt-4': {'rpm': 10000, 'tpm': 10 ** 8}}
+
+
+class TestExtractionEngine(unittest.TestCase):
+    def setUp(self):
+        use_fake_api_key(self)
+        with open("resources/prompts/generic_v4_example_output.txt") as f:
+            self.gpt_output = f.read()
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate_per_min=600, capacity=1)
+        t_start = time.time()
+        for _ in range(3):
+            bucket.acquire(1)
+        self.assertTrue(time.time() - t_start >= 0.15, "Token bucket did not throttle.")
+
+    def test_rate_limit_retry_after(self):
+        with FakeOpenAI(self.gpt_output, rate_limit_first=2, retry_after=0.1) as api:
+            openai = OpenAIQuery("resources/prompts", "generic_v4", 1000, rate_limiter=RateLimiter(LIMITS),
+                                 base_url=api.base_url)
+            result = openai.query("Some document text.", "gpt-4")
+            self.assertTrue('entities' in result, f"Unexpected output: {result}")
+            self.assertEqual(api.requests, 3)
+
+    def test_server_error_retry(self):
+        metrics = Metrics()
+        with FakeOpenAI(self.gpt_output, fail_first=1) as api:
+            openai = OpenAIQuery("resources/prompts", "generic_v4", 1000, base_url=api.base_url, metrics=metrics,
+                                 error_backoff=0.01)
+            result = openai.query("Some document text.", "gpt-4")
+            self.assertTrue('entities' in result, f"Unexpected output: {result}")
+            self.assertEqual(api.requests, 2)
+        self.assertEqual(metrics.get('llm_requests_total', model="gpt-4", status="transient_error"), 1)
+
+        with FakeOpenAI(self.gpt_output, fail_first=10) as api:
+            openai = OpenAIQuery("resources/prompts", "generic_v4", 1000, base_url=api.base_url,
+                                 max_error_retries=2, error_backoff=0.01)
+            self.assertIn('error', openai.query("Some document text.", "gpt-4"))
+            self.assertEqual(api.requests, 3)
+
+    def test_concurrent_extraction(self):
+        docs = [{'element_id': str(i), 'text': f"Document {i}"} for i in range(8)]
+        writer_threads = set()
+
+        def store(batch):
+            writer_threads.add(threading.current_thread().name)
+            stored.extend(doc['element_id'] for doc, result in batch)
+
+        stored = list()
+        with FakeOpenAI(self.gpt_output, latency=0.3) as api:
+            openai = OpenAIQuery("resources/prompts", "generic_v4", 1000, rate_limiter=RateLimiter(LIMITS),
+                                 base_url=api.base_url)
+            t_start = time.time()
+            stats = ExtractionEngine(concurrency=4, write_batch_size=3).run(docs, lambda doc: openai.query(doc['text'], "gpt-4"), store)
+            elapsed = time.time() - t_start
+            self.assertTrue(1 < api.max_active <= 4, f"Unexpected concurrency: {api.max_active}")
+        self.assertEqual(stats['stored'], 8)
+        self.assertEqual(sorted(stored), sorted(d['element_id'] for d in docs))
+        self.assertEqual(len(writer_threads), 1, "Results must be stored by a single writer thread.")
+        self.assertTrue(elapsed < 8 * 0.3 * 0.6, f"No speed-up from concurrency: {elapsed} sec")
+
+
+    def test_failing_source(self):
+        # e.g. Neo4j failing while documents are streamed: what was extracted is stored, then the error is raised
+        def docs():
+            for i in range(3):
+                yield {'element_id': str(i)}
+            raise RuntimeError("Connection lost")
+
+        def store(batch):
+            time.sleep(0.1)  # slow DB
+            stored.extend(doc['element_id'] for doc, _ in batch)
+
+        stored = list()
+        with self.assertRaises(RuntimeError):
+            ExtractionEngine(concurrency=2).run(docs(), lambda doc: {'entities': {}}, store)
+        self.assertEqual(sorted(stored), ["0", "1", "2"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,5 @@
+import os
+import copy
 import json
 import unittest
 import logging
@@ -6,6 +8,19 @@ from src.kg import KnowledgeGraph
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s: %(message)s")
 
 
+class FakeNeo:
+    """Records the queries sent to Neo4j, File nodes are looked up in `files` (id -> element id)."""
+    def __init__(self, files: dict):
+        self.files = files
+        self.transactions = list()
+
+    def run_simple_query(self, query, data=None, db=None):
+        return [{'element_id': self.files[path]} for path in data['ids'] if path in self.files]
+
+    def run_multi_queries(self, queries, db=None):
+        self.transactions.append(queries)
+
+
 class TestKG(unittest.TestCase):
     def test_kg_initialisation(self):
         kg = KnowledgeGraph('neo4j', 'resources')
@@ -22,10 +37,111 @@ class TestKG(unittest.TestCase):
     def test_kg_cypher_generation(self):
         with open("resources/gpt_output.json", 'r') as f:
             gpt_output = json.load(f)
-        kg = KnowledgeGraph('neo4j', 'resources')
+        kg = KnowledgeGraph('neo4j', 'resources', initialise=False)
         queries = kg.generate_cypher("4:fd52e840-5039-4b9a-825c-7de81396aab9:9328", gpt_output)
         print(queries[1])
         self.assertTrue(len(queries) == 2, "Unexpected number of entity & relation storage queries.")
+        self.assertTrue(all('_all_properties' not in e for e in queries[0]['data']['entities']),
+                        "Properties are stored natively, not as a serialised map.")
+        self.assertTrue(kg.schema_index["Person|WORKS_FOR|Organization"])
+
+    def test_kg_idempotent_upsert(self):
+        kg = KnowledgeGraph('neo4j', 'resources', initialise=False)
+        output = {'entities': {"Person": [{'id': 0, 'name': "R. A. Prokop"}, {'name': "W. Pearlson"}]},
+                  'relations': {"works with": [{'source': 0, 'target': "_1"}]}}
+        queries = kg.generate_cypher("4:x:1", output)
+        self.assertEqual([e['id'] for e in queries[0]['data']['entities']], [0, "_1"], "Every entity has a key.")
+        self.assertIn("MERGE (e:Entity {_doc_id: $element_id, id: ent.id})", kg.queries['entities'])
+        self.assertNotIn("CREATE", kg.queries['entities'])
+        self.assertIn("elementId(n) = $element_id", kg.queries['error'])
+
+    def test_kg_partial_output(self):
+        kg = KnowledgeGraph('neo4j', 'resources', initialise=False)
+        output = {'entities': {"Person": [{'id': 0, 'name': "R. A. Prokop"}]}, 'relations': {}, '_failed_chunks': 2}
+        queries = kg.generate_cypher("4:x:1", output)
+        self.assertEqual(queries[0]['data']['failed_chunks'], 2)
+        self.assertEqual(queries[-1], {'query': kg.QUERY_PARTIAL_OUTPUT, 'data': {'element_id': "4:x:1"}},
+                         "A document with failed chunks is stored but not marked processed.")
+        del output['_failed_chunks']
+        self.assertNotIn(kg.QUERY_PARTIAL_OUTPUT, [q['query'] for q in kg.generate_cypher("4:x:1", output)])
+
+    @unittest.skipUnless(os.environ.get('NEO4J_URI'), "Needs a Neo4j DB.")
+    def test_kg_idempotent_upsert_counts(self):
+        QUERY_COUNTS = """MATCH (f:File {id: $id})-[:MENTIONS_ENTITY]->(e:Entity)
+        OPTIONAL MATCH (e)-[r:RELATED_TO_ENTITY]->()
+        RETURN count(DISTINCT e) AS entities, count(r) AS relations
+        """
+        output = {'entities': {"Person": [{'id': 0, 'name': "R. A. Prokop"}, {'name': "W. Pearlson"}],
+                               "Organization": [{'id': 1, 'name': "3M"}]},
+                  'relations': {"works with": [{'source': 0, 'target': "_1"}],
+                                "works for": [{'source': 0, 'target': 1}]}}
+        path = "_test_upsert.json"
+        with KnowledgeGraph('neo4j', 'resources', initialise=False) as kg:
+            try:
+                element_id = kg.neo.run_simple_query("CREATE (f:File {id: $id}) RETURN elementId(f) AS element_id",
+                                                     {'id': path})[0]['element_id']
+                doc = {'element_id': element_id}
+                kg.store_results([(doc, copy.deepcopy(output))])
+                counts = kg.neo.run_simple_query(QUERY_COUNTS, {'id': path})[0]
+                self.assertEqual(counts, {'entities': 3, 'relations': 2})
+
+                # a retried transaction or a replayed document
+                kg.store_results([(doc, copy.deepcopy(output))])
+                self.assertEqual(kg.neo.run_simple_query(QUERY_COUNTS, {'id': path})[0], counts)
+
+                # a new extraction without an entity & its relation
+                del output['entities']["Organization"], output['relations']["works for"]
+                kg.store_results([(doc, copy.deepcopy(output))])
+                self.assertEqual(kg.neo.run_simple_query(QUERY_COUNTS, {'id': path})[0],
+                                 {'entities': 2, 'relations': 1})
+            finally:
+                kg.remove_files([path])
+
+    def test_kg_remove_files(self):
+        neo = FakeNeo({"a.json": "4:x:1", "b.json": "4:x:2"})
+        kg = KnowledgeGraph('neo4j', 'resources', neo=neo, initialise=False)
+        removed = list()
+        self.assertEqual(kg.remove_files(["a.json", "b.json", "c.json"], batch_size=2, on_batch=removed.extend), 3)
+        self.assertEqual(removed, ["a.json", "b.json", "c.json"])
+        self.assertEqual(len(neo.transactions), 2)
+        retract, remove = neo.transactions[0]
+        self.assertEqual(retract, {'query': kg.queries['retract_kg'], 'data': {'file_ids': ["4:x:1", "4:x:2"]}},
+                         "The KG layer is retracted before the files are deleted, in the same transaction.")
+        self.assertEqual(remove['data'], {'rows': [{'id': "a.json"}, {'id': "b.json"}]})
+
+    @unittest.skipUnless(os.environ.get('NEO4J_URI'), "Needs a Neo4j DB.")
+    def test_kg_remove_files_counts(self):
+        QUERY_SETUP = """UNWIND $files AS file
+        CREATE (f:File {id: file})
+        CREATE (f)-[:MENTIONS_ENTITY]->(e1:Entity {_doc_id: elementId(f), id: 0, name: "Test Removal Person",
+                                                    _label_llm: "Person"})
+        CREATE (f)-[:MENTIONS_ENTITY]->(e2:Entity {_doc_id: elementId(f), id: 1, name: "Test Removal Org",
+                                                    _label_llm: "Organization"})
+        CREATE (e1)-[:RELATED_TO_ENTITY {_type_llm: "WORKS_FOR"}]->(e2)
+        RETURN elementId(f) AS element_id
+        """
+        QUERY_COUNT = """OPTIONAL MATCH (:KGEntity {name_normalized: "test removal person"})-[r:WORKS_FOR]->
+            (:KGEntity {name_normalized: "test removal org"})
+        RETURN r.count AS count
+        """
+        QUERY_KG_ENTITIES = """MATCH (k:KGEntity) WHERE k.name_normalized STARTS WITH "test removal" RETURN count(k) AS n"""
+
+        files = ["_test_removal_a.json", "_test_removal_b.json"]
+        with KnowledgeGraph('neo4j', 'resources', initialise=False) as kg:
+            try:
+                file_ids = [x['element_id'] for x in kg.neo.run_simple_query(QUERY_SETUP, {'files': files})]
+                kg.neo.run_simple_query(kg.queries['create_kg'], {'file_ids': file_ids, 'schema_index': kg.schema_index})
+                self.assertEqual(kg.neo.run_simple_query(QUERY_COUNT)[0]['count'], 2)
+
+                kg.remove_files(files[:1])
+                self.assertEqual(kg.neo.run_simple_query(QUERY_COUNT)[0]['count'], 1)
+                self.assertEqual(kg.neo.run_simple_query(QUERY_KG_ENTITIES)[0]['n'], 2)
+
+                kg.remove_files(files[1:])
+                self.assertIsNone(kg.neo.run_simple_query(QUERY_COUNT)[0]['count'])
+                self.assertEqual(kg.neo.run_simple_query(QUERY_KG_ENTITIES)[0]['n'], 0, "Orphaned KG entities deleted.")
+            finally:
+                kg.remove_files(files)
 
     @unittest.skip("Makes changes to Neo4j DB.")
     def test_kg_extraction(self):
@@ -38,7 +154,8 @@ class TestKG(unittest.TestCase):
         # Whole batch of test documents
         QUERY_BATCH = """MATCH (f:TestSet)-[:CONTAINS_PAGE]->(p:Page)
         WHERE NOT f:LLMProcessed
-        RETURN elementId(f) AS element_id, REDUCE(mergedString="", page IN collect(p.text) | mergedString + page + '\n\n') AS text
+        WITH f, p ORDER BY p.pageNumber
+        RETURN elementId(f) AS element_id, collect(p.text) AS pages
         """
 
         kg = KnowledgeGraph('neo4j', 'resources')
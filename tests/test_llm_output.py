@@ -0,0 +1,96 @@
+import os
+import json
+import tempfile
+import unittest
+import logging
+from fake_openai import FakeOpenAI, use_fake_api_key
+from src.llmOutput import salvage_json, summarize_output, JSON_MODE, CONTINUATION_PROMPT
+from src.metrics import Metrics
+from src.openaiQuery import OpenAIQuery
+from src.responseCache import ResponseCache
+
+logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(name)s - %(levelname)s: %(message)s")
+
+
+class TestLLMOutput(unittest.TestCase):
+    def setUp(self):
+        use_fake_api_key(self)
+
+    @classmethod
+    def setUpClass(cls):
+        with open("resources/prompts/generic_v4_example_output.txt") as f:
+            cls.gpt_output = f.read()
+        cls.full = json.loads(cls.gpt_output)
+
+    def test_salvage(self):
+        self.assertEqual(salvage_json(self.gpt_output), self.full)
+        self.assertIsNone(salvage_json("Sorry, I can't help with that."))
+
+        # cut inside the last relation: all complete entities & relations are kept
+        cut = self.gpt_output.rindex('"source"') + 5
+        output = salvage_json(self.gpt_output[:cut])
+        self.assertEqual(output['entities'], self.full['entities'])
+        n_full = sum(len(x) for x in self.full['relations'].values())
+        self.assertEqual(sum(len(x) for x in output['relations'].values()), n_full - 1)
+
+        # cut in the middle of a string containing brackets & escaped quotes
+        output = salvage_json('{"entities": {"Person": [{"id": 0, "name": "A"}, {"id": 1, "name": "B \\"[x}')
+        self.assertEqual(output, {"entities": {"Person": [{"id": 0, "name": "A"}]}})
+
+    def test_truncated_output(self):
+        metrics = Metrics()
+        cut = len(self.gpt_output) * 2 // 3
+        with FakeOpenAI(lambda messages: (self.gpt_output[:cut], "length")) as api:
+            openai = OpenAIQuery("resources/prompts", "generic_v4", 1000, base_url=api.base_url, metrics=metrics,
+                                 max_continuations=0)
+            output = openai.query("Document.", "gpt-4")
+        self.assertNotIn('error', output)
+        self.assertTrue(output['_truncated'])
+        self.assertTrue(0 < sum(len(x) for x in output['entities'].values()))
+        self.assertEqual(metrics.get('llm_truncated_total'), 1)
+        self.assertEqual(metrics.get('llm_salvaged_total'), 1)
+
+    def test_truncated_output_not_cached(self):
+        cut = len(self.gpt_output) * 2 // 3
+        with tempfile.TemporaryDirectory() as tmp, \
+                FakeOpenAI(lambda messages: (self.gpt_output[:cut], "length")) as api:
+            cache = ResponseCache(os.path.join(tmp, "cache.db"))
+            openai = OpenAIQuery("resources/prompts", "generic_v4", 1000, base_url=api.base_url, cache=cache,
+                                 max_continuations=0)
+            self.assertTrue(openai.query("Document.", "gpt-4")['_truncated'])
+            self.assertTrue(openai.query("Document.", "gpt-4")['_truncated'])
+            self.assertEqual(api.requests, 2, "A salvaged output is extracted again, not replayed.")
+            cache.close()
+
+    def test_continuation(self):
+        cut = len(self.gpt_output) // 2
+
+        def content(messages):
+            if messages[-1]['content'] == CONTINUATION_PROMPT:
+                self.assertEqual(messages[-2], {"role": "assistant", "content": self.gpt_output[:cut]})
+                if 'response_format' in api.bodies[-1]:  # JSON mode: a new complete object, as the API does
+                    return self.gpt_output, "stop"
+                return self.gpt_output[cut:], "stop"
+            return self.gpt_output[:cut], "length"
+
+        metrics = Metrics()
+        with FakeOpenAI(content) as api:
+            openai = OpenAIQuery("resources/prompts", "generic_v4", 1000, base_url=api.base_url, metrics=metrics,
+                                 response_format=JSON_MODE)
+            output = openai.query("Document.", "gpt-4")
+            self.assertEqual(api.requests, 2)
+            self.assertEqual([b.get('response_format') for b in api.bodies], [JSON_MODE, None],
+                             "The continuation must not request JSON mode.")
+        self.assertEqual(output, self.full)
+        self.assertEqual(metrics.get('llm_continuations_total'), 1)
+        self.assertEqual(metrics.get('llm_salvaged_total'), 0)
+
+    def test_summary(self):
+        summary = summarize_output(self.full)
+        rel_type = next(iter(self.full['relations']))
+        self.assertIn(f" - {rel_type.upper()} (", summary)
+        self.assertNotIn(" None ", summary, "Every relation's source & target must be resolved.")
+
+
+if __name__ == '__main__':
+    unittest.main()
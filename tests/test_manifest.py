@@ -0,0 +1,41 @@
+import os
+import time
+import tempfile
+import unittest
+import logging
+from src.manifest import FileManifest
+
+logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(name)s - %(levelname)s: %(message)s")
+
+
+class TestFileManifest(unittest.TestCase):
+    def test_incremental_runs(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            files = [os.path.join(tmp, f"{i}.json") for i in range(3)]
+            for f in files:
+                with open(f, 'w') as fw:
+                    fw.write(f"[{{\"text\": \"{f}\"}}]")
+            manifest_path = os.path.join(tmp, "manifest.sqlite")
+
+            manifest = FileManifest(manifest_path)
+            for f in files:
+                status, record = manifest.classify(f)
+                self.assertEqual(status, 'new')
+                manifest.update(f, record)
+            manifest.close()
+
+            # touch one file, modify another, delete the third
+            os.utime(files[0], (time.time() + 10, time.time() + 10))
+            with open(files[1], 'w') as fw:
+                fw.write("[]")
+            os.remove(files[2])
+
+            manifest = FileManifest(manifest_path)
+            self.assertEqual(manifest.classify(files[0])[0], 'unchanged')
+            self.assertEqual(manifest.classify(files[1])[0], 'changed')
+            self.assertEqual(list(manifest.removed()), [files[2]])
+            manifest.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import os
+import json
+import tempfile
+import unittest
+import logging
+import threading
+from types import SimpleNamespace
+from unittest import mock
+from fake_openai import FakeOpenAI, use_fake_api_key
+from src.metrics import Metrics, MODEL_PRICES, in_context
+from src.neo4jWriter import Neo4jWriter
+from src.openaiQuery import OpenAIQuery
+from src.rateLimiter import RateLimiter
+from src.dataLoader import DataLoader
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s: %(message)s")
+LIMITS = {'gpt-4': {'rpm': 10000, 'tpm': 10 ** 8}}
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        use_fake_api_key(self)
+
+    def test_llm_metrics(self):
+        with open("resources/prompts/generic_v4_example_output.txt") as f:
+            gpt_output = f.read()
+        metrics = Metrics()
+        with FakeOpenAI(gpt_output, rate_limit_first=1, retry_after=0.05) as api:
+            openai = OpenAIQuery("resources/prompts", "generic_v4", 1000, rate_limiter=RateLimiter(LIMITS),
+                                 base_url=api.base_url, metrics=metrics)
+            with metrics.stage("extract"):
+                for i in range(3):
+                    openai.query(f"Document {i}.", "gpt-4")
+
+        self.assertEqual(metrics.get('llm_requests_total', model="gpt-4", status="ok", stage="extract"), 3)
+        self.assertEqual(metrics.get('llm_requests_total', status="rate_limited"), 1)
+        prompt_tokens = metrics.get('llm_prompt_tokens_total', model="gpt-4")
+        completion_tokens = metrics.get('llm_completion_tokens_total', model="gpt-4")
+        self.assertEqual(completion_tokens, 3 * (len(gpt_output) // 4))
+        price_in, price_out = MODEL_PRICES['gpt-4']
+        self.assertAlmostEqual(metrics.get('llm_cost_usd_total'),
+                               (prompt_tokens * price_in + completion_tokens * price_out) / 1000)
+        latency = [h for h in metrics.summary()['histograms'] if h['name'] == "llm_request_seconds"]
+        self.assertEqual(latency[0]['count'], 4, "All calls, incl. the rate-limited one, are timed.")
+        self.assertTrue(metrics.get('stage_seconds_total', stage="extract") > 0)
+
+    def test_concurrent_stages(self):
+        metrics = Metrics()
+        in_stage, done = threading.Barrier(2), list()
+
+        def run(name):
+            with metrics.stage(name):
+                in_stage.wait()  # both stages open at the same time
+                worker = threading.Thread(target=in_context(lambda: metrics.inc('work_total')))
+                worker.start()
+                worker.join()
+                metrics.inc('work_total')
+
+        threads = [threading.Thread(target=run, args=(name,)) for name in ["extract", "ingest"]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(metrics.get('work_total', stage="extract"), 2)
+        self.assertEqual(metrics.get('work_total', stage="ingest"), 2)
+        metrics.inc('work_total')
+        self.assertEqual(metrics.get('work_total'), 5, "No stage outside of a stage block.")
+
+    def test_neo4j_counters_after_commit(self):
+        summary = SimpleNamespace(counters=SimpleNamespace(nodes_created=1))
+
+        class Session:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def execute_write(self, work):
+                tx = mock.Mock()
+                tx.run.return_value.data.return_value = [{'n': 1}]
+                tx.run.return_value.consume.return_value = summary
+                work(tx)  # attempt failing on a transient error, re-run by the driver
+                return work(tx)
+
+        with mock.patch.dict(os.environ, {'NEO4J_URI': "bolt://localhost", 'NEO4J_USER': "u", 'NEO4J_PWD': "p"}), \
+                mock.patch('src.neo4jWriter.GraphDatabase.driver') as driver:
+            driver.return_value.session.side_effect = lambda **kwargs: Session()
+            neo = Neo4jWriter('neo4j')
+            self.assertEqual(neo.run_multi_queries([{'query': "CREATE (n)", 'data': None}] * 2), [[{'n': 1}]] * 2)
+            self.assertEqual(neo.run_write_query("CREATE (n)"), [{'n': 1}])
+        self.assertEqual(neo.metrics.get('neo4j_nodes_created_total'), 3, "Only the committed attempt is counted.")
+        self.assertEqual(neo.metrics.get('neo4j_queries_total'), 3)
+
+    def test_export(self):
+        metrics = Metrics()
+        with tempfile.TemporaryDirectory() as tmp:
+            for i in range(2):
+                with open(os.path.join(tmp, f"{i}.json"), 'w') as f:
+                    json.dump([{'pageNumber': 1, 'text': "Page text."}, {'pageNumber': 2, 'text': "More."}], f)
+            loader = DataLoader.from_path(tmp, metrics)
+            with metrics.stage("parse"):
+                for file in loader.iter_files():
+                    loader.build_file_payload(file)
+            metrics.record_neo4j({'nodes_created': 5, 'relationships_created': 0})
+
+            metrics.write_prometheus(os.path.join(tmp, "metrics.prom"))
+            metrics.write_json(os.path.join(tmp, "metrics.json"))
+            with open(os.path.join(tmp, "metrics.prom")) as f:
+                prom = f.read()
+            with open(os.path.join(tmp, "metrics.json")) as f:
+                summary = json.load(f)
+
+        self.assertIn('legal_kg_pages_parsed_total{stage="parse"} 4', prom)
+        self.assertIn('legal_kg_file_parse_seconds_count{stage="parse"} 2', prom)
+        self.assertIn('legal_kg_file_parse_seconds_bucket{stage="parse",le="+Inf"} 2', prom)
+        self.assertIn('legal_kg_neo4j_nodes_created_total 5', prom)
+        self.assertNotIn('relationships_created', prom)
+        self.assertEqual([c['value'] for c in summary['counters'] if c['name'] == "files_parsed_total"], [2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+import logging
+from src.migrations import Migrator, MIGRATIONS
+from src.kg import KnowledgeGraph
+
+logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(name)s - %(levelname)s: %(message)s")
+
+
+class FakeNeo:
+    """Keeps the recorded schema state and counts DDL statements instead of running them."""
+    def __init__(self, results: dict = None):
+        self.state = None
+        self.ddl = list()
+        self.queries = 0
+        self.results = results or dict()  # records returned by a query
+
+    def run_simple_query(self, query, data=None, db=None):
+        self.queries += 1
+        if query == Migrator.QUERY_STATE:
+            return [self.state] if self.state is not None else list()
+        if query == Migrator.QUERY_RECORD:
+            self.state = {key: data[key] for key in ['versions', 'hashes', 'fingerprint']}
+            return list()
+        self.ddl.append(query)
+        return self.results.get(query, list())
+
+
+class TestMigrations(unittest.TestCase):
+    def test_versioned_migrations(self):
+        neo = FakeNeo()
+        n_ddl = sum(len(m['queries']) for m in MIGRATIONS)
+        self.assertEqual(Migrator(neo).migrate(), [m['version'] for m in MIGRATIONS])
+        self.assertEqual(len(neo.ddl), n_ddl)
+
+        neo.queries = 0
+        self.assertEqual(Migrator(neo).migrate(), list())
+        self.assertEqual((len(neo.ddl), neo.queries), (n_ddl, 1), "Up-to-date DB: one read query, no DDL.")
+
+        # a new migration is the only one applied
+        new = {'version': MIGRATIONS[-1]['version'] + 1, 'description': "Test",
+               'queries': ["CREATE INDEX test IF NOT EXISTS FOR (n:X) ON (n.y)"]}
+        self.assertEqual(Migrator(neo, MIGRATIONS + [new]).migrate(), [new['version']])
+        self.assertEqual(neo.ddl[-1], new['queries'][0])
+        self.assertEqual(len(neo.ddl), n_ddl + 1)
+
+    def test_deferred_indices(self):
+        neo = FakeNeo()
+        deferrable = [m['version'] for m in MIGRATIONS if m.get('deferrable')]
+        applied = Migrator(neo).migrate(defer=True)
+        self.assertTrue(deferrable and not set(deferrable) & set(applied))
+        self.assertFalse(any("FULLTEXT" in q for q in neo.ddl))
+        self.assertIsNone(neo.state['fingerprint'], "Schema with deferred migrations is not up to date.")
+        self.assertEqual(Migrator(neo).migrate(), deferrable)
+        self.assertIsNotNone(neo.state['fingerprint'])
+
+    def test_entity_key_migration(self):
+        queries = next(m for m in MIGRATIONS if m['version'] == 5)['queries']
+        dedup = next(q for q in queries if "DETACH DELETE copy" in q)
+        self.assertIn("e.id IS NOT NULL", dedup, "Entities without an id are not copies of each other.")
+        self.assertLess(queries.index(next(q for q in queries if "e.id IS NULL" in q)), queries.index(dedup))
+
+        # counts returned by data migrations are logged
+        keying = next(q for q in queries if "e.id IS NULL" in q)
+        neo = FakeNeo({keying: [{'entities_without_id': 2}]})
+        with self.assertLogs(level=logging.INFO) as logs:
+            Migrator(neo).migrate()
+        self.assertTrue(any("{'entities_without_id': 2}" in line for line in logs.output))
+
+    def test_page_texts_index(self):
+        # the last definition of the index covers the previews of texts kept in the content store
+        index = [q for m in MIGRATIONS for q in m['queries'] if "FULLTEXT INDEX pageTexts" in q][-1]
+        self.assertIn("[n.text, n.text_preview]", index)
+
+    def test_no_connection(self):
+        kg = KnowledgeGraph('neo4j', 'resources', initialise=False)
+        self.assertIsNone(kg._neo, "Constructing without initialisation must not connect to Neo4j.")
+        kg = KnowledgeGraph('neo4j', 'resources', neo=FakeNeo(), bulk_load=True)
+        self.assertFalse(any("FULLTEXT" in q for q in kg.neo.ddl))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -24,6 +24,23 @@ class TestNeo4jWriter(unittest.TestCase):
         print(res)
         self.assertTrue(len(res) == 2, f"Unexpected number of outputs: {len(res)}")
 
+    def test_stream_query(self):
+        neo = Neo4jWriter('neo4j')
+        res = neo.stream_query("UNWIND range(1, 2500) AS x RETURN x", fetch_size=100)
+        self.assertEqual(sum(1 for _ in res), 2500)
+        neo.close()
+
+    def test_paginate_query(self):
+        neo = Neo4jWriter('neo4j')
+        query = """UNWIND range(1, 2500) AS x
+        WITH toString(100000 + x) AS x WHERE x > $last_key
+        RETURN x ORDER BY x LIMIT $limit
+        """
+        res = list(neo.paginate_query(query, page_size=1000, key='x'))
+        neo.close()
+        self.assertEqual(len(res), 2500)
+        self.assertEqual(len(set(r['x'] for r in res)), 2500)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -2,15 +2,16 @@ import unittest
 import logging
 import json
 from src.openaiQuery import OpenAIQuery
+from src.llmOutput import summarize_output
 
 logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(name)s - %(levelname)s: %(message)s")
 
 
 class TestOpenAIAPI(unittest.TestCase):
-    def test_pretty_print(self):
+    def test_summary(self):
         with open("resources/prompts/generic_v4_example_output.txt") as f:
             gpt_output = json.load(f)
-        OpenAIQuery.pretty_print_rels(gpt_output)
+        print(summarize_output(gpt_output))
 
 
     def test_simple_query(self):
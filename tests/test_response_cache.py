@@ -0,0 +1,54 @@
+import os
+import json
+import tempfile
+import unittest
+import logging
+from fake_openai import FakeOpenAI, use_fake_api_key
+from src.openaiQuery import OpenAIQuery
+from src.responseCache import ResponseCache
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s: %(message)s")
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        use_fake_api_key(self)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "responses.sqlite")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_eviction(self):
+        cache = ResponseCache(self.path, max_bytes=1000)
+        for i in range(10):
+            cache.put(str(i), "gpt-4", "generic_v4", {'text': "x" * 200})
+        self.assertTrue(cache.total_bytes <= 1000)
+        self.assertIsNone(cache.get("0"), "Oldest entry should have been evicted.")
+        self.assertIsNotNone(cache.get("9"))
+        self.assertEqual(cache.stats()['hits'], 1)
+        cache.close()
+
+    def test_cached_query_and_replay(self):
+        with open("resources/prompts/generic_v4_example_output.txt") as f:
+            gpt_output = f.read()
+        with FakeOpenAI(gpt_output) as api:
+            openai = OpenAIQuery("resources/prompts", "generic_v4", 1000, base_url=api.base_url,
+                                 cache=ResponseCache(self.path))
+            first = openai.query("Some document text.", "gpt-4")
+            second = openai.query("Some document text.", "gpt-4")
+            self.assertEqual(first, second)
+            self.assertEqual(api.requests, 1)
+            openai.cache.close()
+
+            # replay: cached documents are served, others skipped without calling the API
+            replay = OpenAIQuery("resources/prompts", "generic_v4", 1000, base_url=api.base_url,
+                                 cache=ResponseCache(self.path, read_only=True))
+            self.assertEqual(replay.query("Some document text.", "gpt-4"), json.loads(gpt_output))
+            self.assertIsNone(replay.query("Another document.", "gpt-4"))
+            self.assertEqual(api.requests, 1)
+            replay.cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import os
+import shutil
+import tempfile
+import unittest
+import logging
+from src.snapshot import SnapshotBuilder, Snapshot
+
+logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(name)s - %(levelname)s: %(message)s")
+
+
+class FakeNeo:
+    """
+    In-memory KG layer answering the snapshot queries; records the `$files` parameter of each read. Provenance
+    endpoints are resolved by name the way `QUERY_PROVENANCE` does - on `name_normalized` or on `name`.
+    """
+    def __init__(self):
+        self.built = {"a.json": 10, "b.json": 20}
+        self.entities = {"e1": ("Organization", "DuPont"), "e2": ("Substance", "PFOA"), "e3": ("Location", "Ohio")}
+        self.rels = [("e1", "e2", "PRODUCES", 3), ("e1", "e3", "LOCATED_IN", 1), ("e2", "e3", "FOUND_IN", 2)]
+        self.mentions = {"a.json": ["e1", "e2"], "b.json": ["e1", "e2", "e3"]}
+        self.provenance = [("PRODUCES", "a.json", "DuPont", "PFOA"), ("FOUND_IN", "b.json", "PFOA", "Ohio")]
+        self.files_params = list()
+
+    def stream_query(self, query, data=None, db=None, fetch_size=1000):
+        if query == SnapshotBuilder.QUERY_FILES:
+            return [{'file': f, 'built': ts} for f, ts in self.built.items()]
+        if query == SnapshotBuilder.QUERY_ENTITIES:
+            return [{'id': e, 'label': label, 'name': name,
+                     'rels': [[t, r, c] for s, t, r, c in self.rels if s == e]}
+                    for e, (label, name) in self.entities.items()]
+        self.files_params.append(data['files'])
+        selected = lambda f: data['files'] is None or f in data['files']
+        if query == SnapshotBuilder.QUERY_MENTIONS:
+            return [{'file': f, 'entities': es} for f, es in self.mentions.items() if selected(f)]
+        if query == SnapshotBuilder.QUERY_PROVENANCE:
+            normalized = "n.name_normalized = toLower(ex.source)" in query
+
+            def resolve(name):
+                for e, (_, entity_name) in self.entities.items():
+                    if (entity_name.lower() == name.lower()) if normalized else entity_name == name:
+                        return e
+            return [{'type': r, 'file': f, 'source': resolve(s), 'target': resolve(t)}
+                    for r, f, s, t in self.provenance if selected(f)]
+        raise ValueError(query)
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "snapshot")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_aggregations(self):
+        meta = SnapshotBuilder(FakeNeo()).build(self.path)
+        self.assertEqual(meta['mode'], "full")
+        with Snapshot(self.path) as snapshot:
+            self.assertEqual(snapshot.meta['counts'],
+                             {'entities': 3, 'relationships': 3, 'files': 2, 'mentions': 5, 'provenance': 2})
+            self.assertEqual(list(snapshot.names), ["DuPont", "PFOA", "Ohio"])
+            self.assertEqual(snapshot.neighbors(0), [(1, "PRODUCES", 3), (2, "LOCATED_IN", 1)])
+            self.assertEqual(list(snapshot.degrees()), [2, 2, 2])
+            self.assertEqual(snapshot.degree_stats()['max'], 2)
+            self.assertEqual(snapshot.relation_type_histogram(weighted=True),
+                             {"PRODUCES": 3, "FOUND_IN": 2, "LOCATED_IN": 1})
+            self.assertEqual(snapshot.mentions_per_file(), {"a.json": 2, "b.json": 3})
+            self.assertEqual(snapshot.top_entities(1), [("DuPont", "Organization", 2)])
+            self.assertEqual(snapshot.provenance_per_file(), {"a.json": 1, "b.json": 1})
+
+    def test_provenance_spelling(self):
+        # the entity is named after its first mention, a later document spells it differently
+        neo = FakeNeo()
+        neo.provenance.append(("PRODUCES", "b.json", "DUPONT", "pfoa"))
+        SnapshotBuilder(neo).build(self.path)
+        with Snapshot(self.path) as snapshot:
+            self.assertEqual(snapshot.provenance_per_file(), {"a.json": 1, "b.json": 2})
+            c = snapshot.columns
+            self.assertEqual(sorted(zip(c['prov_source'], c['prov_target'])), [(0, 1), (0, 1), (1, 2)])
+
+    def test_refresh(self):
+        neo = FakeNeo()
+        builder = SnapshotBuilder(neo)
+        builder.build(self.path)
+        self.assertEqual(builder.build(self.path)['mode'], "unchanged")
+
+        # b.json re-projected: a new entity & relation, PFOA no longer mentioned by it
+        neo.built["b.json"] = 30
+        neo.entities["e4"] = ("Person", "Bilott")
+        neo.rels.append(("e4", "e1", "SUED", 1))
+        neo.mentions["b.json"] = ["e1", "e3", "e4"]
+        neo.files_params.clear()
+        meta = builder.build(self.path)
+        self.assertEqual((meta['mode'], meta['changed_files']), ("refresh", 1))
+        self.assertEqual(neo.files_params, [["b.json"], ["b.json"]], "Only the changed file is read.")
+        with Snapshot(self.path) as snapshot:
+            self.assertEqual(meta['kg_built'], 30)
+            self.assertEqual(snapshot.mentions_per_file(), {"a.json": 2, "b.json": 3})
+            self.assertEqual(list(snapshot.entity_mentions()), [2, 1, 1, 1])
+            self.assertEqual(snapshot.relation_type_histogram()["SUED"], 1)
+            self.assertEqual(snapshot.provenance_per_file(), {"a.json": 1, "b.json": 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
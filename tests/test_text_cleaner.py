@@ -0,0 +1,36 @@
+import unittest
+import logging
+from src.textCleaner import TextCleaner
+
+logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(name)s - %(levelname)s: %(message)s")
+
+LETTERHEAD = """Minnesota        Pollution     Control      Agency
+
+                                                    RECEIVED
+                                                              1983
+"""
+
+
+class TestTextCleaner(unittest.TestCase):
+    def test_normalize(self):
+        text = TextCleaner.normalize(LETTERHEAD + "\n\n\n\n  Dear   Sir,\t\tthe  permit\r\nis attached.  ")
+        self.assertEqual(text, "Minnesota Pollution Control Agency\n\nRECEIVED\n1983\n\nDear Sir, the permit\nis attached.")
+
+    def test_strip_boilerplate(self):
+        pages = [f"{LETTERHEAD}\nBody of page {i}: the sampling of groundwater at site {i}.\n\nPage {i} of 4"
+                 for i in range(1, 5)]
+        pages[2] += "\nRECEIVED"  # repeated stamp
+        cleaned, stats = TextCleaner().clean(pages)
+        self.assertEqual(cleaned[0], "Body of page 1: the sampling of groundwater at site 1.")
+        self.assertEqual(cleaned[2], "Body of page 3: the sampling of groundwater at site 3.")
+        self.assertEqual(stats['boilerplate_lines'], 4 * 4 + 1)
+        self.assertTrue(stats['tokens_clean'] < stats['tokens_raw'] / 2, stats)
+
+        # a single page has nothing to compare with, only whitespace is collapsed
+        cleaned, stats = TextCleaner().clean(pages[:1])
+        self.assertTrue(cleaned[0].startswith("Minnesota Pollution Control Agency"))
+        self.assertEqual(stats['boilerplate_lines'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import os
+import unittest
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from src.neo4jWriter import Neo4jWriter
+from src.workQueue import WorkQueue
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s: %(message)s")
+LABEL = "WorkQueueTest"
+
+
+class FakeNeo:
+    """Answers leases with the given results in turn, `available` jobs are reported by the count query."""
+    def __init__(self, leases: list, available: int):
+        self.leases = leases
+        self.available = available
+        self.n_leases = 0
+
+    def run_multi_queries(self, queries, db=None):
+        self.n_leases += 1
+        return [list(), [{'element_id': x} for x in self.leases.pop(0)]]
+
+    def run_simple_query(self, query, data=None, db=None):
+        assert query == WorkQueue(self, LABEL)._query(WorkQueue.QUERY_AVAILABLE)
+        return [{'n': self.available}]
+
+
+class TestWorkQueueLease(unittest.TestCase):
+    def test_lost_candidates(self):
+        # candidates taken by other workers: the lease is re-tried while jobs are available
+        neo = FakeNeo([[], [], ["4:x:1"]], available=1)
+        self.assertEqual(WorkQueue(neo, LABEL).lease(3), ["4:x:1"])
+        self.assertEqual(neo.n_leases, 3)
+
+        neo = FakeNeo([[]], available=0)
+        self.assertEqual(WorkQueue(neo, LABEL).lease(3), list(), "Empty queue.")
+
+
+@unittest.skipUnless(os.environ.get('NEO4J_URI'), "Needs a Neo4j DB.")
+class TestWorkQueue(unittest.TestCase):
+    def setUp(self):
+        self.neo = Neo4jWriter('neo4j')
+        self.neo.run_write_query(f"MATCH (n:{LABEL}) DETACH DELETE n")
+        res = self.neo.run_write_query(f"UNWIND range(1, 50) AS i CREATE (n:{LABEL} {{id: i}}) "
+                                       f"RETURN elementId(n) AS element_id")
+        self.ids = [x['element_id'] for x in res]
+
+    def tearDown(self):
+        self.neo.run_write_query(f"MATCH (n:{LABEL}) DETACH DELETE n")
+        self.neo.close()
+
+    def test_concurrent_leases(self):
+        queue = WorkQueue(self.neo, LABEL)
+        self.assertEqual(queue.enqueue(self.ids), 50)
+        self.assertEqual(queue.enqueue(self.ids), 0, "Queued documents must not be enqueued twice.")
+
+        def work(worker: int) -> list:
+            worker_queue = WorkQueue(self.neo, LABEL, worker_id=f"worker-{worker}")
+            leased = list()
+            while True:
+                ids = worker_queue.lease(3)
+                if not ids:
+                    return leased
+                leased += ids
+                worker_queue.complete(ids)
+
+        with ThreadPoolExecutor(4) as pool:
+            leased = [x for ids in pool.map(work, range(4)) for x in ids]
+        self.assertEqual(sorted(leased), sorted(self.ids), "Every job must be leased exactly once.")
+        self.assertEqual(queue.stats()['done'], 50)
+
+    def test_lease_expiry_and_dead_letters(self):
+        queue = WorkQueue(self.neo, LABEL, lease_seconds=0., max_attempts=2)
+        queue.enqueue(self.ids[:2])
+        crashed = queue.lease(1)  # never finished, the lease expires
+        failing = [x for x in self.ids[:2] if x not in crashed][0]
+
+        self.assertEqual(sorted(queue.lease(10)), sorted(self.ids[:2]), "Expired lease must be re-leased.")
+        queue.fail(failing, "LLM error")
+        self.assertEqual(queue.lease(10), [failing], "Failed job is re-tried, the expired one isn't (2 attempts).")
+        queue.fail(failing, "LLM error")
+
+        self.assertEqual(queue.lease(10), list())
+        self.assertEqual(queue.stats()['failed'], 2)
+        self.assertEqual(sorted((x['element_id'], x['error']) for x in queue.dead_letters()),
+                         sorted([(crashed[0], "Lease expired"), (failing, "LLM error")]))
+        self.assertEqual(queue.requeue_failed(), 2)
+        self.assertEqual(queue.stats()['pending'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()